@@ -0,0 +1,218 @@
+''' Headless headstone detection for directories of orthophotos, without a display or PyQt
+
+    Usage: batch_detect.py [IMAGES ...] [--output-dir DIR] [--database FILE.db] [--workers N]
+
+    IMAGES may be directories, searched for .tif/.tiff files, or glob patterns. Every image needs a world file
+    (.tfw) next to it. Each image gets a GeoJSON file in the output directory and/or a table in the database,
+    named after the image. Images are processed concurrently, each worker process loads the model once.
+'''
+
+import argparse
+import configparser
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from ml.worldfile import WorldFileTransform
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+
+# Loaded once per worker process
+_detect_fn = None
+
+
+def read_config(filename: str) -> dict:
+    ''' Read the detection settings from config.ini, with the same defaults as the editor '''
+    parser = configparser.ConfigParser()
+    parser.read(filename)
+    settings = parser['DEFAULT']
+    return {
+        'confidence_threshold': float(settings.get('confidence_threshold', "0.45")),
+        'iou_threshold': float(settings.get('iou_threshold', "0.15")),
+        'batch_size': int(settings.get('batch_size', "8")),
+        'tiling_backend': settings.get('tiling_backend', 'numpy'),
+        'nms_mode': settings.get('nms_mode', 'grid'),
+        'empty_crop_min_std': float(settings.get('empty_crop_min_std', "0")),
+        'empty_crop_max_padding': float(settings.get('empty_crop_max_padding', "1")),
+        'saved_model_path': settings.get('saved_model_path', 'ml/final_trained_model/saved_model'),
+        'detection_server': settings.get('detection_server', '127.0.0.1:8765'),
+        'detection_cache_dir': settings.get('detection_cache_dir', 'detection_cache'),
+        'detection_cache_size_mb': float(settings.get('detection_cache_size_mb', "1024"))
+    }
+
+
+def find_images(inputs: list) -> list:
+    ''' Expand directories and glob patterns into a sorted list of image paths '''
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            candidates = glob.glob(pattern)
+        paths.update(path for path in candidates
+                     if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def read_world_file(image_path: str) -> WorldFileTransform:
+    ''' Returns the world file transform of an image, from the .tfw next to it '''
+    return WorldFileTransform.from_file(os.path.splitext(image_path)[0] + ".tfw")
+
+
+def table_name(image_path: str) -> str:
+    ''' Database table name for an image, its file name reduced to a valid identifier '''
+    name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(image_path))[0])
+    return name if re.match(r'[A-Za-z_]', name) else f't_{name}'
+
+
+def polygons_to_geojson(name: str, world_polygons: np.ndarray) -> dict:
+    ''' Build the same GeoJSON the editor exports, for an (N, 4, 2) array of world polygons '''
+    geojson = {'type': 'FeatureCollection', 'name': name, 'features': []}
+    for polygon_id, corners in enumerate(world_polygons.tolist()):
+        centroid = np.mean(corners, axis=0).tolist()
+        feature = {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'MultiPolygon', 'coordinates': []}}
+        feature['geometry']['coordinates'] = [[corners + [corners[0]]]]
+        feature['properties']['id'] = polygon_id
+        feature['properties']['row'] = None
+        feature['properties']['col'] = None
+        feature['properties']['centroid'] = centroid
+        geojson['features'].append(feature)
+    return geojson
+
+
+def _init_worker(saved_model_path: str, server_address: str, threads: int) -> None:
+    ''' Connect to the detection service, or load the model once in each worker process '''
+    global _detect_fn
+    from ml import detection_server
+
+    _detect_fn = detection_server.get_detect_fn(saved_model_path, server_address, threads)
+
+
+def detect_image(image_path: str, settings: dict) -> np.ndarray:
+    ''' Run detection on a single image in a worker process, returns an (N, 4, 2) array of pixel polygons '''
+    import PIL.Image
+
+    from ml import detection_cache, image_cut, inference, raster
+
+    # Compressed images are decoded by PIL, which refuses very large images by default
+    PIL.Image.MAX_IMAGE_PIXELS = None
+    image = raster.open_raster(image_path)
+    crop_size = (320, 320)
+    stride = 300
+    full_size = image_cut.get_image_size(image)
+    crop_filter = image_cut.EmptyCropFilter(settings['empty_crop_min_std'], settings['empty_crop_max_padding'])
+
+    # Raw detections are cached, so runs with other thresholds skip the model
+    cache = None
+    cache_key, detections = None, None
+    if settings['detection_cache_dir'] and settings['detection_cache_size_mb'] > 0:
+        cache = detection_cache.DetectionCache(settings['detection_cache_dir'],
+                                               int(settings['detection_cache_size_mb'] * 1024 * 1024))
+        cache_key, detections = cache.lookup(image, settings['saved_model_path'], crop_size, stride, crop_filter,
+                                             settings['confidence_threshold'])
+
+    if detections is None:
+        crops = image_cut.iter_crops_with_padding(crop_size, stride, image, prefetch=2 * settings['batch_size'],
+                                                  backend=settings['tiling_backend'])
+        accumulator = inference.DetectionAccumulator()
+        for _, batch_detections, flag in detection_cache.iter_cached_detections(
+                cache, cache_key, _detect_fn, crops, full_size, stride, settings['confidence_threshold'],
+                settings['batch_size'], crop_filter):
+            if flag:
+                accumulator.append(batch_detections)
+        detections = accumulator.finalize()
+
+    detections = inference.non_maximum_supression(detections, settings['iou_threshold'], settings['nms_mode'])
+    return inference.boxes_to_pixel_polygons(detections['detection_boxes'], full_size)
+
+
+def write_results(image_path: str, pixel_polygons: np.ndarray, output_dir: str, database) -> None:
+    ''' Save the detections of an image as GeoJSON and/or a database table '''
+    name = table_name(image_path)
+    world_polygons = read_world_file(image_path).to_world(pixel_polygons)
+
+    if output_dir is not None:
+        with open(os.path.join(output_dir, f'{name}.geojson'), 'w') as output_file:
+            json.dump(polygons_to_geojson(name, world_polygons), output_file, indent=2)
+
+    if database is not None:
+        from database import gravestone_rows
+
+        database.create_table(name)
+        count = len(world_polygons)
+        database.add_entries(name, gravestone_rows(range(count), [None] * count, [None] * count,
+                                                   world_polygons.tolist(), world_polygons.mean(axis=1).tolist()))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Detect headstones in orthophotos without the editor.')
+    parser.add_argument('images', nargs='+', help='directories or glob patterns of TIFF images with .tfw files')
+    parser.add_argument('--output-dir', help='directory to write one GeoJSON file per image to')
+    parser.add_argument('--database', help='SQLite database to write one table per image to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of images processed at once')
+    parser.add_argument('--config', default='./config.ini', help='configuration file, as used by the editor')
+    parser.add_argument('--model', help='saved model directory, overrides saved_model_path in the config')
+    args = parser.parse_args(argv)
+
+    if args.output_dir is None and args.database is None:
+        parser.error('at least one of --output-dir or --database is required')
+
+    settings = read_config(args.config)
+    if args.model is not None:
+        settings['saved_model_path'] = args.model
+
+    image_paths = []
+    for image_path in find_images(args.images):
+        if os.path.exists(os.path.splitext(image_path)[0] + ".tfw"):
+            image_paths.append(image_path)
+        else:
+            print(f'Skipping {image_path}, it has no world file')
+    if not image_paths:
+        print('No images to process')
+        return 1
+
+    database = None
+    if args.database is not None:
+        from database import Database
+        database = Database(args.database)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # Split the cores between workers, so concurrent models don't oversubscribe the CPU
+    workers = max(1, min(args.workers, len(image_paths)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # Spawned workers don't inherit any TensorFlow state from this process
+    context = multiprocessing.get_context('spawn')
+    failures = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(settings['saved_model_path'], settings['detection_server'], threads)) as executor:
+        futures = {executor.submit(detect_image, image_path, settings): image_path for image_path in image_paths}
+        for future in as_completed(futures):
+            image_path = futures[future]
+            try:
+                pixel_polygons = future.result()
+                write_results(image_path, pixel_polygons, args.output_dir, database)
+            except Exception as e:
+                failures += 1
+                print(f'Failed on {image_path}: {e}')
+                continue
+            print(f'{image_path}: {len(pixel_polygons)} headstones')
+
+    if database is not None:
+        database.close()
+    print(f'Processed {len(image_paths) - failures} of {len(image_paths)} images '
+          f'in {time.perf_counter() - start:.1f}s')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,8 @@
 from PyQt5.QtCore import QPointF
 
+# Kept free of Qt in ml, so batch_detect can use it without importing PyQt
+from ml.worldfile import WorldFileTransform
+
 
 # read for info
 
@@ -13,8 +16,8 @@ def pixel_map(coordinate, a, d, b, e, c, f):  # this is the order of the params
     # for x and y
     x1 = coordinate.x()
     y1 = coordinate.y()
-    x = (-(b*f) + (b*y1) + (c*e) - (e * x1))/-(a*e) + (b*d)
-    y = (-(d*c) + (d*x1) + (a*f) - (a * y1))/-(a*e) + (b*d)
+    x = (-(b*f) + (b*y1) + (c*e) - (e * x1))/(-(a*e) + (b*d))
+    y = (-(d*c) + (d*x1) + (a*f) - (a * y1))/(-(a*e) + (b*d))
 
     return QPointF(x, y)
 
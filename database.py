@@ -1,113 +1,276 @@
 import json
 import re
 import sqlite3
+import threading
 
-import pandas as pd
+import numpy as np
 
 import database_validation
 
 
+# Columns of a gravestone table, in order
+COLUMNS = ('id', 'row', 'col', 'toplx', 'toply', 'toprx', 'topry', 'botlx', 'botly', 'botrx', 'botry',
+           'centroidx', 'centroidy')
+
+
+def gravestone_rows(ids, rows, cols, corners, centroids) -> list:
+    """ Table rows for polygons with corners in the order top left, top right, bottom right, bottom left """
+    return [(id, row, col,
+             points[0][0], points[0][1], points[1][0], points[1][1],
+             points[3][0], points[3][1], points[2][0], points[2][1],
+             centroid[0], centroid[1])
+            for id, row, col, points, centroid in zip(ids, rows, cols, corners, centroids)]
+
+
+# Rows read without pandas, NULL ids, rows, cols and coordinates are NaN
+GRAVESTONE_DTYPE = np.dtype([(column, np.float64) for column in COLUMNS])
+
+
+def rows_to_array(rows: list) -> np.ndarray:
+    """ Converts rows of the table's COLUMNS, as returned by a cursor, to a structured array a column at a time.
+        Values that aren't numbers, such as text typed into a table by hand, are read as NaN like NULL """
+    array = np.empty(len(rows), dtype=GRAVESTONE_DTYPE)
+    if rows:
+        columns = np.array(rows, dtype=object)
+        bad = np.zeros(len(rows), dtype=bool)
+        for index, column in enumerate(COLUMNS):
+            array[column], not_numbers = database_validation.numeric_column(columns[:, index])
+            bad |= not_numbers
+        indices = np.flatnonzero(bad)
+        if len(indices):
+            print(f"{len(indices)} rows have a value that isn't a number, read as empty, rows "
+                  f"{indices[:10].tolist()}{'...' if len(indices) > 10 else ''}")
+    return array
+
+
+def optional_int(value):
+    """ An id, row or col as an int, or None for NULL, which is NaN in arrays and None or NaN in DataFrames """
+    if value is None or value != value:
+        return None
+    return int(value)
+
+
+# Bounding box of a gravestone's corners, as stored in its table's spatial index
+MIN_X = "min({0}toplx, {0}toprx, {0}botlx, {0}botrx)"
+MAX_X = "max({0}toplx, {0}toprx, {0}botlx, {0}botrx)"
+MIN_Y = "min({0}toply, {0}topry, {0}botly, {0}botry)"
+MAX_Y = "max({0}toply, {0}topry, {0}botly, {0}botry)"
+# Rows with every corner set to a number, the only ones in the spatial index. Text typed into a corner by hand
+# would otherwise sort above every number and give the R*Tree an inverted box
+HAS_CORNERS = " AND ".join(f"typeof({{0}}{column}) IN ('integer', 'real')" for column in COLUMNS[3:11])
+
+
+def spatial_index_name(tablename: str) -> str:
+    """ Name of the R*Tree virtual table indexing a gravestone table """
+    return f"{tablename}_rtree"
+
+
 class Database:
     def __init__(self, db_url):
         self.db_url = db_url
+        # sqlite connections can't be used across threads, so each thread gets its own, kept open until close()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # False if this sqlite was built without the R*Tree module
+        self.rtree_available = True
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_url, check_same_thread=False)
+            # Write ahead logging lets readers carry on during a write, and only syncs to disk at checkpoints
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("PRAGMA temp_store=MEMORY;")
+            conn.execute("PRAGMA cache_size=-16000;")
+            # Rows removed by INSERT OR REPLACE fire delete triggers, keeping spatial indexes in sync
+            conn.execute("PRAGMA recursive_triggers=ON;")
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self) -> None:
+        """ Close the connections of every thread """
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
 
     def create_table(self, tablename: str) -> None:
-        conn = sqlite3.connect(self.db_url)
-        c = conn.cursor()
+        conn = self._connection()
         try:
             create = f'''CREATE TABLE IF NOT EXISTS {tablename} 
                 (id INTEGER UNIQUE, row INTEGER, col INTEGER, 
                 toplx FLOAT, toply FLOAT, toprx FLOAT, topry FLOAT, 
                 botlx FLOAT, botly FLOAT, botrx FLOAT, botry FLOAT,
                 centroidx FLOAT, centroidy FLOAT);'''
-            c.execute(create)
+            with conn:
+                conn.execute(create)
         except conn.Error as e:
-            conn.commit()
-            conn.close()
             print(e)
             return
         except:
-            conn.commit()
-            conn.close()
             print("Unknown Error Occured in create")
             return
-        conn.commit()
-        conn.close()
+        self.create_spatial_index(tablename)
 
-    def delete_table(self, tablename: str) -> None:
-        conn = sqlite3.connect(self.db_url)
+    def create_spatial_index(self, tablename: str) -> bool:
+        """ Create the R*Tree of a table's gravestone bounding boxes if it doesn't exist, filled from the rows
+            already in the table, with triggers keeping it in sync on insert, replace, update and delete.
+            Returns whether the table has a spatial index """
+        if not self.rtree_available:
+            return False
+        conn = self._connection()
+        index = spatial_index_name(tablename)
         c = conn.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?;", (index,))
+        if c.fetchone() is not None:
+            return True
+
+        new = "new."
+        insert = (f"INSERT OR REPLACE INTO {index} VALUES (new.rowid, {MIN_X.format(new)}, {MAX_X.format(new)}, "
+                  f"{MIN_Y.format(new)}, {MAX_Y.format(new)});")
+        try:
+            with conn:
+                conn.execute(f"CREATE VIRTUAL TABLE {index} USING rtree(id, minx, maxx, miny, maxy);")
+                conn.execute(f"INSERT INTO {index} SELECT rowid, {MIN_X.format('')}, {MAX_X.format('')}, "
+                             f"{MIN_Y.format('')}, {MAX_Y.format('')} FROM {tablename} "
+                             f"WHERE {HAS_CORNERS.format('')};")
+                conn.execute(f"CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {tablename} "
+                             f"WHEN {HAS_CORNERS.format(new)} BEGIN {insert} END;")
+                conn.execute(f"CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE ON {tablename} BEGIN "
+                             f"DELETE FROM {index} WHERE id = old.rowid; "
+                             f"INSERT INTO {index} SELECT new.rowid, {MIN_X.format(new)}, {MAX_X.format(new)}, "
+                             f"{MIN_Y.format(new)}, {MAX_Y.format(new)} WHERE {HAS_CORNERS.format(new)}; END;")
+                conn.execute(f"CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {tablename} BEGIN "
+                             f"DELETE FROM {index} WHERE id = old.rowid; END;")
+        except conn.OperationalError as e:
+            if "rtree" in str(e):
+                print("SQLite was built without R*Tree support, bounding box queries will scan the whole table")
+                self.rtree_available = False
+            else:
+                print(e)
+            return False
+        return True
+
+    def delete_table(self, tablename: str) -> None:
+        conn = self._connection()
         try:
             delete = f"DROP TABLE IF EXISTS {tablename};"
-            c.execute(delete)
+            with conn:
+                conn.execute(delete)
+                conn.execute(f"DROP TABLE IF EXISTS {spatial_index_name(tablename)};")
         except conn.Error as e:
-            conn.commit()
-            conn.close()
             print(e)
-            return
         except:
-            conn.commit()
-            conn.close()
             print("Unknown Error Occured in delete")
-            return
-        conn.commit()
-        conn.close()
 
     def get_gravestones(self, tablename: str):
-        conn = sqlite3.connect(self.db_url)
+        """ Returns a table as a pandas DataFrame. fetch_gravestones is faster and doesn't need pandas """
+        import pandas as pd
+
+        conn = self._connection()
         try:
             df = pd.read_sql_query(f"SELECT * FROM {tablename}", conn)
         except conn.Error as e:
-            conn.commit()
-            conn.close()
             print(e)
             return
         except Exception as e:
-            conn.commit()
-            conn.close()
-
             print(e)
             return
-        conn.commit()
-        conn.close()
 
         return df
 
+    def _fetch(self, query: str, params: tuple = ()):
+        conn = self._connection()
+        try:
+            rows = conn.execute(query, params).fetchall()
+        except conn.Error as e:
+            print(e)
+            return
+        except Exception as e:
+            print(e)
+            return
+
+        return rows_to_array(rows)
+
+    def fetch_gravestones(self, tablename: str):
+        """ Returns a table as a structured array of GRAVESTONE_DTYPE, read straight from the cursor """
+        return self._fetch(f"SELECT {', '.join(COLUMNS)} FROM {tablename};")
+
+    def query_bbox(self, tablename: str, minx: float, miny: float, maxx: float, maxy: float):
+        """ Returns the gravestones whose corners' bounding box intersects the given box, in world coordinates,
+            as a structured array of GRAVESTONE_DTYPE. Found through the table's R*Tree rather than reading
+            the whole table """
+        bounds = (maxx, minx, maxy, miny)
+        # The R*Tree rounds boxes outwards to 32 bit floats, so the matches are checked against the exact corners
+        exact = (f"{MIN_X.format('t.')} <= ? AND {MAX_X.format('t.')} >= ? AND "
+                 f"{MIN_Y.format('t.')} <= ? AND {MAX_Y.format('t.')} >= ?")
+        columns = ', '.join(f"t.{column}" for column in COLUMNS)
+        if self.create_spatial_index(tablename):
+            query = (f"SELECT {columns} FROM {tablename} AS t JOIN {spatial_index_name(tablename)} AS r "
+                     f"ON t.rowid = r.id WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ? "
+                     f"AND {exact};")
+            return self._fetch(query, bounds + bounds)
+        return self._fetch(f"SELECT {columns} FROM {tablename} AS t WHERE {exact};", bounds)
+
+    def max_id(self, tablename: str):
+        """ Returns the largest headstone id in a table, or None if it's empty """
+        conn = self._connection()
+        try:
+            return conn.execute(f"SELECT max(id) FROM {tablename};").fetchone()[0]
+        except conn.Error as e:
+            print(e)
+            return
+
     def get_tables(self) -> list:
-        conn = sqlite3.connect(self.db_url)
-        c = conn.cursor()
-        c.execute(f"SELECT name FROM sqlite_master WHERE type='table';")
+        c = self._connection().cursor()
+        c.execute(f"SELECT name, sql FROM sqlite_master WHERE type='table';")
         tables = c.fetchall()
-        conn.commit()
-        conn.close()
+        # R*Tree spatial indexes and the shadow tables storing them aren't gravestone tables
+        hidden = set()
+        for name, sql in tables:
+            if sql is not None and sql.upper().startswith("CREATE VIRTUAL TABLE"):
+                hidden.update((name, f"{name}_node", f"{name}_parent", f"{name}_rowid"))
         list_of_tables = []
         for table in tables:
-            list_of_tables.append(table[0])
+            if table[0] not in hidden:
+                list_of_tables.append(table[0])
         return list_of_tables
 
     def export_table(self, tablename: str, output_filename: str) -> None:
-        df = self.get_gravestones(tablename, self.db_url)
+        gravestones = self.fetch_gravestones(tablename)
         properties = ['id', 'row', 'col', 'centroid']
-        geojson = self.df_to_geojson(df, properties)
+        geojson = self.df_to_geojson(gravestones, properties)
         with open(output_filename, 'w') as output_file:
             json.dump(geojson, output_file, indent=2)
 
     def df_to_geojson(self, df, properties, toplx='toplx', toply='toply', toprx='toprx', topry='topry', botlx='botlx',
                       botly='botly', botrx='botrx', botry='botry', centroidx='centroidx',
                       centroidy='centroidy') -> dict:
+        # df is a structured array from fetch_gravestones or a pandas DataFrame, read a whole column at a time
+        def column(name):
+            return np.asarray(df[name]).tolist()
+
+        values = {}
+        for prop in properties:
+            if prop == 'id' or prop == 'row' or prop == 'col':
+                values[prop] = [optional_int(value) for value in column(prop)]
+            elif prop == 'centroid':
+                values[prop] = [list(centroid) for centroid in zip(column(centroidx), column(centroidy))]
+            else:
+                values[prop] = column(prop)
+
         geojson = {'type': 'FeatureCollection', 'name': "Arlington", 'features': []}
-        for _, row in df.iterrows():
+        corners = zip(*(column(name) for name in (toplx, toply, toprx, topry, botlx, botly, botrx, botry)))
+        for index, (tlx, tly, trx, tr_y, blx, bly, brx, br_y) in enumerate(corners):
             feature = {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'MultiPolygon', 'coordinates': []}}
-            feature['geometry']['coordinates'] = [
-                [[row[toplx], row[toply]], [row[toprx], row[topry]], [row[botlx], row[botly]], [row[botrx], row[botry]],
-                 [row[toplx], row[toply]]]]
+            feature['geometry']['coordinates'] = [[[tlx, tly], [trx, tr_y], [blx, bly], [brx, br_y], [tlx, tly]]]
             for prop in properties:
-                if prop == 'id' or prop == 'row' or prop == 'col':
-                    feature['properties'][prop] = int(row[prop]) if row[prop] is not None else None
-                elif prop == 'centroid':
-                    feature['properties'][prop] = [row[centroidx], row[centroidy]]
-                else:
-                    feature['properties'][prop] = row[prop]
+                feature['properties'][prop] = values[prop][index]
             geojson['features'].append(feature)
         return geojson
 
@@ -126,20 +289,33 @@ class Database:
             botrx) or not database_validation.isValidCoord(botry) or not database_validation.isValidCoord(
             centroidx) or not database_validation.isValidCoord(centroidy):
             return
-        conn = sqlite3.connect(self.db_url)
-        c = conn.cursor()
+        conn = self._connection()
         try:
             add = f"INSERT OR REPLACE INTO {tablename} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);"
-            c.execute(add, (id, row, col, toplx, toply, toprx, topry, botlx, botly, botrx, botry, centroidx, centroidy))
+            with conn:
+                conn.execute(add, (id, row, col, toplx, toply, toprx, topry, botlx, botly, botrx, botry, centroidx,
+                                   centroidy))
         except conn.Error as e:
-            conn.commit()
-            conn.close()
             print(e)
-            return
         except:
-            conn.commit()
-            conn.close()
             print("Unknown Error Occured")
-            return
-        conn.commit()
-        conn.close()
+
+    def add_entries(self, tablename: str, entries) -> int:
+        """ Insert or replace many rows, each a tuple of the table's COLUMNS, in a single transaction.
+            The rows are validated a column at a time and invalid rows are skipped, returns the number written """
+        entries = list(entries)
+        if entries:
+            invalid = set(database_validation.invalid_rows(dict(zip(COLUMNS, zip(*entries)))).tolist())
+            entries = [entry for index, entry in enumerate(entries) if index not in invalid]
+        conn = self._connection()
+        try:
+            add = f"INSERT OR REPLACE INTO {tablename} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?);"
+            with conn:
+                conn.executemany(add, entries)
+        except conn.Error as e:
+            print(e)
+            return 0
+        except:
+            print("Unknown Error Occured")
+            return 0
+        return len(entries)
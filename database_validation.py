@@ -1,17 +1,35 @@
+import math
+import numbers
 import re
 
+import numpy as np
+
+# Compiled once, these are used for every row of interactive edits
+CEMETERY_PATTERN = re.compile('^[a-zA-Z ]+$')
+ID_PATTERN = re.compile('^[0-9]+$')
+ORDER_PATTERN = re.compile('^[0-9a-zA-Z -]+$')
+# Decimal or scientific notation, with or without a fractional part
+COORD_PATTERN = re.compile(r'^[+-]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][+-]?[0-9]+)?$')
+GEOJSON_PATTERN = re.compile('^[a-zA-Z0-9 -_]+.geojson$')
+CSV_PATTERN = re.compile('^[a-zA-Z0-9 -_]+.csv$')
+TXT_PATTERN = re.compile('^[a-zA-Z0-9 -_]+.txt$')
+
+# Columns checked by invalid_rows
+ORDER_FEATURES = ('row', 'col')
+COORD_FEATURES = ('toplx', 'toply', 'toprx', 'topry', 'botlx', 'botly', 'botrx', 'botry', 'centroidx', 'centroidy')
+# No projected or geographic coordinate system comes near this
+MAX_ABS_COORD = 1e9
+
 
 def validate_cemetery_name(cemetery_name: str) -> bool:
-    pattern = re.compile('^[a-zA-Z ]+$')
-    if cemetery_name and re.match(pattern, cemetery_name):
+    if cemetery_name and re.match(CEMETERY_PATTERN, cemetery_name):
         return True
     print("Cemetery name may only contain alphabetical characters or spaces.")
     return False
 
 
 def isValidCemetery(cemetery_name: str) -> bool:
-    pattern = re.compile('^[a-zA-Z ]+$')
-    if cemetery_name and re.match(pattern, cemetery_name):
+    if cemetery_name and re.match(CEMETERY_PATTERN, cemetery_name):
         return True
     print("Cemetery name may only contain alphabetical characters or spaces.")
     return False
@@ -19,9 +37,8 @@ def isValidCemetery(cemetery_name: str) -> bool:
 
 # validate headstone id before inserting into table.
 def isValidID(id: int) -> bool:
-    pattern = re.compile('^[0-9]+$')
     return True
-    if id and re.match(pattern, str(id)):
+    if id and re.match(ID_PATTERN, str(id)):
         return True
     print("Headstone ID may only consist of integers.")
     return False
@@ -30,8 +47,7 @@ def isValidID(id: int) -> bool:
 # validate headstone row's and col's before inserting into table.
 def isValidOrder(rc: int) -> bool:
     return True
-    pattern = re.compile('^[0-9a-zA-Z -]+$')
-    if rc and re.match(pattern, str(rc)):
+    if rc and re.match(ORDER_PATTERN, str(rc)):
         return True
     print("Row's and Col's may only consist of integers or letters.")
     return False
@@ -39,13 +55,62 @@ def isValidOrder(rc: int) -> bool:
 
 # validate headstone coordinates and centroid before inserting into table.
 def isValidCoord(coord: float) -> bool:
-    pattern = re.compile('^[+-]*[0-9]*[.][0-9]+$')
-    if coord and re.match(pattern, str(coord)):
+    if isinstance(coord, numbers.Real) and not isinstance(coord, bool):
+        if math.isfinite(coord):
+            return True
+    elif isinstance(coord, str) and re.match(COORD_PATTERN, coord.strip()):
         return True
     print("Coordinate may only consist of a proper floating point number.")
     return False
 
 
+def numeric_column(values) -> tuple:
+    """ Returns a column as float64, with None as NaN, and a mask of the values that aren't numbers """
+    try:
+        column = np.asarray(values, dtype=np.float64)
+        return column, np.zeros(column.shape, dtype=bool)
+    except (TypeError, ValueError):
+        pass
+
+    # Mixed column, check values one at a time
+    column = np.full(len(values), np.nan)
+    not_numbers = np.zeros(len(values), dtype=bool)
+    for index, value in enumerate(values):
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            column[index] = value
+        elif isinstance(value, str) and re.match(COORD_PATTERN, value.strip()):
+            column[index] = float(value)
+        elif value is not None:
+            not_numbers[index] = True
+    return column, not_numbers
+
+
+# validate whole columns of rows before a bulk insert, instead of a row at a time.
+def invalid_rows(columns) -> np.ndarray:
+    """ Returns the indices of rows with an id that isn't a whole number, a row or col that isn't a whole number
+        or empty, or a coordinate that isn't a finite number within MAX_ABS_COORD. columns maps feature names
+        to sequences, arrays or pandas columns of equal length, a DataFrame works as is """
+    ids, bad = numeric_column(columns['id'])
+    bad |= ~np.isfinite(ids) | (ids != np.round(ids))
+
+    for feature in ORDER_FEATURES:
+        orders, not_numbers = numeric_column(columns[feature])
+        # Empty rows and cols are allowed
+        present = ~np.isnan(orders)
+        bad |= not_numbers | (present & (~np.isfinite(orders) | (orders != np.round(orders))))
+
+    for feature in COORD_FEATURES:
+        coords, not_numbers = numeric_column(columns[feature])
+        with np.errstate(invalid='ignore'):
+            bad |= not_numbers | ~np.isfinite(coords) | (np.abs(coords) > MAX_ABS_COORD)
+
+    indices = np.flatnonzero(bad)
+    if len(indices):
+        print(f"{len(indices)} rows have an invalid id, row, col or coordinate, rows {indices[:10].tolist()}"
+              f"{'...' if len(indices) > 10 else ''}")
+    return indices
+
+
 # validate whether input is a valid feature in table.
 def isValidFeature(feature: str) -> bool:
     features = {'id', 'row', 'col', 'toplx', 'toply', 'toprx', 'topry', 'botlx', 'botly', 'botrx', 'botry', 'centroidx',
@@ -58,8 +123,7 @@ def isValidFeature(feature: str) -> bool:
 
 # validate whether input is a valid geojson file type.
 def isValidGeoJSON(filename: str) -> bool:
-    pattern = re.compile('^[a-zA-Z0-9 -_]+.geojson$')
-    if filename and re.match(pattern, filename):
+    if filename and re.match(GEOJSON_PATTERN, filename):
         return True
     print("File name format is incorrect.")
     return False
@@ -67,8 +131,7 @@ def isValidGeoJSON(filename: str) -> bool:
 
 # NOTE: (might not need when deployed) validate csv file.
 def isValidCSV(filename: str) -> bool:
-    pattern = re.compile('^[a-zA-Z0-9 -_]+.csv$')
-    if filename and re.match(pattern, filename):
+    if filename and re.match(CSV_PATTERN, filename):
         return True
     print("File is not a CSV file.")
     return False
@@ -76,8 +139,7 @@ def isValidCSV(filename: str) -> bool:
 
 # NOTE: (might not need when deployed) validate yolo txt file.
 def isValidTXT(filename: str) -> bool:
-    pattern = re.compile('^[a-zA-Z0-9 -_]+.txt$')
-    if filename and re.match(pattern, filename):
+    if filename and re.match(TXT_PATTERN, filename):
         return True
     print("File is not a TXT file.")
     return False
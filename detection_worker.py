@@ -0,0 +1,156 @@
+import threading
+
+import numpy as np
+from PyQt5 import QtCore
+
+from ml import detection_server, inference, image_cut, raster
+from ml.detection_cache import iter_cached_detections
+
+
+class ModelLoader(QtCore.QThread):
+    """ Loads the detection model in the background after startup, so it's ready when detection is first run """
+
+    # Detect function, or None if the model failed to load
+    model_loaded = QtCore.pyqtSignal(object)
+
+    def __init__(self, saved_model_path, server_address=None, parent=None):
+        super(ModelLoader, self).__init__(parent)
+
+        self.saved_model_path = saved_model_path
+        self.server_address = server_address
+        self.detect_fn = None
+
+    def run(self):
+        try:
+            self.detect_fn = detection_server.get_detect_fn(self.saved_model_path, self.server_address)
+        except (ValueError, OSError):
+            print(f"Error preloading saved model: {self.saved_model_path}")
+        self.model_loaded.emit(self.detect_fn)
+
+
+class DetectionWorker(QtCore.QThread):
+    """ Runs headstone detection off the GUI thread, reporting progress and each batch's detections as signals """
+
+    # Percentage of crops done
+    progress = QtCore.pyqtSignal(int)
+    # Text describing the current step
+    status = QtCore.pyqtSignal(str)
+    # Detect function, once loaded, so it can be reused by later runs
+    model_loaded = QtCore.pyqtSignal(object)
+    # Detections dictionary of a single batch, before non max supression, with boxes normalized to the full image
+    batch_detected = QtCore.pyqtSignal(object)
+    # Indices of the boxes kept by non max supression, counting boxes across all batches in the order they were sent
+    detection_finished = QtCore.pyqtSignal(object)
+    # Error message
+    detection_failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, image, detect_fn, saved_model_path, confidence_threshold, iou_threshold, batch_size=1,
+                 tiling_backend='numpy', nms_mode='grid', crop_filter=None, crop_size=(320, 320), stride=300,
+                 server_address=None, model_loader=None, detection_cache=None, region=None, existing_boxes=None,
+                 parent=None):
+        super(DetectionWorker, self).__init__(parent)
+
+        self.image = image
+        self.detect_fn = detect_fn
+        self.saved_model_path = saved_model_path
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.batch_size = batch_size
+        self.tiling_backend = tiling_backend
+        self.nms_mode = nms_mode
+        self.crop_filter = crop_filter
+        self.crop_size = crop_size
+        self.stride = stride
+        self.server_address = server_address
+        self.model_loader = model_loader
+        self.detection_cache = detection_cache
+        # (left, top, width, height) of the part of the image to detect in, or None for the whole image
+        self.region = region
+        # Normalized boxes of headstones already marked, new detections overlapping them are dropped before
+        # batch_detected is sent
+        self.existing_boxes = existing_boxes
+
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """ Stop after the batch currently running, detections found so far are still reported """
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            self._detect()
+        except Exception as e:
+            print(f"Error during detection: {e}")
+            self.detection_failed.emit(str(e))
+
+    def _detect(self):
+        # Detections of the same image, model and tiling are reused, only the thresholds are applied again
+        cache_key = None
+        if self.detection_cache is not None and self.region is None:
+            self.status.emit("Checking detection cache...")
+            cache_key, cached = self.detection_cache.lookup(self.image, self.saved_model_path, self.crop_size,
+                                                            self.stride, self.crop_filter, self.confidence_threshold)
+            if cached is not None:
+                if len(cached['detection_scores']):
+                    self.batch_detected.emit(cached)
+                self._finish(cached)
+                return
+
+        if self.detect_fn is None and self.model_loader is not None:
+            # Use the model being preloaded rather than loading a second copy
+            self.status.emit("Loading detection model...")
+            self.model_loader.wait()
+            self.detect_fn = self.model_loader.detect_fn
+
+        if self.detect_fn is None:
+            self.status.emit("Loading detection model...")
+            try:
+                self.detect_fn = detection_server.get_detect_fn(self.saved_model_path, self.server_address)
+            except (ValueError, OSError):
+                self.detection_failed.emit(f"Error loading saved model: {self.saved_model_path}")
+                return
+            print("Model loaded!")
+            self.model_loaded.emit(self.detect_fn)
+
+        # A region is tiled on its own, as though it were the whole image
+        image = self.image
+        if self.region is not None:
+            image = raster.WindowRaster(raster.as_raster(self.image), *self.region)
+        width, height = image_cut.get_image_size(image)
+        crops = image_cut.iter_crops_with_padding(self.crop_size, self.stride, image,
+                                                  prefetch=2 * self.batch_size, backend=self.tiling_backend)
+        rows, cols = image_cut.crop_grid_shape(self.crop_size, self.stride, (width, height))
+
+        self.status.emit("Detecting headstones...")
+        accumulator = inference.DetectionAccumulator()
+        batches = iter_cached_detections(self.detection_cache, cache_key, self.detect_fn, crops, (width, height),
+                                         self.stride, self.confidence_threshold, self.batch_size, self.crop_filter)
+        for done, detections, flag in batches:
+            if flag:
+                if self.region is not None:
+                    detections['detection_boxes'] = inference.region_boxes_to_image(
+                        detections['detection_boxes'], self.region, image_cut.get_image_size(self.image))
+                if self.existing_boxes is not None:
+                    # Headstones already marked are never shown twice
+                    kept = inference.suppress_overlapping(detections, np.arange(len(detections['detection_scores'])),
+                                                          self.existing_boxes, self.iou_threshold)
+                    detections = {key: value[kept] for key, value in detections.items()}
+                if len(detections['detection_scores']):
+                    accumulator.append(detections)
+                    self.batch_detected.emit(detections)
+            self.progress.emit(min(99, done * 100 // (rows * cols)))
+            if self.is_cancelled():
+                batches.close()
+                break
+
+        self._finish(accumulator.finalize())
+
+    def _finish(self, detections):
+        # Prune overlapping boxes across all batches
+        self.status.emit("Removing overlapping detections...")
+        kept_indices = inference.non_maximum_supression_indices(detections, self.iou_threshold, self.nms_mode)
+        self.progress.emit(100)
+        self.detection_finished.emit(kept_indices)
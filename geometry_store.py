@@ -0,0 +1,82 @@
+import numpy as np
+
+# Row and col of polygons that haven't been given one
+NO_VALUE = np.iinfo(np.int64).min
+
+# Corners are in the polygon's item coordinates, in the order top left, top right, bottom right, bottom left,
+# and offset is the item's position in the scene
+GEOMETRY_DTYPE = np.dtype([('id', np.int64), ('row', np.int64), ('col', np.int64),
+                           ('corners', np.float64, (4, 2)), ('offset', np.float64, (2,)), ('used', np.bool_)])
+
+
+def optional_value(value):
+    """ Converts a stored row or col to an int, or None if it isn't set """
+    return None if value == NO_VALUE else int(value)
+
+
+class GeometryStore:
+    """ Structured array holding the id, row, col and corners of every headstone polygon, one record per slot.
+        Polygons keep their slot for as long as they exist, freed slots are reused, so whole selections can be
+        exported, transformed and rotated with array operations instead of a Python loop over points """
+
+    def __init__(self, capacity=1024):
+        self.records = np.zeros(capacity, dtype=GEOMETRY_DTYPE)
+        self._free = []
+        # Slots past this have never been used
+        self._end = 0
+
+    def __len__(self):
+        return self._end - len(self._free)
+
+    def allocate(self, corners, id=0, row=None, col=None):
+        """ Stores a new polygon and returns its slot """
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._end == len(self.records):
+                records = np.zeros(2 * len(self.records), dtype=GEOMETRY_DTYPE)
+                records[:self._end] = self.records[:self._end]
+                self.records = records
+            slot = self._end
+            self._end += 1
+
+        self.records[slot] = (id, NO_VALUE if row is None else row, NO_VALUE if col is None else col,
+                              corners, (0, 0), True)
+        return slot
+
+    def release(self, slot):
+        if self.records['used'][slot]:
+            self.records['used'][slot] = False
+            self._free.append(slot)
+
+    def clear(self):
+        self.records['used'][:self._end] = False
+        self._free = []
+        self._end = 0
+
+    def used_slots(self):
+        """ Slots of every stored polygon, in allocation order for slots never freed """
+        return np.flatnonzero(self.records['used'][:self._end])
+
+    def scene_corners(self, slots):
+        """ (N, 4, 2) corners of the polygons in scene coordinates """
+        return self.records['corners'][slots] + self.records['offset'][slots][:, np.newaxis, :]
+
+    def centroids(self, slots):
+        """ (N, 2) mean of the corners of each polygon in item coordinates """
+        return self.records['corners'][slots].mean(axis=1)
+
+    def radii(self, slots):
+        """ (N,) furthest distance of any corner from each polygon's centroid """
+        corners = self.records['corners'][slots]
+        offsets = corners - corners.mean(axis=1)[:, np.newaxis, :]
+        return np.sqrt(np.sum(offsets ** 2, axis=2)).max(axis=1)
+
+    def rotate(self, slots, degrees):
+        """ Rotates each polygon about its own centroid """
+        radians = np.radians(degrees)
+        rotation = np.array([[np.cos(radians), np.sin(radians)],
+                             [-np.sin(radians), np.cos(radians)]])
+        corners = self.records['corners'][slots]
+        origins = corners.mean(axis=1)[:, np.newaxis, :]
+        self.records['corners'][slots] = (corners - origins).dot(rotation) + origins
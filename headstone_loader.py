@@ -0,0 +1,110 @@
+import numpy as np
+from PyQt5.QtCore import QRectF
+
+from database import optional_int
+from selection_polygon import SelectionPolygon
+
+# Corner columns in the order polygons store them, top left, top right, bottom right, bottom left
+CORNER_COLUMNS = ['toplx', 'toply', 'toprx', 'topry', 'botrx', 'botry', 'botlx', 'botly']
+
+
+class HeadstoneLoader:
+    """ Loads the headstones of a database table lazily, only creating polygons for the rows around the visible
+        part of the image. Polygons that have been panned well out of view are removed again, unless they are
+        selected or have been edited, so memory use follows the viewport rather than the size of the table """
+
+    def __init__(self, viewer, database, tablename, transform, margin=0.5):
+        self.viewer = viewer
+        self.database = database
+        self.tablename = tablename
+        self.transform = transform
+        # fraction of the visible width and height loaded around it, so short pans don't need a query
+        self.margin = margin
+
+        # database id -> polygon made for it
+        self._loaded = {}
+        # database id -> geometry record as loaded, to tell whether the polygon has been edited since
+        self._originals = {}
+        # ids of headstones deleted in the editor, which must not come back when panning over them again
+        self._deleted = set()
+        # scene rect that every headstone has been loaded in
+        self._loaded_rect = QRectF()
+
+        # Polygons drawn or detected from now on take ids after all of the table's, loaded or not, so exporting
+        # them doesn't replace a headstone that hasn't been in view
+        max_id = database.max_id(tablename)
+        if max_id is not None:
+            viewer.reserve_polygon_ids(max_id + 1)
+
+    def loaded_count(self):
+        return len(self._loaded)
+
+    def update(self, visible_rect):
+        """ Loads the headstones around the visible scene rect and removes the unchanged ones far from it """
+        self._forget_deleted()
+        if self._loaded_rect.contains(visible_rect):
+            return
+
+        dx = visible_rect.width() * self.margin
+        dy = visible_rect.height() * self.margin
+        load_rect = visible_rect.adjusted(-dx, -dy, dx, dy)
+        self._load(self._query(load_rect))
+        self._evict(load_rect)
+        self._loaded_rect = load_rect
+
+    def load_all(self):
+        """ Loads every headstone in the table, before exporting all of them """
+        self._forget_deleted()
+        self._load(self.database.fetch_gravestones(self.tablename))
+
+    def _query(self, scene_rect):
+        corners = np.array([[scene_rect.left(), scene_rect.top()], [scene_rect.right(), scene_rect.top()],
+                            [scene_rect.right(), scene_rect.bottom()], [scene_rect.left(), scene_rect.bottom()]])
+        world = self.transform.to_world(corners)
+        minx, miny = world.min(axis=0)
+        maxx, maxy = world.max(axis=0)
+        return self.database.query_bbox(self.tablename, float(minx), float(miny), float(maxx), float(maxy))
+
+    def _load(self, gravestones):
+        """ Creates polygons for the rows of a structured array from the database that aren't loaded yet """
+        if gravestones is None or not len(gravestones):
+            return
+        world_corners = np.stack([gravestones[column] for column in CORNER_COLUMNS], axis=1).reshape(-1, 4, 2)
+        # Rows missing a corner can't be drawn
+        complete = np.isfinite(world_corners).all(axis=(1, 2))
+        gravestones = gravestones[complete]
+        pixel_corners = self.transform.to_pixel(world_corners[complete])
+        for id, row, col, corners in zip(gravestones['id'].tolist(), gravestones['row'].tolist(),
+                                         gravestones['col'].tolist(), pixel_corners):
+            id = optional_int(id)
+            if id in self._loaded or id in self._deleted:
+                continue
+            polygon = SelectionPolygon(corners, self.viewer, id=id, row=optional_int(row), col=optional_int(col))
+            self.viewer.add_selection_polygon(polygon)
+            self._loaded[id] = polygon
+            self._originals[id] = self.viewer.geometry.records[polygon.slot].copy()
+
+    def _is_edited(self, id, polygon):
+        record = self.viewer.geometry.records[polygon.slot]
+        original = self._originals[id]
+        return any(not np.array_equal(record[field], original[field])
+                   for field in ('id', 'row', 'col', 'corners', 'offset'))
+
+    def _evict(self, keep_rect):
+        """ Removes the loaded polygons outside keep_rect that are neither selected nor edited """
+        kept = self.viewer.polygon_index.query_rect((keep_rect.left(), keep_rect.top(),
+                                                     keep_rect.right(), keep_rect.bottom()))
+        evicted = [id for id, polygon in self._loaded.items()
+                   if polygon not in kept and not polygon._selected and not self._is_edited(id, polygon)]
+        self.viewer.remove_selection_polygons([self._loaded[id] for id in evicted])
+        for id in evicted:
+            del self._loaded[id]
+            del self._originals[id]
+
+    def _forget_deleted(self):
+        """ Stops tracking polygons the user deleted, and remembers not to load them again """
+        deleted = [id for id, polygon in self._loaded.items() if polygon not in self.viewer.polygon_index]
+        for id in deleted:
+            del self._loaded[id]
+            del self._originals[id]
+            self._deleted.add(id)
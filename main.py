@@ -1,24 +1,28 @@
 import io
 import json
 import configparser
+import math
 import os
 
+import numpy as np
 from PIL.ImageQt import ImageQt, toqpixmap
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import Qt, QBuffer, QPointF, QRegExp, QCoreApplication
+from PyQt5.QtCore import Qt, QBuffer, QPointF, QRegExp
 from PyQt5.QtGui import QIntValidator, QImage, QPixmap, QRegExpValidator
 from PyQt5.QtWidgets import QSizePolicy, QLineEdit, QComboBox, QInputDialog, QMessageBox, QDialog, QProgressDialog
 
 from QPropertyLineEdit import QPropertyLineEdit
 from photoviewer import PhotoViewer
-from database import Database
+from database import Database, gravestone_rows
 import coordmap
 
-from ml import inference, image_cut
-import tensorflow as tf
+from detection_worker import DetectionWorker, ModelLoader
+from ml import detection_cache, detection_server, image_cut, inference, raster
 import PIL
 from PIL import Image
 
+from geometry_store import optional_value
+from headstone_loader import HeadstoneLoader
 from selection_polygon import SelectionPolygon
 
 # turns off max size on pil img loads
@@ -51,12 +55,25 @@ class Window(QtWidgets.QWidget):
 
         self.viewer = PhotoViewer(self)
         self.viewer.update_selected = self.selected_updated
+        self.viewer.region_selected = self.detect_gravestones_in_region
+        self.viewer.viewport_changed = self.viewport_changed
 
         self.image = None
-        # transform encoded as (A,D,B,E,C,F) http://webhelp.esri.com/arcims/9.3/General/topics/author_world_files.htm
+        # coordmap.WorldFileTransform of the image's world file, encoded as (A,D,B,E,C,F)
+        # http://webhelp.esri.com/arcims/9.3/General/topics/author_world_files.htm
         self.transform = None
         self.detect_fn = None
+        self.detection_worker = None
+        self.detection_progress = None
+        self.model_loader = None
+        self.detection_cache = None
+        if self.detection_cache_dir and self.detection_cache_size_mb > 0:
+            self.detection_cache = detection_cache.DetectionCache(self.detection_cache_dir,
+                                                                  int(self.detection_cache_size_mb * 1024 * 1024))
+        self._detected_polygons = []
         self.database_manager = None
+        # loads the imported table's headstones around the part of the image in view
+        self.headstone_loader = None
 
         # Set of buttons to disable, and enable after loading an image
         self.enable_on_load = []
@@ -76,6 +93,10 @@ class Window(QtWidgets.QWidget):
         for button in self.enable_on_load:
             button.setEnabled(False)
 
+        # TensorFlow is only imported once the model is needed, optionally load it in the background now
+        if self.preload_model:
+            self.preload_detection_model()
+
     def _read_config(self, filename: str) -> None:
         ''' Read config and set default values '''
         parser = configparser.ConfigParser()
@@ -88,10 +109,35 @@ class Window(QtWidgets.QWidget):
         # Discard boxes above this intersection over union threshold
         self.iou_threshold = float(settings.get('iou_threshold', "0.15"))
 
+        # Number of image crops run through the model per inference call
+        self.batch_size = int(settings.get('batch_size', "8"))
+
+        # How image crops are made, 'numpy' for array views or 'pil' for PIL crops
+        self.tiling_backend = settings.get('tiling_backend', 'numpy')
+
+        # How overlapping boxes are pruned, 'grid' for neighbouring boxes only or 'global' for TensorFlow's
+        self.nms_mode = settings.get('nms_mode', 'grid')
+
+        # Crops skipped before detection, flat crops below this standard deviation
+        # and crops with more than this fraction of padding
+        self.empty_crop_min_std = float(settings.get('empty_crop_min_std', "0"))
+        self.empty_crop_max_padding = float(settings.get('empty_crop_max_padding', "1"))
+
         # Saved model path to use
         # Should be a directory containing saved_model.pb
         self.saved_model_path = settings.get('saved_model_path', 'ml/final_trained_model/saved_model')
 
+        # Address of the local detection service, used instead of loading the model when it is running
+        self.detection_server = settings.get('detection_server', detection_server.DEFAULT_ADDRESS)
+
+        # Raw detections are cached in this directory, so detecting the same image again with other thresholds
+        # doesn't rerun the model. The least recently used detections are removed past the size limit, 0 disables
+        self.detection_cache_dir = settings.get('detection_cache_dir', 'detection_cache')
+        self.detection_cache_size_mb = float(settings.get('detection_cache_size_mb', "1024"))
+
+        # Load the detection model in the background at startup, instead of on the first detection
+        self.preload_model = settings.getboolean('preload_model', False)
+
     def _create_left_layout(self) -> None:
         ''' Build left layout '''
         self.vert_left_layout = QtWidgets.QVBoxLayout()
@@ -159,6 +205,15 @@ class Window(QtWidgets.QWidget):
         self.enable_on_load.append(self.detect_btn)
         self.vert_left_layout.addWidget(self.detect_btn)
 
+        # Detect in region button
+        self.detect_region_btn = QtWidgets.QPushButton(self)
+        self.detect_region_btn.setText('Detect in Region')
+        self.detect_region_btn.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+        self.detect_region_btn.setShortcut("g")
+        self.detect_region_btn.clicked.connect(self.enable_region_detection_mode)
+        self.enable_on_load.append(self.detect_region_btn)
+        self.vert_left_layout.addWidget(self.detect_region_btn)
+
     def _create_right_layout(self) -> None:
         ''' Build right layout '''
         self.vert_right_layout = QtWidgets.QVBoxLayout()
@@ -268,32 +323,30 @@ class Window(QtWidgets.QWidget):
             tfw_filename, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Open file', 'c:/',
                                                                     "Tfw files (*.tfw)")
         try:
-            tfw_file = open(tfw_filename, "r")
-            lines = tfw_file.readlines()
-            if len(lines) != 6:
-                raise Exception("tfw file has too many parameters")
-
-            self.transform = tuple([float(line) for line in lines])
-            print(self.transform)
+            self.transform = coordmap.WorldFileTransform.from_file(tfw_filename)
+            print(self.transform.parameters)
         except Exception:
             self.transform = None
             dlg = QDialog(self)
             dlg.setWindowTitle("Invalid tfw file")
             dlg.exec_()
 
-        # todo maybe fix loading it twice, i tried really hard to get it to only work once but all the methods i
-        # tried crashed mysteriously, even those in the pil library itself see toqpixmap()
-        self.image = Image.open(file_name)
-        pixmap = QtGui.QPixmap(file_name)
+        # Uncompressed TIFFs are memory-mapped and only read where they are tiled for detection or drawn by the viewer,
+        # other images are decoded once into an array shared by both
+        self.image = raster.open_raster(file_name)
+
+        # Detections of the previous image mustn't be drawn on this one
+        self._stop_detection()
 
         # Remove any present polygons before loading
         self.viewer.remove_all()
+        self.headstone_loader = None
 
         # Enable interface buttons
         for button in self.enable_on_load:
             button.setEnabled(True)
 
-        self.viewer.set_photo(pixmap)
+        self.viewer.set_photo(self.image)
 
     def open_db(self):
         file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Open file', '',
@@ -302,7 +355,10 @@ class Window(QtWidgets.QWidget):
         if file_name == '':
             return
 
+        if self.database_manager is not None:
+            self.database_manager.close()
         self.database_manager = Database(file_name)
+        self.headstone_loader = None
         self.db_filename_label.setText(os.path.basename(file_name))
         self.table_select.clear()
         self.table_select.addItems(self.database_manager.get_tables())
@@ -314,24 +370,34 @@ class Window(QtWidgets.QWidget):
             no_db_prompt.setWindowTitle("No database selected")
             no_db_prompt.exec()
             return
-        dataframe = self.database_manager.get_gravestones(self.table_select.currentText())
-        for _, row in dataframe.iterrows():
-            polygon_coords = [QPointF(row['toplx'], row['toply']),
-                              QPointF(row['toprx'], row['topry']),
-                              QPointF(row['botrx'], row['botry']),
-                              QPointF(row['botlx'], row['botly'])]
-            width, height = self.viewer.pixmap_width_and_height()
-            adjusted_polygon_points = [coordmap.pixel_map(point, *self.transform) for point in polygon_coords]
-            selection_polygon = SelectionPolygon(adjusted_polygon_points, self.viewer)
+        # Only the headstones around the view are loaded, more are loaded as it's panned and zoomed
+        self.headstone_loader = HeadstoneLoader(self.viewer, self.database_manager, self.table_select.currentText(),
+                                                self.transform)
+        self.headstone_loader.update(self.viewer.visible_scene_rect())
 
-            self.viewer.add_selection_polygon(selection_polygon)
+    def viewport_changed(self, visible_rect):
+        if self.headstone_loader is not None:
+            self.headstone_loader.update(visible_rect)
+
+    def load_all_headstones(self):
+        """ Loads the rest of the imported table, so exports include headstones that haven't been in view """
+        if self.headstone_loader is not None:
+            self.headstone_loader.load_all()
 
     def enable_box_creation_mode(self):
         if not self.viewer.has_photo():
             return
+        self.viewer.region_detection_mode = False
         self.viewer.box_creation_mode = True
         self.viewer.setDragMode(QtWidgets.QGraphicsView.NoDrag)
 
+    def enable_region_detection_mode(self):
+        if not self.viewer.has_photo():
+            return
+        self.viewer.box_creation_mode = False
+        self.viewer.region_detection_mode = True
+        self.viewer.setDragMode(QtWidgets.QGraphicsView.NoDrag)
+
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Delete:
             self.viewer.delete_selected()
@@ -372,6 +438,22 @@ class Window(QtWidgets.QWidget):
             if self.col_txtbox.text() != "" and self.col_txtbox.text() != "...":
                 polygon.col = int(self.col_txtbox.text())
 
+    def world_geometry(self, polygons):
+        """ Ids, rows, cols, corners and centroids of polygons as lists, with the corners and centroids mapped from
+            scene pixels to world coordinates. Read from the geometry store in one pass rather than polygon by
+            polygon """
+        geometry = self.viewer.geometry
+        slots = [polygon.slot for polygon in polygons]
+        records = geometry.records[slots]
+        corners = geometry.scene_corners(slots)
+        centroids = corners.mean(axis=1)
+
+        world_corners = self.transform.to_world(corners)
+        world_centroids = self.transform.to_world(centroids)
+        rows = [optional_value(row) for row in records['row']]
+        cols = [optional_value(col) for col in records['col']]
+        return records['id'].tolist(), rows, cols, world_corners.tolist(), world_centroids.tolist()
+
     def export_as_database(self):
         print("exporting..")
 
@@ -385,17 +467,10 @@ class Window(QtWidgets.QWidget):
             self.database_manager = Database(file_name)
             self.create_table_popup()
 
-        for polygon in self.viewer.selection_polygons:
-            width, height = self.viewer.pixmap_width_and_height()
-            centroid = coordmap.coordinate_map(polygon.centroid(), *self.transform)
-            adjusted_polygon_points = [coordmap.coordinate_map(point, *self.transform) for point in polygon.polygon_points]
-
-            self.database_manager.add_entry(self.table_select.currentText(), polygon.id, polygon.row, polygon.col,
-                                            toplx=adjusted_polygon_points[0].x(), toply=adjusted_polygon_points[0].y(),
-                                            toprx=adjusted_polygon_points[1].x(), topry=adjusted_polygon_points[1].y(),
-                                            botrx=adjusted_polygon_points[2].x(), botry=adjusted_polygon_points[2].y(),
-                                            botlx=adjusted_polygon_points[3].x(), botly=adjusted_polygon_points[3].y(),
-                                            centroidx=centroid.x(), centroidy=centroid.y())
+        self.load_all_headstones()
+        # Written in a single transaction
+        entries = gravestone_rows(*self.world_geometry(self.viewer.selection_polygons))
+        self.database_manager.add_entries(self.table_select.currentText(), entries)
         print("export complete")
 
     def export_as_geojson(self):
@@ -405,68 +480,163 @@ class Window(QtWidgets.QWidget):
         if file_name == '':
             return
 
+        self.load_all_headstones()
         geojson = {'type': 'FeatureCollection', 'name': self.table_select.currentText(), 'features': []}
-        for polygon in self.viewer.selection_polygons:
-            width, height = self.viewer.pixmap_width_and_height()
-            centroid = coordmap.coordinate_map(polygon.centroid(), *self.transform)
-            adjusted_polygon_points = [coordmap.coordinate_map(point, *self.transform) for point in polygon.polygon_points]
+        ids, rows, cols, corners, centroids = self.world_geometry(self.viewer.selection_polygons)
+        for id, row, col, points, centroid in zip(ids, rows, cols, corners, centroids):
             feature = {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'MultiPolygon', 'coordinates': []}}
-            feature['geometry']['coordinates'] = [[[
-                [adjusted_polygon_points[0].x(), adjusted_polygon_points[0].y()],
-                [adjusted_polygon_points[1].x(), adjusted_polygon_points[1].y()],
-                [adjusted_polygon_points[2].x(), adjusted_polygon_points[2].y()],
-                [adjusted_polygon_points[3].x(), adjusted_polygon_points[3].y()],
-                [adjusted_polygon_points[0].x(), adjusted_polygon_points[0].y()]]]]
-            feature['properties']['id'] = polygon.id
-            feature['properties']['row'] = polygon.row
-            feature['properties']['col'] = polygon.col
-            feature['properties']['centroid'] = [centroid.x(), centroid.y()]
+            feature['geometry']['coordinates'] = [[points + points[:1]]]
+            feature['properties']['id'] = id
+            feature['properties']['row'] = row
+            feature['properties']['col'] = col
+            feature['properties']['centroid'] = centroid
             geojson['features'].append(feature)
 
         with open(file_name, 'w') as output_file:
             json.dump(geojson, output_file, indent=2)
 
+    def preload_detection_model(self):
+        if self.detect_fn is not None or self.model_loader is not None:
+            return
+        self.model_loader = ModelLoader(self.saved_model_path, self.detection_server, parent=self)
+        self.model_loader.model_loaded.connect(self._model_preloaded)
+        self.model_loader.start()
+
+    def _model_preloaded(self, detect_fn):
+        if self.detect_fn is None:
+            self.detect_fn = detect_fn
+        self.model_loader = None
+
     def detect_gravestones(self):
-        # Open progress dialogue
-        progress = QProgressDialog("Loading detection model...", None, 0, 100)
-        progress.setWindowModality(Qt.WindowModal)
+        self._start_detection()
+
+    def detect_gravestones_in_region(self, rect):
+        """ Detect headstones in a rectangle of the image only, keeping the headstones already marked there """
+        width, height = image_cut.get_image_size(self.image)
+        rect = rect.intersected(QtCore.QRectF(0, 0, width, height))
+        left, top = int(rect.left()), int(rect.top())
+        right, bottom = int(math.ceil(rect.right())), int(math.ceil(rect.bottom()))
+        if right - left < 1 or bottom - top < 1:
+            return
+
+        # Normalized [y_min, x_min, y_max, x_max] bounds of the polygons touching the region
+        polygon_index = self.viewer.polygon_index
+        existing_boxes = [polygon_index.bounds(polygon) for polygon in
+                          polygon_index.query_rect((rect.left(), rect.top(), rect.right(), rect.bottom()))]
+        existing_boxes = np.array([[y0 / height, x0 / width, y1 / height, x1 / width]
+                                   for x0, y0, x1, y1 in existing_boxes], dtype=np.float64).reshape(-1, 4)
+
+        self._start_detection((left, top, right - left, bottom - top), existing_boxes)
+
+    def _start_detection(self, region=None, existing_boxes=None):
+        # Only one detection runs at a time
+        if self.detection_worker is not None and self.detection_worker.isRunning():
+            return
+
+        # Open progress dialogue, detection runs in the background so the editor stays usable
+        progress = QProgressDialog("Loading detection model...", "Cancel", 0, 100, self)
+        progress.setWindowModality(Qt.NonModal)
         progress.setAutoClose(True)
         progress.setMinimumDuration(1000)
         progress.setValue(0)
-        progress.show()
-
-        # Refresh GUI to display modal
-        QCoreApplication.processEvents()
-
-        if self.detect_fn is None:
-            try:
-                self.detect_fn = tf.saved_model.load(self.saved_model_path)
-            except ValueError:
-                print(f"Error loading saved model: {self.saved_model_path}")
-        print("Model loaded!")
-
-        width, height = self.image.size
-
-        # Update progress GUI
-        progress.setLabelText("Filtering input image...")
-
-        # Make the crops
-        image_cuts = image_cut.crop_image_with_padding((320, 320), 300, self.image)
-
-        # Run model on image crops
-        progress.setLabelText("Detecting headstones...")
-        detections = inference.detect_and_combine(self.detect_fn, image_cuts,
-                                                  (width, height), 300,
-                                                  self.confidence_threshold,
-                                                  self.iou_threshold, progress)
-
-        for box in detections['detection_boxes']:
-            polygon_coords = [QPointF(box[1] * width, box[0] * height),
-                              QPointF(box[1] * width, box[2] * height),
-                              QPointF(box[3] * width, box[2] * height),
-                              QPointF(box[3] * width, box[0] * height)]
+        self.detection_progress = progress
+
+        crop_filter = image_cut.EmptyCropFilter(self.empty_crop_min_std, self.empty_crop_max_padding)
+        worker = DetectionWorker(self.image, self.detect_fn, self.saved_model_path, self.confidence_threshold,
+                                 self.iou_threshold, self.batch_size, self.tiling_backend, self.nms_mode,
+                                 crop_filter, server_address=self.detection_server,
+                                 model_loader=self.model_loader, detection_cache=self.detection_cache,
+                                 region=region, existing_boxes=existing_boxes, parent=self)
+        worker.progress.connect(progress.setValue)
+        worker.status.connect(progress.setLabelText)
+        worker.model_loaded.connect(self._detection_model_loaded)
+        worker.batch_detected.connect(self._add_detected_batch)
+        worker.detection_finished.connect(self._finish_detection)
+        worker.detection_failed.connect(self._detection_failed)
+        progress.canceled.connect(worker.cancel)
+
+        # Polygons are added as batches finish, in the order the worker counts boxes
+        self._detected_polygons = []
+        self.detection_worker = worker
+        # Detected polygons are added to the current image and table, so neither can change until detection ends
+        self.open_db_btn.setEnabled(False)
+        self.import_btn.setEnabled(False)
+        worker.start()
+
+    def _stop_detection(self):
+        """ Cancels a running detection and discards its results, waiting for the worker to stop """
+        worker = self.detection_worker
+        if worker is None:
+            return
+        self.detection_worker = None
+        for signal in (worker.batch_detected, worker.detection_finished, worker.detection_failed):
+            signal.disconnect()
+        if worker.isRunning():
+            worker.cancel()
+            worker.wait()
+        self._end_detection()
+
+    def _end_detection(self):
+        self.detection_worker = None
+        self._detected_polygons = []
+        self.detection_progress.close()
+        self.open_db_btn.setEnabled(True)
+        self.import_btn.setEnabled(True)
+
+    def _detection_model_loaded(self, detect_fn):
+        self.detect_fn = detect_fn
+
+    def _add_detected_batch(self, detections):
+        # Signals queued by a detection that has since been stopped
+        if self.sender() is not self.detection_worker:
+            return
+        pixel_polygons = inference.boxes_to_pixel_polygons(detections['detection_boxes'],
+                                                           image_cut.get_image_size(self.image))
+        for corners in pixel_polygons:
+            polygon_coords = [QPointF(x, y) for x, y in corners]
             selection_polygon = SelectionPolygon(polygon_coords, self.viewer)
             self.viewer.add_selection_polygon(selection_polygon)
+            self._detected_polygons.append(selection_polygon)
+
+    def _finish_detection(self, kept_indices):
+        if self.sender() is not self.detection_worker:
+            return
+        # Remove the overlapping detections pruned by non max supression, except those already deleted while
+        # detection ran, whose geometry slots may have been given to newer polygons
+        remaining = set(self.viewer.selection_polygons)
+        kept = set(kept_indices.tolist())
+        pruned = [polygon for index, polygon in enumerate(self._detected_polygons)
+                  if index not in kept and polygon in remaining]
+        self.viewer.remove_selection_polygons(pruned)
+
+        # Number the remaining detections in order of confidence, skipping any deleted in the meantime. They
+        # share out the new ids they were created with, so none can clash with other polygons or the table
+        kept_polygons = [self._detected_polygons[index] for index in kept_indices
+                         if self._detected_polygons[index] in remaining]
+        for polygon, id in zip(kept_polygons, sorted(polygon.id for polygon in kept_polygons)):
+            polygon.id = id
+
+        self._end_detection()
+
+    def _detection_failed(self, message):
+        if self.sender() is not self.detection_worker:
+            return
+        # The detection service may have stopped, look for it again or load the model on the next run
+        if isinstance(self.detect_fn, detection_server.RemoteDetectFn):
+            self.detect_fn = None
+        self._end_detection()
+        error_prompt = QMessageBox()
+        error_prompt.setText(message)
+        error_prompt.setWindowTitle("Detection failed")
+        error_prompt.exec()
+
+    def closeEvent(self, event):
+        self._stop_detection()
+        if self.model_loader is not None:
+            self.model_loader.wait()
+        if self.database_manager is not None:
+            self.database_manager.close()
+        super(Window, self).closeEvent(event)
 
     def create_table_popup(self):
         if self.database_manager is None:
@@ -485,8 +655,7 @@ class Window(QtWidgets.QWidget):
     def rotate_selected(self):
         deg, ok = QInputDialog.getDouble(self, "Enter Rotation Amount", "Rotation in Degrees:")
         if ok and deg:
-            for polygon in self.viewer.selected_polygons:
-                polygon.rotate(deg)
+            self.viewer.rotate_polygons(self.viewer.selected_polygons, deg)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+""" On-disk cache of the raw detections of whole images, so changing thresholds doesn't rerun the model """
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from ml import image_cut, inference, raster
+
+# Bumped whenever the stored detections change meaning, so old entries are never used
+CACHE_VERSION = 1
+
+
+def image_hash(image) -> str:
+    """ Content hash of a raster, image array or PIL image """
+    return raster.as_raster(image).content_hash()
+
+
+def model_fingerprint(saved_model_path: str) -> str:
+    """ Hash of the saved model graph and variable index, which change whenever the model is retrained or
+        exported again. Falls back to the path when the model isn't on this machine """
+    digest = hashlib.blake2b(digest_size=20)
+    found = False
+    for name in ('saved_model.pb', os.path.join('variables', 'variables.index')):
+        file_name = os.path.join(saved_model_path, name)
+        if os.path.exists(file_name):
+            found = True
+            with open(file_name, 'rb') as model_file:
+                for chunk in iter(lambda: model_file.read(1 << 20), b''):
+                    digest.update(chunk)
+    if not found:
+        digest.update(os.path.abspath(saved_model_path).encode())
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    """ Least recently used cache of raw detections, before the confidence threshold and non max supression,
+        stored as one .npz file per image, model and tiling. Detections scoring below min_score aren't stored,
+        so runs with a lower confidence threshold bypass the cache """
+
+    def __init__(self, directory: str, max_bytes: int, min_score: float = 0.05):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_score = min_score
+
+    def covers(self, confidence_threshold: float) -> bool:
+        """ Whether cached detections hold every box above this threshold """
+        return confidence_threshold >= self.min_score
+
+    def key(self, image, saved_model_path: str, crop_size: tuple, stride: int,
+            crop_filter: image_cut.EmptyCropFilter = None) -> str:
+        """ Cache key of the detections of an image, from its pixels, the model and everything affecting tiling """
+        filter_settings = None
+        if crop_filter is not None:
+            filter_settings = [crop_filter.min_std, crop_filter.max_padding, crop_filter.sample_step]
+        parts = [CACHE_VERSION, image_hash(image), model_fingerprint(saved_model_path),
+                 list(crop_size), stride, filter_settings, self.min_score]
+        return hashlib.blake2b(json.dumps(parts).encode(), digest_size=20).hexdigest()
+
+    def lookup(self, image, saved_model_path: str, crop_size: tuple, stride: int,
+               crop_filter: image_cut.EmptyCropFilter, confidence_threshold: float) -> tuple:
+        """ Returns (key, detections), the cached detections of an image above the confidence threshold, or None
+            if they haven't been cached yet. The key is None when the threshold is too low for the cache """
+        if not self.covers(confidence_threshold):
+            return None, None
+        key = self.key(image, saved_model_path, crop_size, stride, crop_filter)
+        cached = self.load(key)
+        if cached is None:
+            return key, None
+        print("Using cached detections")
+        return key, inference.filter_detections(cached, confidence_threshold)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def load(self, key: str):
+        """ Returns the cached detections dictionary, or None """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                detections = {name: cached[name] for name in cached.files}
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return detections
+
+    def save(self, key: str, detections: dict) -> None:
+        """ Store detections, then evict the least recently used entries over the size cap """
+        os.makedirs(self.directory, exist_ok=True)
+        # Written under a temporary name, so a partial file is never loaded
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                np.savez(temp_file, **detections)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            print(f"Could not save detections to the cache: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """ Remove the least recently used entries until the cache fits in max_bytes """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Another process evicted it first
+                pass
+            total -= size
+
+
+def iter_cached_detections(cache: DetectionCache, key: str, detect_fn, crops, full_img_size: tuple, stride: int,
+                           confidence_threshold: float, batch_size: int = 1,
+                           crop_filter: image_cut.EmptyCropFilter = None):
+    """ inference.iter_batch_detections, keeping the raw detections above the cache's min_score and saving them
+        under key once every crop is done. Batches are yielded above the confidence threshold as usual, closing
+        the generator to cancel leaves the cache untouched. Without a cache or key nothing is saved """
+    if cache is None or key is None:
+        yield from inference.iter_batch_detections(detect_fn, crops, full_img_size, stride, confidence_threshold,
+                                                   batch_size, crop_filter)
+        return
+
+    raw_detections = inference.DetectionAccumulator()
+    batches = inference.iter_batch_detections(detect_fn, crops, full_img_size, stride, cache.min_score,
+                                              batch_size, crop_filter)
+    try:
+        for done, detections, flag in batches:
+            if flag:
+                raw_detections.append(detections)
+                detections = inference.filter_detections(detections, confidence_threshold)
+                flag = len(detections['detection_scores']) > 0
+            yield done, detections, flag
+    finally:
+        batches.close()
+
+    # Only complete runs are cached
+    cache.save(key, raw_detections.finalize())
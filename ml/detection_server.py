@@ -0,0 +1,208 @@
+''' Local detection service that keeps the detection model loaded and warmed up between editor sessions
+
+    Usage: python -m ml.detection_server [--model SAVED_MODEL_DIRECTORY] [--address 127.0.0.1:8765]
+
+    The editor and batch_detect.py send batches of crops to the service when it is running, and load
+    the model themselves when it isn't. Crops are sent as a .npy uint8 array in a POST to /detect, and
+    the model outputs come back as a .npz archive. GET /ping returns the loaded model path.
+'''
+
+import argparse
+import configparser
+import http.client
+import io
+import ipaddress
+import json
+import os
+import socket
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import numpy as np
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+def parse_address(address: str) -> tuple:
+    ''' Split 'host:port' into (host, port) '''
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def is_loopback(host: str) -> bool:
+    ''' True if the host name or address only reaches this machine '''
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        pass
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class RemoteDetectFn:
+    ''' Drop-in replacement for a loaded detect_fn that runs batches on the detection service '''
+
+    # Batches are sent as arrays, so callers don't need TensorFlow to make tensors
+    accepts_numpy = True
+
+    def __init__(self, address: str, timeout: float = 600.0):
+        self.address = address
+        self.timeout = timeout
+        self._connection = None
+
+    def _request(self, method: str, path: str, body: bytes = None) -> bytes:
+        # Keep the connection open between batches, reconnecting once if the service closed it
+        for attempt in range(2):
+            if self._connection is None:
+                host, port = parse_address(self.address)
+                self._connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            try:
+                self._connection.request(method, path, body=body)
+                response = self._connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt == 1:
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError(f'Detection service error {response.status}: {data.decode(errors="replace")}')
+            return data
+
+    def ping(self) -> dict:
+        return json.loads(self._request('GET', '/ping').decode())
+
+    def __call__(self, input_tensor) -> dict:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(input_tensor, dtype=np.uint8), allow_pickle=False)
+        outputs = np.load(io.BytesIO(self._request('POST', '/detect', buffer.getvalue())), allow_pickle=False)
+        return {key: outputs[key] for key in outputs.files}
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def connect(address: str, saved_model_path: str = None, timeout: float = 0.5):
+    ''' Returns a RemoteDetectFn if the service is running, with the same model if one is given, otherwise None '''
+    if not address:
+        return None
+    probe = RemoteDetectFn(address, timeout)
+    try:
+        info = probe.ping()
+    except (OSError, http.client.HTTPException, RuntimeError, ValueError):
+        return None
+    finally:
+        probe.close()
+    if saved_model_path is not None and os.path.abspath(info['model']) != os.path.abspath(saved_model_path):
+        print(f"Detection service at {address} has a different model loaded: {info['model']}")
+        return None
+    return RemoteDetectFn(address)
+
+
+def get_detect_fn(saved_model_path: str, address: str = None, threads: int = None) -> Callable:
+    ''' Use the detection service when it is running, otherwise load the model in this process,
+        with TensorFlow limited to the given number of threads per operation '''
+    remote = connect(address, saved_model_path)
+    if remote is not None:
+        print(f"Using detection service at {address}")
+        return remote
+
+    import tensorflow as tf
+    if threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    return tf.saved_model.load(saved_model_path)
+
+
+def warm_up(detect_fn: Callable, batch_sizes: tuple, crop_size: tuple = (320, 320)) -> None:
+    ''' Run the model once for each batch size, so the service never pays for graph tracing on a real request '''
+    from ml import inference
+    import tensorflow as tf
+
+    for batch_size in batch_sizes:
+        blank = tf.zeros((batch_size, crop_size[1], crop_size[0], 3), dtype=tf.uint8)
+        inference.run_detect_fn(detect_fn, blank)
+
+
+def make_handler(detect_fn: Callable, saved_model_path: str):
+    ''' Request handler class serving the given detect_fn '''
+    from ml import inference
+    import tensorflow as tf
+
+    class DetectionHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/ping':
+                self._send(404, b'Not found', 'text/plain')
+                return
+            self._send(200, json.dumps({'model': saved_model_path}).encode(), 'application/json')
+
+        def do_POST(self):
+            if self.path != '/detect':
+                self._send(404, b'Not found', 'text/plain')
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                batch = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+                detections = inference.run_detect_fn(detect_fn, tf.convert_to_tensor(batch, dtype=tf.uint8))
+                buffer = io.BytesIO()
+                np.savez(buffer, **{key: np.asarray(value) for key, value in detections.items()})
+            except Exception as e:
+                self._send(500, str(e).encode(), 'text/plain')
+                return
+            self._send(200, buffer.getvalue(), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            # Batches arrive many times a second, don't log each one
+            pass
+
+    return DetectionHandler
+
+
+def main():
+    parser = configparser.ConfigParser()
+    parser.read('./config.ini')
+    settings = parser['DEFAULT']
+
+    arg_parser = argparse.ArgumentParser(description='Keep the detection model loaded for the editor and CLI.')
+    arg_parser.add_argument('--model', default=settings.get('saved_model_path', 'ml/final_trained_model/saved_model'))
+    arg_parser.add_argument('--address', default=settings.get('detection_server', DEFAULT_ADDRESS) or DEFAULT_ADDRESS)
+    args = arg_parser.parse_args()
+
+    # The service has no authentication, so only accept connections from this machine
+    host, port = parse_address(args.address)
+    if not is_loopback(host):
+        arg_parser.error(f'{host} is not a loopback address, the service can only be run on this machine')
+
+    import tensorflow as tf
+
+    print(f'Loading model from {args.model} ...')
+    start = time.perf_counter()
+    detect_fn = tf.saved_model.load(args.model)
+    warm_up(detect_fn, (1, int(settings.get('batch_size', "8"))))
+    print(f'Model loaded and warmed up in {time.perf_counter() - start:.1f}s')
+
+    server = ThreadingHTTPServer((host, port), make_handler(detect_fn, args.model))
+    print(f'Serving detections on {host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 """ Cuts input image with padding and stride """
 
+import math
 import os
+import queue
 import sys
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from PIL import Image
 
+from ml import raster
+
 
 def single_crop(image: Image, top: int, left: int, right: int,
                 bottom: int) -> Image:
@@ -23,39 +30,266 @@ def single_crop(image: Image, top: int, left: int, right: int,
     return cropped_image
 
 
-def crop_image_with_padding(desired_size: tuple, stride: int,
-                            image: Image) -> list:
-    """ Returns 2D list of PIL images, cropped, with stride, adding padding as necessary """
-    image_list = []
+def get_image_size(image) -> tuple:
+    """ Returns (width, height) of a PIL image, raster or image array """
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
 
-    # Non-RGB modes may not save as JPG, which our model requires
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
 
-    # Get image dimensions
-    width, height = image.size
+def crop_grid_shape(desired_size: tuple, stride: int, image_size: tuple) -> tuple:
+    """ Returns the (rows, cols) of the crop grid produced for an image of the given size """
+    width, height = image_size
+    return math.ceil(height / stride), math.ceil(width / stride)
+
 
-    # Initialize cropping coordinates
-    i       = 0
-    top     = 0
-    left    = 0
-    right   = desired_size[0]
-    bottom  = desired_size[1]
-
-    # Make crops
-    while top < height:
-        row = []
-        while left < width:
-            i += 1
+def _iter_crops(desired_size: tuple, stride: int, image: Image):
+    """ Yields (row, col, crop) in row-major order, one crop at a time """
+    rows, cols = crop_grid_shape(desired_size, stride, image.size)
+    for row in range(rows):
+        top = row * stride
+        bottom = top + desired_size[1]
+        for col in range(cols):
+            left = col * stride
+            right = left + desired_size[0]
             cropped_image = single_crop(image, top, left, right, bottom)
-            row.append(cropped_image)
-            right += stride
-            left  += stride
-        image_list.append(row)
-        left    = 0
-        right   = desired_size[0]
-        top     += stride
-        bottom  += stride
+
+            # Non-RGB modes may not save as JPG, which our model requires.
+            # Converting per crop avoids holding a converted copy of the whole image
+            if cropped_image.mode != 'RGB':
+                cropped_image = cropped_image.convert('RGB')
+            yield row, col, cropped_image
+
+
+def _iter_raster_crops(desired_size: tuple, stride: int, image: raster.Raster):
+    """ Yields (row, col, crop) in row-major order, reading one padded band of rows at a time """
+    rows, cols = crop_grid_shape(desired_size, stride, image.size)
+    padded_width = (cols - 1) * stride + desired_size[0]
+    for row in range(rows):
+        band = image.read_window(0, row * stride, padded_width, desired_size[1])
+        for col in range(cols):
+            left = col * stride
+            yield row, col, band[:, left:left + desired_size[0]]
+
+
+def image_to_array(image, strip_height: int = 1024) -> np.ndarray:
+    """ Returns an RGB uint8 array of the image. A PIL image is copied into the array a strip at a time, so
+        besides the array itself only strip-sized copies are made when cropping and converting it. Arrays are
+        passed through without copying where possible """
+    if isinstance(image, np.ndarray):
+        if image.ndim == 2:
+            return np.repeat(image[:, :, np.newaxis], 3, axis=2)
+        # Drop any alpha channel with a view
+        return image[:, :, :3]
+
+    width, height = image.size
+    array = np.empty((height, width, 3), dtype=np.uint8)
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        strip = image.crop((0, top, width, bottom))
+        if strip.mode != 'RGB':
+            strip = strip.convert('RGB')
+        array[top:bottom] = np.asarray(strip)
+    return array
+
+
+def load_image_array(file_name: str) -> np.ndarray:
+    """ Decodes an image file once into an RGB uint8 array, releasing the decoded PIL image afterwards """
+    with Image.open(file_name) as image:
+        return image_to_array(image)
+
+
+def _strided_grid(region: np.ndarray, rows: int, cols: int, desired_size: tuple,
+                  stride: int) -> np.ndarray:
+    """ Returns a (rows, cols, crop_height, crop_width, channels) view of the crops in region """
+    row_stride, col_stride, channel_stride = region.strides
+    return as_strided(region,
+                      shape=(rows, cols, desired_size[1], desired_size[0], region.shape[2]),
+                      strides=(row_stride * stride, col_stride * stride,
+                               row_stride, col_stride, channel_stride),
+                      writeable=False)
+
+
+class ArrayTiler:
+    """ Produces crops as views into an image array. Crops that fit inside the image are strided views
+        of the array itself, only the right and bottom borders are copied, once, into padded strips """
+
+    def __init__(self, array: np.ndarray, desired_size: tuple, stride: int):
+        crop_width, crop_height = desired_size
+        height, width = array.shape[:2]
+        self.stride = stride
+        self.rows, self.cols = crop_grid_shape(desired_size, stride, (width, height))
+
+        # Number of leading rows and cols whose crops need no padding
+        self.inner_rows = min(self.rows, (height - crop_height) // stride + 1) if height >= crop_height else 0
+        self.inner_cols = min(self.cols, (width - crop_width) // stride + 1) if width >= crop_width else 0
+
+        # Size of the image once padded to hold every crop
+        padded_height = (self.rows - 1) * stride + crop_height
+        padded_width = (self.cols - 1) * stride + crop_width
+
+        self.inner = _strided_grid(array, self.inner_rows, self.inner_cols, desired_size, stride)
+
+        # Padded strip beside the inner crops
+        right_top = 0
+        right_bottom = (self.inner_rows - 1) * stride + crop_height if self.inner_rows else 0
+        right_left = self.inner_cols * stride
+        right = np.zeros((right_bottom, max(0, padded_width - right_left), 3), dtype=array.dtype)
+        right_width = max(0, min(width, padded_width) - right_left)
+        right[:, :right_width] = array[right_top:right_bottom, right_left:right_left + right_width]
+        self.right = _strided_grid(right, self.inner_rows, self.cols - self.inner_cols, desired_size, stride)
+
+        # Padded strip below the inner crops, spanning the full padded width
+        bottom_top = self.inner_rows * stride
+        bottom = np.zeros((max(0, padded_height - bottom_top), padded_width, 3), dtype=array.dtype)
+        bottom_height = max(0, min(height, padded_height) - bottom_top)
+        bottom_width = min(width, padded_width)
+        bottom[:bottom_height, :bottom_width] = array[bottom_top:bottom_top + bottom_height, :bottom_width]
+        self.bottom = _strided_grid(bottom, self.rows - self.inner_rows, self.cols, desired_size, stride)
+
+    def crop(self, row: int, col: int) -> np.ndarray:
+        """ Returns the crop at (row, col) as a read-only view """
+        if row >= self.inner_rows:
+            return self.bottom[row - self.inner_rows, col]
+        if col >= self.inner_cols:
+            return self.right[row, col - self.inner_cols]
+        return self.inner[row, col]
+
+    def __iter__(self):
+        for row in range(self.rows):
+            for col in range(self.cols):
+                yield row, col, self.crop(row, col)
+
+
+def iter_crops_with_padding(desired_size: tuple, stride: int, image,
+                            prefetch: int = 0, backend: str = 'pil'):
+    """ Lazily yields (row, col, crop) tuples, cropped with stride and padding as necessary.
+        With prefetch > 0, crops are made ahead on a background thread into a queue holding at most
+        prefetch crops, so at most that many crops exist beyond the ones the consumer holds.
+        The 'numpy' backend (always used for arrays) yields array views instead of PIL images.
+        Rasters are read a band of crops at a time, or viewed like arrays when they can be """
+    if isinstance(image, raster.Raster) and image.as_array() is not None:
+        image = image.as_array()
+    if isinstance(image, np.ndarray) or (backend == 'numpy' and not isinstance(image, raster.Raster)):
+        # Views cost nothing to make, so there is nothing to prefetch
+        yield from ArrayTiler(image_to_array(image), desired_size, stride)
+        return
+
+    make_crops = _iter_raster_crops if isinstance(image, raster.Raster) else _iter_crops
+
+    if prefetch < 1:
+        yield from make_crops(desired_size, stride, image)
+        return
+
+    crop_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    end_of_crops = object()
+
+    def put(item) -> bool:
+        # Wake up periodically so an abandoned generator doesn't leave this thread blocked
+        while not stop.is_set():
+            try:
+                crop_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in make_crops(desired_size, stride, image):
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(end_of_crops)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = crop_queue.get()
+            if item is end_of_crops:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def crop_padding(row: int, col: int, desired_size: tuple, stride: int, image_size: tuple) -> tuple:
+    """ Returns ((width, height), covered) for a crop of the grid: the size of the part of it inside the image, the
+        rest being padding, and whether all of that part also lies in the crop before it in its row or column """
+    (crop_width, crop_height), (image_width, image_height) = desired_size, image_size
+    width = max(0, min(crop_width, image_width - col * stride))
+    height = max(0, min(crop_height, image_height - row * stride))
+    covered = (col > 0 and width <= crop_width - stride) or (row > 0 and height <= crop_height - stride)
+    return (width, height), covered
+
+
+class EmptyCropFilter:
+    """ Pre-inference filter that skips crops which can't contain headstones: crops that are
+        mostly padding past the image edge, and flat crops such as water or roads whose pixels barely vary.
+        Counts the crops it sees and skips so the thresholds can be tuned """
+
+    def __init__(self, min_std: float = 0.0, max_padding: float = 1.0, sample_step: int = 4):
+        # Crops whose pixels inside the image have a standard deviation below this are skipped, 0 disables
+        self.min_std = min_std
+        # Crops with more than this fraction past the image edge are skipped, if what is inside the image is also in
+        # a neighbouring crop. Padding is worked out from the crop's position, black pixels are never counted, 1
+        # disables
+        self.max_padding = max_padding
+        # Only every sample_step-th pixel in each direction is tested
+        self.sample_step = max(1, sample_step)
+
+        self.seen = 0
+        self.skipped = 0
+
+    def is_empty(self, crop, inside_size: tuple = None, covered: bool = False) -> bool:
+        """ Returns True if the crop should be skipped. inside_size is the (width, height) of the part of the crop
+            inside the image, all of it when not given, and covered whether that part is also in another crop """
+        crop = np.asarray(crop)
+        crop_height, crop_width = crop.shape[:2]
+        width, height = inside_size if inside_size is not None else (crop_width, crop_height)
+        if covered and 1 - (width * height) / float(crop_width * crop_height) > self.max_padding:
+            return True
+        if self.min_std > 0:
+            pixels = crop[:height:self.sample_step, :width:self.sample_step]
+            return pixels.size == 0 or pixels.std() < self.min_std
+        return False
+
+    def filter(self, crops, stride: int = None, image_size: tuple = None):
+        """ Yields the (row, col, crop) tuples of crops that aren't empty. Given the stride and the (width, height)
+            of the tiled image, crops past its edges are told apart from padding, otherwise crops have none """
+        try:
+            for row, col, crop in crops:
+                self.seen += 1
+                inside_size, covered = None, False
+                if stride is not None and image_size is not None:
+                    inside_size, covered = crop_padding(row, col, get_image_size(crop), stride, image_size)
+                if self.is_empty(crop, inside_size, covered):
+                    self.skipped += 1
+                    continue
+                yield row, col, crop
+        finally:
+            # Stop any background cropping along with this generator
+            if hasattr(crops, 'close'):
+                crops.close()
+
+    def report(self) -> str:
+        return f'Skipped {self.skipped} of {self.seen} crops as empty'
+
+
+def crop_image_with_padding(desired_size: tuple, stride: int,
+                            image: Image) -> list:
+    """ Returns 2D list of PIL images, cropped, with stride, adding padding as necessary """
+    image_list = []
+    for row, col, cropped_image in iter_crops_with_padding(desired_size, stride, image):
+        if col == 0:
+            image_list.append([])
+        image_list[row].append(cropped_image)
 
     return image_list
 
@@ -1,22 +1,27 @@
 """ Runs inference on a list of images from saved_model and scales the bounding boxes """
 
-from PIL.ImageQt import ImageQt, toqpixmap
-from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import Qt, QBuffer, QPointF, QRegExp, QCoreApplication
-from PyQt5.QtGui import QIntValidator, QImage, QPixmap, QRegExpValidator
-from PyQt5.QtWidgets import QSizePolicy, QLineEdit, QComboBox, QInputDialog, QMessageBox, QDialog, QProgressDialog
-
 import sys
 import os
 import math
 # os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
-import tensorflow as tf
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
-from typing import Callable
-from object_detection.utils import visualization_utils as viz_utils
-from functools import reduce
+from typing import Callable, Iterable
+from itertools import islice
+
+from ml import image_cut, nms
+
+
+def load_tensorflow():
+    ''' Imports TensorFlow on first use, it takes seconds and isn't needed until detection runs '''
+    import tensorflow as tf
+    return tf
+
+
+def accepts_numpy(detect_fn: Callable) -> bool:
+    ''' Whether detect_fn takes and returns NumPy arrays rather than tensors, as the detection service does,
+        so running it doesn't need TensorFlow in this process '''
+    return getattr(detect_fn, 'accepts_numpy', False)
 
 
 def scale_box_dims(box_dims: np.ndarray, full_size: tuple, stride: int,
@@ -49,149 +54,277 @@ def scale_single_dim(pos: int, full: int, crop: int, stride: int,
     return pos * scale + offset
 
 
+def scale_boxes(boxes: np.ndarray, indices: np.ndarray, full_size: tuple,
+                stride: int, crop_size: tuple) -> np.ndarray:
+    ''' Scale an (N, 4) array of boxes from their crops to the original image,
+        indices holds the (row, col) of the crop each box came from '''
+    (full_width, full_height) = full_size
+    (crop_width, crop_height) = crop_size
+    full_dims = np.array([full_height, full_width, full_height, full_width],
+                         dtype=np.float64)
+    scale = np.array([crop_height, crop_width, crop_height, crop_width]) / full_dims
+    # Per-box offsets as [y, x, y, x], from the crop's (row, col) index
+    offsets = indices[:, [0, 1, 0, 1]] * stride / full_dims
+    return boxes * scale + offsets
+
+
+def boxes_to_pixel_polygons(boxes: np.ndarray, full_size: tuple) -> np.ndarray:
+    ''' Convert an (N, 4) array of normalized [y_min, x_min, y_max, x_max] boxes into an (N, 4, 2)
+        array of (x, y) pixel corners, in the order the editor draws them '''
+    (full_width, full_height) = full_size
+    y_min = boxes[:, 0] * full_height
+    x_min = boxes[:, 1] * full_width
+    y_max = boxes[:, 2] * full_height
+    x_max = boxes[:, 3] * full_width
+    return np.stack((np.stack((x_min, y_min), axis=1),
+                     np.stack((x_min, y_max), axis=1),
+                     np.stack((x_max, y_max), axis=1),
+                     np.stack((x_max, y_min), axis=1)), axis=1)
+
+
+def region_boxes_to_image(boxes: np.ndarray, region: tuple, full_size: tuple) -> np.ndarray:
+    ''' Maps [y_min, x_min, y_max, x_max] boxes normalized to a (left, top, width, height) region of the image
+        to boxes normalized to the full image '''
+    left, top, width, height = region
+    full_width, full_height = full_size
+    scale = np.array([height / full_height, width / full_width] * 2)
+    offset = np.array([top / full_height, left / full_width] * 2)
+    return np.asarray(boxes) * scale + offset
+
+
 def find_scaled_boxes_from_crop(crop_image: Image, index: tuple,
                                 full_img_dims: tuple, stride: int,
                                 detect_fn: Callable,
                                 score_threshold: float) -> tuple:
     ''' Runs inference on a single image crop, returns detections dictionary with scaled boxes '''
+    return find_scaled_boxes_from_batch([crop_image], [index], full_img_dims,
+                                        stride, detect_fn, score_threshold)
 
-    # Get dimensions of crop for scaling
-    crop_width, crop_height = crop_image.size
-    full_width = full_img_dims[0]
-    full_height = full_img_dims[1]
 
-    # Convert image to tensor with the correct shape
-    crop_image_np = np.array(crop_image)
-    crop_image_tensor = tf.convert_to_tensor(crop_image_np)
-    input_tensor = tf.convert_to_tensor(np.expand_dims(crop_image_np, 0),
-                                        dtype=tf.uint8)
-
-    # Run inference
-    detections = detect_fn(input_tensor)
-
-    # Remove batch dimension and find number of detections
-    num_detections = int(detections.pop('num_detections'))
-    detections = {
-        key: value[0, :num_detections].numpy()
-        for key, value in detections.items()
-    }
-    detections['num_detections'] = num_detections
+def find_scaled_boxes_from_batch(crop_images: list, indices: list,
+                                 full_img_dims: tuple, stride: int,
+                                 detect_fn: Callable,
+                                 score_threshold: float) -> tuple:
+    ''' Runs inference on a batch of equally sized crops with a single detect_fn call,
+        returns one detections dictionary with scaled boxes for the whole batch,
+        and a flag for whether it holds any boxes '''
 
-    # Convert detection classes to ints
-    detections['detection_classes'] = detections['detection_classes'].astype(
-        np.int64)
+    # Crops may be PIL images or array views, asarray leaves views uncopied
+    crop_arrays = [np.asarray(crop_image) for crop_image in crop_images]
 
-    # Discard low-scoring boxes
-    indices_to_gather = [
-        index for index, val in enumerate(detections['detection_scores'])
-        if val >= score_threshold
-    ]
+    # Get dimensions of crops for scaling, all crops in a batch share a size
+    crop_height, crop_width = crop_arrays[0].shape[:2]
 
-    # tf.gather() will throw an exception for an empty indices tensor,
-    # so return what we have and flag it in this instance
-    if len(indices_to_gather) < 1:
-        return detections, False
+    # Stack crops into a single batch with the correct shape,
+    # this is the only copy made of array crops
+    batch_np = np.stack(crop_arrays)
+    if accepts_numpy(detect_fn):
+        input_batch = batch_np
+    else:
+        tf = load_tensorflow()
+        input_batch = tf.convert_to_tensor(batch_np, dtype=tf.uint8)
 
-    detections['detection_scores'] = tf.gather(
-        detections['detection_scores'],
-        tf.convert_to_tensor(indices_to_gather))
-    detections['detection_boxes'] = tf.gather(detections['detection_boxes'],
-                                              indices_to_gather)
-    detections['detection_classes'] = tf.gather(
-        detections['detection_classes'], indices_to_gather)
-
-    # Scale detection boxes
-    detections['detection_boxes'] = np.array([
-        scale_box_dims(box_dims, full_img_dims, stride,
-                       (crop_width, crop_height), index)
-        for box_dims in detections['detection_boxes']
-    ])
+    # Run inference
+    batch_detections = run_detect_fn(detect_fn, input_batch)
+
+    detections = scale_batch_detections(batch_detections, indices,
+                                        full_img_dims, stride,
+                                        (crop_width, crop_height))
+    detections = filter_detections(detections, score_threshold)
+
+    return detections, len(detections['detection_scores']) > 0
+
+
+def run_detect_fn(detect_fn: Callable, input_tensor) -> dict:
+    ''' Runs detect_fn on a batch, falling back to one call per crop for
+        models exported with a fixed batch size of 1 '''
+    if input_tensor.shape[0] == 1:
+        return detect_fn(input_tensor)
+    try:
+        return detect_fn(input_tensor)
+    except ValueError:
+        # The input signature rejected the batch dimension
+        single_detections = [
+            detect_fn(input_tensor[i:i + 1])
+            for i in range(input_tensor.shape[0])
+        ]
+        concat = np.concatenate if accepts_numpy(detect_fn) else load_tensorflow().concat
+        return {
+            key: concat([d[key] for d in single_detections], axis=0)
+            for key in single_detections[0]
+        }
+
+
+def scale_batch_detections(batch_detections: dict, indices: list,
+                           full_img_dims: tuple, stride: int,
+                           crop_size: tuple) -> dict:
+    ''' Flattens the model outputs for a batch of crops into a single detections
+        dictionary, with every box scaled to the full image in one expression '''
+    boxes = np.asarray(batch_detections['detection_boxes'])
+    scores = np.asarray(batch_detections['detection_scores'])
+    classes = np.asarray(batch_detections['detection_classes'])
+    num_detections = np.asarray(batch_detections['num_detections']).astype(np.int64)
+
+    # Outputs are padded to a fixed number of boxes per crop, keep only the real ones
+    valid = np.arange(scores.shape[1]) < num_detections[:, np.newaxis]
+    crop_of_box = np.nonzero(valid)[0]
+    box_indices = np.asarray(indices, dtype=np.int64).reshape(-1, 2)[crop_of_box]
 
-    return detections, True
+    return {
+        'detection_boxes': scale_boxes(boxes[valid], box_indices,
+                                       full_img_dims, stride, crop_size),
+        'detection_scores': scores[valid],
+        'detection_classes': classes[valid].astype(np.int64),
+        'detection_indices': box_indices
+    }
 
 
-def detect_and_combine(detect_fn: Callable, image_cuts: list,
+def filter_detections(detections: dict, score_threshold: float) -> dict:
+    ''' Discards low-scoring boxes with a boolean mask '''
+    keep = detections['detection_scores'] >= score_threshold
+    return {key: value[keep] for key, value in detections.items()}
+
+
+def iter_batch_detections(detect_fn: Callable, crops: Iterable,
+                          full_img_size: tuple, stride: int,
+                          score_threshold: float,
+                          batch_size: int = 1,
+                          crop_filter: image_cut.EmptyCropFilter = None):
+    ''' Runs detections on (row, col, crop) tuples as they are produced, pulling one batch of crops
+        at a time. Yields (crops_seen, detections, flag) after each batch, stop iterating to cancel '''
+    crops = iter(crops)
+    if crop_filter is not None:
+        # Drop empty crops before they reach the model
+        crops = crop_filter.filter(crops, stride, full_img_size)
+    batch_size = max(1, batch_size)
+    done = 0
+    try:
+        while True:
+            batch = list(islice(crops, batch_size))
+            if not batch:
+                break
+            indices = [(row, col) for row, col, _ in batch]
+            print(f'Running on cuts {indices[0]} to {indices[-1]}...')
+            d, flag = find_scaled_boxes_from_batch([crop for _, _, crop in batch],
+                                                   indices, full_img_size, stride,
+                                                   detect_fn, score_threshold)
+            del batch
+            done = crop_filter.seen if crop_filter is not None else done + len(indices)
+            yield done, d, flag
+    finally:
+        # Stop any background cropping early if detection was cancelled
+        if hasattr(crops, 'close'):
+            crops.close()
+        if crop_filter is not None:
+            print(crop_filter.report())
+
+
+def detect_and_combine(detect_fn: Callable, crops: Iterable,
                        full_img_size: tuple, stride: int,
                        score_threshold: float,
                        iou_threshold: float, 
-                       progress_dialog: QProgressDialog) -> dict:
-    ''' Run detections on all image cuts, combine the results into a single dict '''
-    # This can be hardcoded, since we are only concerned with a single class
-    category_index = {0: 1}
-
-    # Open progress dialogue
-    # progress = QProgressDialog("Detecting headstones...", None, 0, 100)
-    # progress.setWindowModality(Qt.WindowModal)
-    # progress.setAutoClose(True)
-    # progress.setMinimumDuration(1000)
-    # progress.setValue(0)
-    
-    # Dialog isn't appearing without this
-    QCoreApplication.processEvents()
-
+                       progress_callback: Callable = None,
+                       batch_size: int = 1,
+                       num_crops: int = None,
+                       nms_mode: str = 'global',
+                       crop_filter: image_cut.EmptyCropFilter = None) -> dict:
+    ''' Run detections on (row, col, crop) tuples as they are produced, combine the results into a single dict.
+        progress_callback, if given, is called with the percentage of crops done after each batch '''
     # Perform detections
-    full_detections = []
-    rows = len(image_cuts)
-    cols = len(image_cuts[0])
-    for i, row in enumerate(image_cuts):
-        for j, col in enumerate(row):
-            # Dialog isn't appearing without this
-            QCoreApplication.processEvents()
-            pr_p = math.floor((((i) * cols + (j+1)) / (rows * cols)) * 100)
-            progress_dialog.setValue(pr_p)
-            if progress_dialog.wasCanceled():
-                break
-            print(f'Running on cut [{i}][{j}]...')
-            d, flag = find_scaled_boxes_from_crop(image_cuts[i][j], (i, j),
-                                                  full_img_size, stride,
-                                                  detect_fn, score_threshold)
-            if flag:
-                full_detections.append(d)
-
-    # progress.setValue(100)
-    del progress_dialog
-
-    # Fold detections
-    final_detections = reduce(fold_detections, full_detections)
+    accumulator = DetectionAccumulator()
+    for done, d, flag in iter_batch_detections(detect_fn, crops, full_img_size,
+                                               stride, score_threshold,
+                                               batch_size, crop_filter):
+        if flag:
+            accumulator.append(d)
+        if progress_callback is not None and num_crops:
+            progress_callback(math.floor((done / num_crops) * 100))
+
+    # Combine detections with a single concatenation
+    final_detections = accumulator.finalize()
 
     # Apply non max supression for overlapping boxes
-    pruned_detections = non_maximum_supression(final_detections, iou_threshold)
+    pruned_detections = non_maximum_supression(final_detections, iou_threshold,
+                                               nms_mode)
 
     return pruned_detections
 
 
-def fold_detections(d1: dict, d2: dict) -> dict:
-    ''' Used to reduce detections from all image cuts '''
-    boxes = np.concatenate((d1['detection_boxes'], d2['detection_boxes']))
-    scores = np.concatenate((d1['detection_scores'], d2['detection_scores']))
-    classes = np.concatenate(
-        (d1['detection_classes'], d2['detection_classes']))
-    return {
-        'detection_boxes': boxes,
-        'detection_scores': scores,
-        'detection_classes': classes
-    }
+class DetectionAccumulator:
+    ''' Collects detections dictionaries and combines them with one concatenation per key,
+        so merging costs grow linearly with the number of detections '''
 
+    # Empty shapes and types, used when nothing was detected
+    empty_arrays = {
+        'detection_boxes': ((0, 4), np.float64),
+        'detection_scores': ((0,), np.float32),
+        'detection_classes': ((0,), np.int64),
+        'detection_indices': ((0, 2), np.int64)
+    }
 
-def non_maximum_supression(detections: dict, threshold: float) -> dict:
-    ''' Prunes overlapping boxes with TensorFlow's non max supression algorithm '''
-    selected_indices = tf.image.non_max_suppression(
+    def __init__(self):
+        self._parts = {key: [] for key in self.empty_arrays}
+        self.num_detections = 0
+
+    def append(self, detections: dict) -> None:
+        ''' Add the arrays of a detections dictionary, without copying them '''
+        for key, parts in self._parts.items():
+            parts.append(detections[key])
+        self.num_detections += len(detections['detection_scores'])
+
+    def finalize(self) -> dict:
+        ''' Returns all added detections as a single detections dictionary '''
+        combined = {}
+        for key, parts in self._parts.items():
+            if parts:
+                combined[key] = np.concatenate(parts)
+            else:
+                shape, dtype = self.empty_arrays[key]
+                combined[key] = np.zeros(shape, dtype=dtype)
+        return combined
+
+
+def suppress_overlapping(detections: dict, kept_indices: np.ndarray,
+                         existing_boxes: np.ndarray, threshold: float) -> np.ndarray:
+    ''' Returns the kept indices whose boxes don't overlap any of the existing boxes by more than the
+        intersection over union threshold. Existing boxes always win, as though they had the highest score '''
+    if len(kept_indices) == 0 or len(existing_boxes) == 0:
+        return kept_indices
+    boxes = detections['detection_boxes'][kept_indices]
+    overlaps = nms.box_iou(boxes[:, np.newaxis], np.asarray(existing_boxes)[np.newaxis, :]).max(axis=1)
+    return kept_indices[overlaps <= threshold]
+
+
+def non_maximum_supression(detections: dict, threshold: float,
+                           mode: str = 'global') -> dict:
+    ''' Prunes overlapping boxes with non max supression '''
+    selected_indices = non_maximum_supression_indices(detections, threshold, mode)
+    return {key: value[selected_indices] for key, value in detections.items()}
+
+
+def non_maximum_supression_indices(detections: dict, threshold: float,
+                                   mode: str = 'global') -> np.ndarray:
+    ''' Returns the indices of the boxes kept by non max supression, either TensorFlow's global algorithm
+        or, with mode 'grid', one that only compares boxes in neighbouring grid cells '''
+    if len(detections['detection_scores']) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if mode == 'grid':
+        return nms.grid_non_maximum_supression_indices(
+            detections['detection_boxes'],
+            detections['detection_scores'],
+            threshold)
+    tf = load_tensorflow()
+    return tf.image.non_max_suppression(
         detections['detection_boxes'],
         detections['detection_scores'],
         max_output_size=50000,
-        iou_threshold=threshold)
-    detections['detection_boxes'] = tf.gather(detections['detection_boxes'],
-                                              selected_indices).numpy()
-    detections['detection_classes'] = tf.gather(
-        detections['detection_classes'], selected_indices).numpy()
-    detections['detection_scores'] = tf.gather(detections['detection_scores'],
-                                               selected_indices).numpy()
-
-    return detections
+        iou_threshold=threshold).numpy()
 
 
 def visualize_boxes_on_full_image(image: Image, detections: dict) -> None:
     ''' For testing '''
+    import matplotlib.pyplot as plt
+    from object_detection.utils import visualization_utils as viz_utils
 
     print('Visualizing...')
 
@@ -234,6 +367,7 @@ def main():
     # Load model
     print(f'Loading model from {sys.argv[2]} ...')
     saved_model_path = sys.argv[2] + '/saved_model'
+    tf = load_tensorflow()
     detect_fn = tf.saved_model.load(saved_model_path)
 
     print('Running inference...')
@@ -0,0 +1,112 @@
+""" Non max supression over whole-image detections, bucketed into a spatial grid """
+
+import numpy as np
+
+# Offsets of the cells whose boxes are compared with a cell's boxes. Only half of the
+# neighbours are needed, since every pair of neighbouring cells is visited once from the earlier cell
+_CELL_OFFSETS = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def box_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """ Returns the intersection over union of [y_min, x_min, y_max, x_max] boxes, broadcast
+        over the leading dimensions, e.g. box_iou(a[:, None], b[None, :]) for every pair """
+    y_min = np.maximum(boxes_a[..., 0], boxes_b[..., 0])
+    x_min = np.maximum(boxes_a[..., 1], boxes_b[..., 1])
+    y_max = np.minimum(boxes_a[..., 2], boxes_b[..., 2])
+    x_max = np.minimum(boxes_a[..., 3], boxes_b[..., 3])
+    intersection = np.clip(y_max - y_min, 0, None) * np.clip(x_max - x_min, 0, None)
+
+    area_a = (boxes_a[..., 2] - boxes_a[..., 0]) * (boxes_a[..., 3] - boxes_a[..., 1])
+    area_b = (boxes_b[..., 2] - boxes_b[..., 0]) * (boxes_b[..., 3] - boxes_b[..., 1])
+    union = area_a + area_b - intersection
+
+    iou = np.zeros(intersection.shape, dtype=np.float64)
+    np.divide(intersection, union, out=iou, where=union > 0)
+    return iou
+
+
+def _overlapping_pairs(boxes: np.ndarray, iou_threshold: float) -> tuple:
+    """ Returns (first, second) index arrays of every pair of boxes with an IoU above the threshold """
+    heights = boxes[:, 2] - boxes[:, 0]
+    widths = boxes[:, 3] - boxes[:, 1]
+
+    # With cells at least as large as the largest box, boxes can only overlap
+    # when their centres fall in the same or neighbouring cells
+    cell_height = max(float(heights.max()), 1e-9)
+    cell_width = max(float(widths.max()), 1e-9)
+    cell_rows = np.floor((boxes[:, 0] + heights / 2) / cell_height).astype(np.int64)
+    cell_cols = np.floor((boxes[:, 1] + widths / 2) / cell_width).astype(np.int64)
+
+    # Number cells row by row, leaving a spare column on each side so neighbours never wrap
+    cell_rows -= cell_rows.min()
+    cell_cols -= cell_cols.min() - 1
+    row_width = int(cell_cols.max()) + 2
+    cell_keys = cell_rows * row_width + cell_cols
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
+
+    first = []
+    second = []
+    for d_row, d_col in _CELL_OFFSETS:
+        # Range of boxes in the neighbouring cell, for every box
+        neighbour_keys = cell_keys + d_row * row_width + d_col
+        low = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+        counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - low
+
+        # Expand the ranges into candidate pairs
+        a = np.repeat(np.arange(len(boxes)), counts)
+        range_starts = np.repeat(low - (np.cumsum(counts) - counts), counts)
+        b = order[range_starts + np.arange(len(a))]
+        if (d_row, d_col) == (0, 0):
+            # Count pairs within a cell once, and never pair a box with itself
+            same_cell = a < b
+            a, b = a[same_cell], b[same_cell]
+
+        overlapping = box_iou(boxes[a], boxes[b]) > iou_threshold
+        first.append(a[overlapping])
+        second.append(b[overlapping])
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def grid_non_maximum_supression_indices(boxes: np.ndarray, scores: np.ndarray,
+                                        iou_threshold: float) -> np.ndarray:
+    """ Greedy non max supression that only compares boxes in neighbouring grid cells.
+        Gives the same result as a global greedy pass, with no cap on the number of boxes kept.
+        Returns the indices of the kept boxes, highest score first """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores)
+    by_score = np.argsort(-scores, kind='stable')
+    if len(boxes) < 2:
+        return by_score
+
+    first, second = _overlapping_pairs(boxes, iou_threshold)
+
+    # Adjacency lists of overlapping boxes, in both directions
+    sources = np.concatenate((first, second))
+    targets = np.concatenate((second, first))
+    adjacency_order = np.argsort(sources, kind='stable')
+    targets = targets[adjacency_order]
+    bounds = np.searchsorted(sources[adjacency_order], np.arange(len(boxes) + 1))
+
+    # Boxes without overlaps are always kept, only the rest need the greedy pass
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    has_overlaps = bounds[1:] > bounds[:-1]
+    for index in by_score[has_overlaps[by_score]]:
+        if suppressed[index]:
+            continue
+        suppressed[targets[bounds[index]:bounds[index + 1]]] = True
+
+    return by_score[~suppressed[by_score]]
+
+
+def greedy_non_maximum_supression_indices(boxes: np.ndarray, scores: np.ndarray,
+                                          iou_threshold: float) -> np.ndarray:
+    """ Reference greedy non max supression, comparing every box with all the boxes kept so far.
+        Quadratic in the number of boxes, for checking and benchmarking the grid version without TensorFlow """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    kept = []
+    for index in np.argsort(-np.asarray(scores), kind='stable'):
+        if not kept or box_iou(boxes[index], boxes[kept]).max() <= iou_threshold:
+            kept.append(index)
+    return np.array(kept, dtype=np.int64)
@@ -0,0 +1,87 @@
+''' Benchmarks grid non max supression against TensorFlow's global non max supression
+
+    Usage: python -m ml.nms_benchmark [NUM_HEADSTONES ...]
+
+    Without TensorFlow installed, the grid version is compared against the NumPy greedy reference
+    instead, which is quadratic, so the default sizes are smaller.
+
+    Synthetic headstones are laid out in rows on a large orthophoto, and every headstone
+    near a crop overlap is detected twice, like the duplicates produced by stride 300 and crop 320.
+'''
+
+import sys
+import time
+
+import numpy as np
+
+from ml import nms
+
+IMAGE_SIZE = (40000, 30000)
+HEADSTONE_SIZE = (18, 30)
+IOU_THRESHOLD = 0.15
+
+
+def synthetic_detections(num_headstones: int, seed: int = 0) -> tuple:
+    ''' Returns normalized boxes and scores for a grid of headstones, with duplicates at crop overlaps '''
+    rng = np.random.default_rng(seed)
+    full_width, full_height = IMAGE_SIZE
+    cols = int(np.ceil(np.sqrt(num_headstones * full_width / full_height)))
+    rows = int(np.ceil(num_headstones / cols))
+    y, x = np.divmod(np.arange(num_headstones), cols)
+
+    # Headstones spaced evenly, with some jitter
+    top = y * (full_height / rows) + rng.uniform(0, 10, num_headstones)
+    left = x * (full_width / cols) + rng.uniform(0, 10, num_headstones)
+    boxes = np.stack((top, left, top + HEADSTONE_SIZE[1], left + HEADSTONE_SIZE[0]), axis=1)
+
+    # Headstones within the 20 px overlap of neighbouring crops get a second, shifted detection
+    in_overlap = (left % 300) >= 300 - HEADSTONE_SIZE[0] - 20
+    duplicates = boxes[in_overlap] + rng.uniform(-2, 2, (in_overlap.sum(), 4))
+    boxes = np.concatenate((boxes, duplicates))
+    boxes /= np.array([full_height, full_width, full_height, full_width], dtype=np.float64)
+    scores = rng.uniform(0.45, 1.0, len(boxes)).astype(np.float32)
+    return boxes, scores
+
+
+def time_call(function, *args) -> tuple:
+    ''' Returns (seconds, result) for a single call '''
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def baseline_nms() -> tuple:
+    ''' Returns (name, function) of the non max supression the grid version is compared against, TensorFlow's as
+        run by inference.non_maximum_supression in 'global' mode, or the NumPy greedy reference without it '''
+    try:
+        import tensorflow as tf
+    except ImportError:
+        print('TensorFlow is not installed, comparing with the NumPy greedy reference instead')
+        return 'greedy', lambda boxes, scores: nms.greedy_non_maximum_supression_indices(boxes, scores,
+                                                                                         IOU_THRESHOLD)
+
+    def global_nms(boxes: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        return tf.image.non_max_suppression(boxes.astype(np.float32), scores,
+                                            max_output_size=50000,
+                                            iou_threshold=IOU_THRESHOLD).numpy()
+    return 'global', global_nms
+
+
+def main():
+    baseline_name, baseline = baseline_nms()
+    default_sizes = [5000, 20000, 60000] if baseline_name == 'global' else [1000, 5000, 10000]
+    sizes = [int(arg) for arg in sys.argv[1:]] or default_sizes
+    print(f'{"boxes":>8} {baseline_name + " s":>10} {"grid s":>10} {baseline_name + " kept":>12} '
+          f'{"grid kept":>10} {"same":>5}')
+    for num_headstones in sizes:
+        boxes, scores = synthetic_detections(num_headstones)
+        baseline_seconds, baseline_kept = time_call(baseline, boxes, scores)
+        grid_seconds, grid_kept = time_call(nms.grid_non_maximum_supression_indices, boxes, scores,
+                                            IOU_THRESHOLD)
+        same = set(baseline_kept.tolist()) == set(grid_kept.tolist())
+        print(f'{len(boxes):>8} {baseline_seconds:>10.3f} {grid_seconds:>10.3f} '
+              f'{len(baseline_kept):>12} {len(grid_kept):>10} {str(same):>5}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+""" Windowed reading of large rasters, so only the part of an image in use has to be in memory """
+
+import hashlib
+import math
+
+import numpy as np
+from PIL import Image
+
+# TIFF tags used to locate the pixel data
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+BITS_PER_SAMPLE = 258
+SAMPLE_FORMAT = 339
+ORIENTATION = 274
+
+
+class Raster:
+    """ Base class of rasters that return RGB uint8 windows of an image """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self._content_hash = None
+
+    @property
+    def size(self) -> tuple:
+        """ (width, height), like a PIL image """
+        return self.width, self.height
+
+    def as_array(self):
+        """ Returns the whole image as a (height, width, 3) array view without reading it, or None if the pixels
+            aren't laid out as one array """
+        return None
+
+    def content_hash(self, strip_height: int = 1024) -> str:
+        """ Hex digest of the RGB pixels, read a strip at a time. Computed once per raster """
+        if self._content_hash is None:
+            digest = hashlib.blake2b(repr(self.size).encode(), digest_size=20)
+            for top in range(0, self.height, strip_height):
+                digest.update(self.read_window(0, top, self.width, min(strip_height, self.height - top)).data)
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    def read_window(self, left: int, top: int, width: int, height: int) -> np.ndarray:
+        """ Returns a (height, width, 3) RGB uint8 copy of a window, zero-filled where it extends past the image """
+        window = np.zeros((height, width, 3), dtype=np.uint8)
+        right = min(left + width, self.width)
+        bottom = min(top + height, self.height)
+        x0 = max(left, 0)
+        y0 = max(top, 0)
+        if right > x0 and bottom > y0:
+            window[y0 - top:bottom - top, x0 - left:right - left] = self._read(x0, y0, right, bottom)
+        return window
+
+    def _read(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        """ Returns the RGB pixels of a window inside the image """
+        raise NotImplementedError
+
+
+class ArrayRaster(Raster):
+    """ Raster over an image already in memory """
+
+    def __init__(self, array: np.ndarray):
+        super(ArrayRaster, self).__init__(array.shape[1], array.shape[0])
+        self.array = array
+
+    def as_array(self):
+        return self.array
+
+    def _read(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        return self.array[top:bottom, left:right]
+
+
+class WindowRaster(Raster):
+    """ Raster over a window inside another raster, for working on part of an image """
+
+    def __init__(self, source: Raster, left: int, top: int, width: int, height: int):
+        super(WindowRaster, self).__init__(width, height)
+        self.source = source
+        self.left = left
+        self.top = top
+
+    def as_array(self):
+        array = self.source.as_array()
+        if array is None:
+            return None
+        return array[self.top:self.top + self.height, self.left:self.left + self.width]
+
+    def _read(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        return self.source._read(left + self.left, top + self.top, right + self.left, bottom + self.top)
+
+
+class TiffRaster(Raster):
+    """ Raster over the memory-mapped pixel data of an uncompressed 8 bit TIFF, striped or tiled.
+        Reading a window only touches the strips or tiles it overlaps, so images larger than memory can be used """
+
+    def __init__(self, file_name: str, width: int, height: int, samples: int,
+                 offsets: tuple, chunk_size: tuple = None, rows_per_strip: int = None):
+        super(TiffRaster, self).__init__(width, height)
+        self.file_name = file_name
+        self.samples = samples
+        self.offsets = offsets
+        # (width, height) of each tile, or None for strips
+        self.chunk_size = chunk_size
+        self.rows_per_strip = rows_per_strip
+        self._data = np.memmap(file_name, dtype=np.uint8, mode='r')
+
+    def _rgb(self, pixels: np.ndarray) -> np.ndarray:
+        if self.samples < 3:
+            return np.repeat(pixels[:, :, :1], 3, axis=2)
+        return pixels[:, :, :3]
+
+    def _chunk(self, index: int, height: int, width: int) -> np.ndarray:
+        """ Returns the pixels of a strip or tile as a view of the file """
+        start = self.offsets[index]
+        return self._data[start:start + height * width * self.samples].reshape(height, width, self.samples)
+
+    def as_array(self):
+        # Strips written back to back form a single array
+        if self.chunk_size is not None or self.samples < 3:
+            return None
+        strip_bytes = self.rows_per_strip * self.width * self.samples
+        if any(offset != self.offsets[0] + i * strip_bytes for i, offset in enumerate(self.offsets)):
+            return None
+        return self._rgb(self._chunk(0, self.height, self.width))
+
+    def _read(self, left: int, top: int, right: int, bottom: int) -> np.ndarray:
+        window = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+        if self.chunk_size is None:
+            for strip in range(top // self.rows_per_strip, (bottom - 1) // self.rows_per_strip + 1):
+                strip_top = strip * self.rows_per_strip
+                strip_height = min(self.rows_per_strip, self.height - strip_top)
+                pixels = self._chunk(strip, strip_height, self.width)
+                y0 = max(top, strip_top)
+                y1 = min(bottom, strip_top + strip_height)
+                window[y0 - top:y1 - top] = self._rgb(pixels[y0 - strip_top:y1 - strip_top, left:right])
+            return window
+
+        # Tiles are always full size, padded past the image edge
+        tile_width, tile_height = self.chunk_size
+        tiles_across = math.ceil(self.width / tile_width)
+        for tile_row in range(top // tile_height, (bottom - 1) // tile_height + 1):
+            for tile_col in range(left // tile_width, (right - 1) // tile_width + 1):
+                pixels = self._chunk(tile_row * tiles_across + tile_col, tile_height, tile_width)
+                tile_top = tile_row * tile_height
+                tile_left = tile_col * tile_width
+                y0, y1 = max(top, tile_top), min(bottom, tile_top + tile_height)
+                x0, x1 = max(left, tile_left), min(right, tile_left + tile_width)
+                window[y0 - top:y1 - top, x0 - left:x1 - left] = self._rgb(
+                    pixels[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left])
+        return window
+
+
+def _tiff_raster(file_name: str, image: Image):
+    """ Returns a TiffRaster if the TIFF's pixel data can be memory-mapped as is, otherwise None """
+    tags = image.tag_v2
+    samples = tags.get(SAMPLES_PER_PIXEL, 1)
+    bits = tags.get(BITS_PER_SAMPLE, (1,))
+    if not isinstance(bits, tuple):
+        bits = (bits,)
+    sample_formats = tags.get(SAMPLE_FORMAT, (1,))
+    if not isinstance(sample_formats, tuple):
+        sample_formats = (sample_formats,)
+    if (tags.get(COMPRESSION, 1) != 1 or tags.get(PLANAR_CONFIGURATION, 1) != 1
+            or tags.get(ORIENTATION, 1) != 1 or any(bit != 8 for bit in bits)
+            or any(sample_format != 1 for sample_format in sample_formats)):
+        return None
+    # Only RGB, and grayscale with black as zero
+    photometric = tags.get(PHOTOMETRIC)
+    if not ((photometric == 2 and samples >= 3) or (photometric == 1 and samples in (1, 2))):
+        return None
+
+    width, height = image.size
+    if TILE_OFFSETS in tags:
+        chunk_size = (tags[TILE_WIDTH], tags[TILE_LENGTH])
+        return TiffRaster(file_name, width, height, samples, tuple(tags[TILE_OFFSETS]), chunk_size=chunk_size)
+    if STRIP_OFFSETS in tags:
+        rows_per_strip = min(tags.get(ROWS_PER_STRIP, height), height)
+        return TiffRaster(file_name, width, height, samples, tuple(tags[STRIP_OFFSETS]),
+                          rows_per_strip=rows_per_strip)
+    return None
+
+
+def as_raster(image) -> Raster:
+    """ Returns a raster of a raster, image array or PIL image """
+    if isinstance(image, Raster):
+        return image
+    from ml import image_cut
+    return ArrayRaster(image_cut.image_to_array(image))
+
+
+def open_raster(file_name: str) -> Raster:
+    """ Opens an image for windowed reading. Uncompressed TIFFs are memory-mapped, any other image is decoded into
+        memory once """
+    with Image.open(file_name) as image:
+        raster = _tiff_raster(file_name, image) if image.format == 'TIFF' else None
+    if raster is not None:
+        return raster
+
+    from ml import image_cut
+    return ArrayRaster(image_cut.load_image_array(file_name))
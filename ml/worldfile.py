@@ -0,0 +1,39 @@
+""" World file (.tfw) transforms between pixels and world coordinates, without Qt, for headless tools """
+
+import numpy as np
+
+
+class WorldFileTransform:
+    """ Affine transform from pixels to world coordinates and back, for (..., 2) arrays of (x, y) points.
+        The inverse is computed once, so each direction is a single matrix multiply over all the points """
+
+    def __init__(self, a, d, b, e, c, f):  # this is the order of the params in the file
+        self.parameters = (a, d, b, e, c, f)
+        self.matrix = np.array([[a, b, c],
+                                [d, e, f],
+                                [0.0, 0.0, 1.0]])
+        if a * e - b * d == 0:
+            raise ValueError("world file transform can't be inverted")
+        self.inverse = np.linalg.inv(self.matrix)
+
+    @classmethod
+    def from_file(cls, file_name):
+        """ Parses the six parameters of a world file (.tfw), ignoring blank lines """
+        with open(file_name, "r") as tfw_file:
+            lines = [line for line in tfw_file.readlines() if line.strip()]
+        if len(lines) != 6:
+            raise ValueError(f"{file_name} does not have 6 parameters")
+        return cls(*(float(line) for line in lines))
+
+    @staticmethod
+    def _apply(matrix, points):
+        points = np.asarray(points, dtype=np.float64)
+        return points.dot(matrix[:2, :2].T) + matrix[:2, 2]
+
+    def to_world(self, points):
+        """ Maps pixel points to world coordinates """
+        return self._apply(self.matrix, points)
+
+    def to_pixel(self, points):
+        """ Maps world coordinates to pixel points """
+        return self._apply(self.inverse, points)
@@ -4,9 +4,9 @@
 
     Key steps:
         - Load model and get detection function with tf.saved_model(PATH_TO_SAVED_MODEL)
-        - Get image cuts with image_cut.crop_image_with_padding(CROP_IMG_SIZE, STRIDE, IMAGE)
+        - Get image cuts with image_cut.iter_crops_with_padding(CROP_IMG_SIZE, STRIDE, IMAGE)
         - Get detections with inference.detect_and_combine(DETECT_FN, IMAGE_CUTS, FULL_IMG_SIZE,
-                                                           STRIDE, SCORE_THRESHOLD)
+                                                           STRIDE, SCORE_THRESHOLD, IOU_THRESHOLD)
         - The bounding box coordinates can then be accessed as detections['detection_boxes']
           as [y_min, x_min, y_max, x_max] as floats between 0.0 and 1.0 
 
@@ -27,7 +27,7 @@ def main():
     full_width, full_height = image.size
 
     # Make the crops
-    image_cuts = image_cut.crop_image_with_padding((320, 320), 300, image)
+    image_cuts = image_cut.iter_crops_with_padding((320, 320), 300, image)
 
     # Load model
     print(f'Loading model from {sys.argv[2]}...')
@@ -38,7 +38,7 @@ def main():
     print(f'Running inferences...')
     detections = inference.detect_and_combine(detect_fn, image_cuts,
                                               (full_width, full_height), 300,
-                                              0.35)
+                                              0.35, 0.15)
 
     print(detections)
 
@@ -2,10 +2,11 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, QPointF, QRectF, QLineF
 from PyQt5.QtGui import QBrush, QPen
 from PyQt5.QtWidgets import QGraphicsRectItem, QGraphicsLineItem
-from numpy.linalg import norm
-import numpy as np
 
+from geometry_store import GeometryStore
 from selection_polygon import SelectionPolygon
+from spatial_index import CentroidArray, SpatialIndex
+from tiled_image_item import TiledImageItem
 
 
 class PhotoViewer(QtWidgets.QGraphicsView):
@@ -14,13 +15,27 @@ class PhotoViewer(QtWidgets.QGraphicsView):
     def __init__(self, parent):
         super(PhotoViewer, self).__init__(parent)
 
-        # all gravestone-denoting polygons
+        # all gravestone-denoting polygons, with their corners, ids, rows and cols stored together in geometry
         self.selection_polygons = []
+        self.geometry = GeometryStore()
+        # grid of polygon bounds, for finding polygons by area without looping over all of them
+        self.polygon_index = SpatialIndex()
+        # packed scene centroids and radii of all polygons, for line select
+        self.polygon_centroids = CentroidArray()
+        # id given to the next polygon drawn or detected, past the ids of every polygon and imported table row
+        self.next_polygon_id = 0
 
         self.box_creation_mode = False
         self.box_start_point = None
         self._box_graphic = None
 
+        # rubber band for detecting headstones in part of the image, called with the QRectF selected
+        self.region_detection_mode = False
+        self.region_selected = None
+
+        # rubber band for selecting the polygons inside a box, ctrl + drag on the image
+        self.box_select_start = None
+
         self.line_selection_mode = False
         self.start_line_select = None
         self.line_graphic = None
@@ -31,10 +46,17 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         self.selected_polygons = []
         self.update_selected = None
 
+        # called with the visible scene rect shortly after the view stops being panned, zoomed or resized
+        self.viewport_changed = None
+        self._viewport_timer = QtCore.QTimer(self)
+        self._viewport_timer.setSingleShot(True)
+        self._viewport_timer.setInterval(50)
+        self._viewport_timer.timeout.connect(self._notify_viewport_changed)
+
         self._zoom = 0
         self._empty = True
         self.scene = QtWidgets.QGraphicsScene(self)
-        self._photo = QtWidgets.QGraphicsPixmapItem()
+        self._photo = TiledImageItem()
 
         self.scene.addItem(self._photo)
         self.setScene(self.scene)
@@ -64,7 +86,7 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         return self._photo
 
     def fitInView(self, scale=True):
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self._photo.boundingRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.has_photo():
@@ -76,16 +98,23 @@ class PhotoViewer(QtWidgets.QGraphicsView):
                              viewrect.height() / scenerect.height())
                 self.scale(factor, factor)
             self._zoom = 0
+            self._viewport_timer.start()
 
-    def set_photo(self, pixmap=None):
+    def set_photo(self, image=None):
+        """ Show a raster or RGB uint8 array, drawn in tiles so any size of image can be panned and zoomed """
         self._zoom = 0
-        if pixmap and not pixmap.isNull():
+        if image is not None:
             self._empty = False
             self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
-            self._photo.setPixmap(pixmap)
+            self._photo.set_image(image)
 
             self.selection_polygons = []
+            self.geometry.clear()
+            self.polygon_index.clear()
+            self.polygon_centroids.clear()
+            self.next_polygon_id = 0
             self.box_creation_mode = False
+            self.region_detection_mode = False
             self.box_start_point = None
             self._box_graphic = None
 
@@ -94,7 +123,7 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         else:
             self._empty = True
             self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
-            self._photo.setPixmap(QtGui.QPixmap())
+            self._photo.set_image(None)
         self.fitInView()
 
     def wheelEvent(self, event):
@@ -111,14 +140,81 @@ class PhotoViewer(QtWidgets.QGraphicsView):
                 self.fitInView()
             else:
                 self._zoom = 0
+            self._viewport_timer.start()
+
+    def scrollContentsBy(self, dx, dy):
+        super(PhotoViewer, self).scrollContentsBy(dx, dy)
+        self._viewport_timer.start()
+
+    def resizeEvent(self, event):
+        super(PhotoViewer, self).resizeEvent(event)
+        self._viewport_timer.start()
+
+    def visible_scene_rect(self):
+        return self.mapToScene(self.viewport().rect()).boundingRect()
+
+    def _notify_viewport_changed(self):
+        if self.viewport_changed is not None and self.has_photo():
+            self.viewport_changed(self.visible_scene_rect())
+
+    def new_polygon_id(self):
+        """ Takes an id no polygon, loaded or not, has yet """
+        id = self.next_polygon_id
+        self.next_polygon_id += 1
+        return id
+
+    def reserve_polygon_ids(self, next_id):
+        """ Keeps new polygons from taking ids below next_id, such as those of a table's unloaded rows """
+        self.next_polygon_id = max(self.next_polygon_id, next_id)
 
     def delete_selected(self):
-        for selected in self.selected_polygons:
-            selected.deselect()
-            self.scene.removeItem(selected)
-            self.selection_polygons.remove(selected)
+        self.remove_selection_polygons(self.selected_polygons)
 
-        self.selected_polygons = []
+    def remove_selection_polygons(self, polygons):
+        """ Delete the given polygons, in a single pass over all polygons. Polygons already deleted are ignored,
+            their geometry slot may belong to another polygon by now """
+        polygons = {polygon for polygon in polygons if polygon in self.polygon_index}
+        if not polygons:
+            return
+        for polygon in polygons:
+            if polygon._selected:
+                polygon.deselect()
+            if polygon.scene() is self.scene:
+                self.scene.removeItem(polygon)
+            self.polygon_index.remove(polygon)
+            self.polygon_centroids.remove(polygon)
+            self.geometry.release(polygon.slot)
+        self.selected_polygons = [polygon for polygon in self.selected_polygons if polygon not in polygons]
+        self.selection_polygons = [polygon for polygon in self.selection_polygons if polygon not in polygons]
+        if self.update_selected is not None:
+            self.update_selected()
+
+    def polygon_bounds(self, polygon):
+        """ (x0, y0, x1, y1) scene bounds of a polygon, as stored in the polygon index """
+        rect = polygon.sceneBoundingRect()
+        return rect.left(), rect.top(), rect.right(), rect.bottom()
+
+    def polygon_geometry_changed(self, polygon):
+        """ Called by polygons after they are moved, rotated or reshaped, to keep the polygon index current """
+        if polygon in self.polygon_index:
+            self.polygon_index.insert(polygon, self.polygon_bounds(polygon))
+            self.polygon_centroids.insert(polygon, *self.polygon_centroid_and_radius(polygon))
+
+    def polygon_centroid_and_radius(self, polygon):
+        """ (x, y) scene centroid and radius of a polygon, as stored in the centroid array """
+        centroid = polygon.centroid() + polygon.pos()
+        return (centroid.x(), centroid.y()), polygon.radius()
+
+    def polygons_at(self, scene_point):
+        """ Polygons containing a scene point, found through the polygon index """
+        x, y = scene_point.x(), scene_point.y()
+        return [polygon for polygon in self.polygon_index.query_rect((x, y, x, y))
+                if polygon.contains(polygon.mapFromScene(scene_point))]
+
+    def polygons_in_rect(self, rect):
+        """ Polygons whose centroid lies inside a scene rectangle """
+        candidates = self.polygon_index.query_rect((rect.left(), rect.top(), rect.right(), rect.bottom()))
+        return [polygon for polygon in candidates if rect.contains(polygon.centroid() + polygon.pos())]
 
     def any_selection_nodes_under_mouse(self):
         for selected in self.selected_polygons:
@@ -128,6 +224,12 @@ class PhotoViewer(QtWidgets.QGraphicsView):
 
         return False
 
+    def rotate_polygons(self, polygons, degrees):
+        """ Rotate each polygon about its own centroid, in one operation on the geometry store """
+        self.geometry.rotate([polygon.slot for polygon in polygons], degrees)
+        for polygon in polygons:
+            polygon.geometry_changed()
+
     def deselect_all(self):
         for polygon in self.selected_polygons:
             polygon.deselect()
@@ -141,17 +243,23 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         for polygon in self.selection_polygons:
             self.scene.removeItem(polygon)
         self.selection_polygons.clear()
+        self.geometry.clear()
+        self.polygon_index.clear()
+        self.polygon_centroids.clear()
 
     def mousePressEvent(self, event):
         if not self._photo.isUnderMouse():
             return
-        if self.box_creation_mode:
+        if self.box_creation_mode or self.region_detection_mode:
             photo_click_point = self.mapToScene(event.pos()).toPoint()
             self.box_start_point = photo_click_point
 
             self._box_graphic = QGraphicsRectItem(0, 0, 1, 1)
             self._box_graphic.setBrush(QBrush(Qt.transparent))
-            self._box_graphic.setPen(QPen(Qt.blue, 2, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
+            if self.region_detection_mode:
+                self._box_graphic.setPen(QPen(Qt.yellow, 2, Qt.DashLine, Qt.RoundCap, Qt.RoundJoin))
+            else:
+                self._box_graphic.setPen(QPen(Qt.blue, 2, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin))
             self._box_graphic.setPos(photo_click_point)
             self.scene.addItem(self._box_graphic)
         elif self.line_selection_mode and self.start_line_select is None:
@@ -160,6 +268,18 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             self.line_graphic = QGraphicsLineItem()
             self.line_graphic.setPen(QPen(Qt.green, 4, Qt.DotLine, Qt.RoundCap, Qt.RoundJoin))
             self.scene.addItem(self.line_graphic)
+        elif self.ctrl_held and not self.any_selection_nodes_under_mouse() \
+                and not self.polygons_at(self.mapToScene(event.pos())):
+            # box select, starting outside any polygon
+            photo_click_point = self.mapToScene(event.pos()).toPoint()
+            self.box_select_start = photo_click_point
+            self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
+
+            self._box_graphic = QGraphicsRectItem(0, 0, 1, 1)
+            self._box_graphic.setBrush(QBrush(Qt.transparent))
+            self._box_graphic.setPen(QPen(Qt.green, 2, Qt.DotLine, Qt.RoundCap, Qt.RoundJoin))
+            self._box_graphic.setPos(photo_click_point)
+            self.scene.addItem(self._box_graphic)
         else:
             # this is pretty hacky and ugly but it works well
             if not self.any_selection_nodes_under_mouse() and not self.ctrl_held:
@@ -183,6 +303,29 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             self.box_start_point = None
             self._box_graphic = None
             self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
+        elif self.region_detection_mode and self.box_start_point is not None:
+            photo_click_point = self.mapToScene(event.pos()).toPoint()
+            region = QRectF(QPointF(self.box_start_point), QPointF(photo_click_point)).normalized()
+            self.scene.removeItem(self._box_graphic)
+
+            self.region_detection_mode = False
+            self.box_start_point = None
+            self._box_graphic = None
+            self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
+
+            if self.region_selected is not None:
+                self.region_selected(region)
+        elif self.box_select_start is not None:
+            photo_click_point = self.mapToScene(event.pos()).toPoint()
+            rect = QRectF(QPointF(self.box_select_start), QPointF(photo_click_point)).normalized()
+            self.scene.removeItem(self._box_graphic)
+            self._box_graphic = None
+            self.box_select_start = None
+            self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
+
+            for polygon in self.polygons_in_rect(rect):
+                if not polygon._selected:
+                    polygon.select()
         elif self.line_selection_mode and self.start_line_select is not None:
             # line select
             self.deselect_all()
@@ -190,30 +333,11 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             photo_click_point = self.mapToScene(event.pos()).toPoint()
             self.scene.removeItem(self.line_graphic)
 
-            for polygon in self.selection_polygons:
-                line = [np.array([photo_click_point.x(), photo_click_point.y()]),
-                        np.array([self.start_line_select.x(), self.start_line_select.y()])]
-                centroid = polygon.centroid()
-
-                # max node dist from centroid, used for approximations
-                max_dist = 0.0
-                for point in polygon.polygon_points:
-                    # todo manhattan length is a bad approx of euclid. dist, maybe its not worth the inaccuracy
-                    dist = (point - centroid).manhattanLength()
-                    if dist > max_dist:
-                        max_dist = dist
-
-                np_centroid = np.array([centroid.x(), centroid.y()])
-                distance_from_line = np.abs(np.cross(line[1] - line[0], line[0] - np_centroid)) / norm(
-                    line[0] - line[1])
-
-                if distance_from_line <= max_dist:
-                    min_x = min(photo_click_point.x(), self.start_line_select.x()) * .95
-                    max_x = max(photo_click_point.x(), self.start_line_select.x()) * 1.05
-                    min_y = min(photo_click_point.y(), self.start_line_select.y()) * .95
-                    max_y = max(photo_click_point.y(), self.start_line_select.x()) * 1.05
-                    if min_x < centroid.x() < max_x and min_y < centroid.y() < max_y:
-                        polygon.select()
+            # polygons whose centroid is within their radius of the line
+            line = [(self.start_line_select.x(), self.start_line_select.y()),
+                    (photo_click_point.x(), photo_click_point.y())]
+            for polygon in self.polygon_centroids.near_polyline(line):
+                polygon.select()
 
             self.start_line_select = None
             self.line_graphic = None
@@ -221,20 +345,30 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             super(PhotoViewer, self).mouseReleaseEvent(event)
 
     def mouseMoveEvent(self, event):
-        if self.box_creation_mode and self.box_start_point is not None and self._box_graphic is not None:
+        if ((self.box_creation_mode or self.region_detection_mode) and self.box_start_point is not None
+                and self._box_graphic is not None):
             mouse_point = self.mapToScene(event.pos()).toPoint()
             self._box_graphic.setRect(QRectF(0,
                                              0,
                                              mouse_point.x() - self.box_start_point.x(),
                                              mouse_point.y() - self.box_start_point.y()).normalized())
+        elif self.box_select_start is not None and self._box_graphic is not None:
+            mouse_point = self.mapToScene(event.pos()).toPoint()
+            self._box_graphic.setRect(QRectF(0,
+                                             0,
+                                             mouse_point.x() - self.box_select_start.x(),
+                                             mouse_point.y() - self.box_select_start.y()).normalized())
         elif self.line_selection_mode and self.start_line_select is not None and self.line_graphic is not None:
             mouse_point = self.mapToScene(event.pos()).toPoint()
             self.line_graphic.setLine(QLineF(mouse_point, self.start_line_select))
         super(PhotoViewer, self).mouseMoveEvent(event)
 
     def add_selection_polygon(self, selection_polygon):
+        self.reserve_polygon_ids(selection_polygon.id + 1)
         self.selection_polygons.append(selection_polygon)
         self.scene.addItem(selection_polygon)
+        self.polygon_index.insert(selection_polygon, self.polygon_bounds(selection_polygon))
+        self.polygon_centroids.insert(selection_polygon, *self.polygon_centroid_and_radius(selection_polygon))
 
     def pixmap_width_and_height(self):
-        return self._photo.pixmap().width(), self._photo.pixmap().height()
+        return self._photo.width_and_height()
@@ -3,29 +3,32 @@ from PyQt5.QtCore import Qt, QPointF
 from PyQt5.QtWidgets import QGraphicsPolygonItem, QGraphicsItem
 from PyQt5 import QtGui
 import numpy as np
-import math
 
 from edge import Edge
+from geometry_store import NO_VALUE, optional_value
 from node import Node
 
 
 class SelectionPolygon(QGraphicsPolygonItem):
     # NOTE! TRUE POSITIONING OFR ANY GIVEN POLYGON COORD IS self.pos() + node.pos()
+    # The corners, id, row and col live in the photoviewer's geometry store, this item is a view of its record
 
-    def __init__(self, points, photoviewer):
+    def __init__(self, points, photoviewer, id=None, row=None, col=None):
         super(SelectionPolygon, self).__init__()
 
         self._photoviewer = photoviewer
+        self._store = photoviewer.geometry
 
-        self.id = len(self._photoviewer.selection_polygons)
-        self.row = None
-        self.col = None
+        if id is None:
+            id = self._photoviewer.new_polygon_id()
+        if not isinstance(points, np.ndarray):
+            points = [(point.x(), point.y()) for point in points]
+        self.slot = self._store.allocate(points, id, row, col)
 
         self._selected = False
         self._nodes = []
         self._edges = []
         self._scene = photoviewer.scene
-        self.polygon_points = points
 
         polygon = QtGui.QPolygonF(self.polygon_points)
 
@@ -38,68 +41,100 @@ class SelectionPolygon(QGraphicsPolygonItem):
         self.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
         self.setZValue(1)
 
-    def centroid(self):
-        sum_point = QPointF(0, 0)
-        for point in self.polygon_points:
-            sum_point += point
+    @property
+    def id(self):
+        return int(self._store.records['id'][self.slot])
 
-        return QPointF(sum_point.x()/len(self.polygon_points), sum_point.y()/len(self.polygon_points))
+    @id.setter
+    def id(self, value):
+        self._store.records['id'][self.slot] = value
 
-    def rotate(self, degrees):
-        radians = np.radians(degrees)
-        # todo this could be pulled out for all polygons but it would make it ugly, idk if the optimization is needed
-        cos_deg = math.cos(radians)
-        sin_deg = math.sin(radians)
+    @property
+    def row(self):
+        return optional_value(self._store.records['row'][self.slot])
+
+    @row.setter
+    def row(self, value):
+        self._store.records['row'][self.slot] = NO_VALUE if value is None else value
 
-        origin = self.centroid()
+    @property
+    def col(self):
+        return optional_value(self._store.records['col'][self.slot])
 
-        for point, node in zip(self.polygon_points, self._nodes):
-            old_x = point.x()
-            point.setX(origin.x() + cos_deg * (point.x() - origin.x()) - sin_deg * (point.y() - origin.y()))
-            point.setY(origin.y() + sin_deg * (old_x - origin.x()) + cos_deg * (point.y() - origin.y()))
+    @col.setter
+    def col(self, value):
+        self._store.records['col'][self.slot] = NO_VALUE if value is None else value
+
+    @property
+    def polygon_points(self):
+        """ Corners in item coordinates """
+        return [QPointF(x, y) for x, y in self._store.records['corners'][self.slot]]
+
+    def centroid(self):
+        x, y = self._store.centroids([self.slot])[0]
+        return QPointF(x, y)
 
+    def radius(self):
+        """ Furthest distance of any point from the centroid """
+        return float(self._store.radii([self.slot])[0])
+
+    def rotate(self, degrees):
+        self._store.rotate([self.slot], degrees)
+        self.geometry_changed()
+
+    def geometry_changed(self):
+        """ Redraws the polygon and moves its nodes after its corners change in the geometry store """
+        points = self.polygon_points
+        for point, node in zip(points, self._nodes):
             node.setPos(point + self.pos())
 
         for edge in self._edges:
             edge.adjust()
 
-        polygon = QtGui.QPolygonF(self.polygon_points)
+        polygon = QtGui.QPolygonF(points)
         self.setPolygon(polygon)
+        self._photoviewer.polygon_geometry_changed(self)
 
     def itemChange(self, change, value):
         if change == QGraphicsItem.ItemPositionHasChanged:
             p = self.pos()
             self.setPos(QPointF(round(p.x()), round(p.y())))
+            self._store.records['offset'][self.slot] = (self.pos().x(), self.pos().y())
 
-            for idx in range(0, len(self.polygon_points)):
-                self._nodes[idx].setPos(self.polygon_points[idx] + self.pos())
+            for point, node in zip(self.polygon_points, self._nodes):
+                node.setPos(point + self.pos())
 
             for edge in self._edges:
                 edge.adjust()
 
+            self._photoviewer.polygon_geometry_changed(self)
+
         return super(SelectionPolygon, self).itemChange(change, value)
 
     def update_points_from_nodes(self):
-        self.polygon_points = [node.pos() - self.pos() for node in self._nodes]
+        self._store.records['corners'][self.slot] = [(node.pos().x() - self.pos().x(), node.pos().y() - self.pos().y())
+                                                     for node in self._nodes]
         polygon = QtGui.QPolygonF(self.polygon_points)
 
         self.setPolygon(polygon)
+        self._photoviewer.polygon_geometry_changed(self)
 
     def select(self):
         self._selected = True
         self._photoviewer.add_selected_polygon(self)
 
+        points = self.polygon_points
         first_node = Node(self)
-        first_node.setPos(self.polygon_points[0] + self.pos())
+        first_node.setPos(points[0] + self.pos())
 
         self._nodes = [first_node]
         self._edges = []
 
         self._scene.addItem(first_node)
 
-        for idx in range(1, len(self.polygon_points)):
+        for idx in range(1, len(points)):
             new_node = Node(self)
-            new_node.setPos(self.polygon_points[idx] + self.pos())
+            new_node.setPos(points[idx] + self.pos())
             self._scene.addItem(new_node)
 
             new_edge = Edge(self._nodes[idx - 1], new_node, self)
@@ -132,4 +167,4 @@ class SelectionPolygon(QGraphicsPolygonItem):
         super(SelectionPolygon, self).mousePressEvent(event)
 
     def adjusted_polygon_points(self):
-        return [self.pos() + QPointF(point[0], point[1]) for point in self.polygon_points]
+        return [QPointF(x, y) for x, y in self._store.scene_corners([self.slot])[0]]
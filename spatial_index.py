@@ -0,0 +1,163 @@
+from collections import defaultdict
+import math
+
+import numpy as np
+
+
+class SpatialIndex:
+    """ Uniform grid over the bounding rectangles of items, for finding the items in a rectangle or at a point
+        without visiting every item. Rectangles are (x0, y0, x1, y1) in scene coordinates """
+
+    def __init__(self, cell_size=64.0):
+        self.cell_size = cell_size
+
+        # (col, row) -> items whose bounds touch that cell
+        self._cells = defaultdict(set)
+        # item -> bounds
+        self._bounds = {}
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __contains__(self, item):
+        return item in self._bounds
+
+    def _cell_range(self, bounds):
+        x0, y0, x1, y1 = bounds
+        return (int(math.floor(x0 / self.cell_size)), int(math.floor(y0 / self.cell_size)),
+                int(math.floor(x1 / self.cell_size)), int(math.floor(y1 / self.cell_size)))
+
+    def bounds(self, item):
+        return self._bounds.get(item)
+
+    def insert(self, item, bounds):
+        """ Add an item, or move it if it's already indexed """
+        self.remove(item)
+        self._bounds[item] = bounds
+        first_col, first_row, last_col, last_row = self._cell_range(bounds)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                self._cells[(col, row)].add(item)
+
+    def remove(self, item):
+        bounds = self._bounds.pop(item, None)
+        if bounds is None:
+            return
+        first_col, first_row, last_col, last_row = self._cell_range(bounds)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                cell = self._cells[(col, row)]
+                cell.discard(item)
+                if not cell:
+                    del self._cells[(col, row)]
+
+    def clear(self):
+        self._cells.clear()
+        self._bounds.clear()
+
+    def _items_in_cells(self, cell_range):
+        first_col, first_row, last_col, last_row = cell_range
+        items = set()
+        # Visit only the occupied cells when the range covers more cells than are occupied
+        if (last_col - first_col + 1) * (last_row - first_row + 1) > len(self._cells):
+            for (col, row), cell in self._cells.items():
+                if first_col <= col <= last_col and first_row <= row <= last_row:
+                    items.update(cell)
+            return items
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                cell = self._cells.get((col, row))
+                if cell:
+                    items.update(cell)
+        return items
+
+    def query_rect(self, bounds):
+        """ Items whose bounds intersect the rectangle """
+        x0, y0, x1, y1 = bounds
+        return {item for item in self._items_in_cells(self._cell_range(bounds))
+                if self._bounds[item][0] <= x1 and self._bounds[item][2] >= x0
+                and self._bounds[item][1] <= y1 and self._bounds[item][3] >= y0}
+
+
+class CentroidArray:
+    """ Packed (N, 2) array of item centroids and an (N,) array of their radii, the furthest any point of the item
+        is from its centroid. Rows are updated in place and removed by moving the last row into the gap, so
+        queries over every item are single vectorized operations """
+
+    def __init__(self, capacity=1024):
+        self._centroids = np.empty((capacity, 2), dtype=np.float64)
+        self._radii = np.empty(capacity, dtype=np.float64)
+        self._items = []
+        # item -> row
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._rows
+
+    @property
+    def centroids(self):
+        return self._centroids[:len(self._items)]
+
+    @property
+    def radii(self):
+        return self._radii[:len(self._items)]
+
+    def insert(self, item, centroid, radius):
+        """ Add an item, or update its row if it's already in the array """
+        row = self._rows.get(item)
+        if row is None:
+            row = len(self._items)
+            if row == len(self._radii):
+                self._grow()
+            self._items.append(item)
+            self._rows[item] = row
+        self._centroids[row] = centroid
+        self._radii[row] = radius
+
+    def _grow(self):
+        capacity = 2 * len(self._radii)
+        centroids = np.empty((capacity, 2), dtype=np.float64)
+        radii = np.empty(capacity, dtype=np.float64)
+        centroids[:len(self._items)] = self.centroids
+        radii[:len(self._items)] = self.radii
+        self._centroids, self._radii = centroids, radii
+
+    def remove(self, item):
+        row = self._rows.pop(item, None)
+        if row is None:
+            return
+        last = len(self._items) - 1
+        if row != last:
+            moved = self._items[last]
+            self._items[row] = moved
+            self._rows[moved] = row
+            self._centroids[row] = self._centroids[last]
+            self._radii[row] = self._radii[last]
+        self._items.pop()
+
+    def clear(self):
+        self._items.clear()
+        self._rows.clear()
+
+    def near_polyline(self, points):
+        """ Items whose centroid is within their radius of the polyline through the given (x, y) points """
+        points = np.asarray(points, dtype=np.float64)
+        centroids = self.centroids
+        if not len(centroids) or not len(points):
+            return []
+
+        # Squared distance from every centroid to the closest segment, one segment at a time
+        distances = np.sum((centroids - points[0]) ** 2, axis=1)
+        for start, end in zip(points[:-1], points[1:]):
+            direction = end - start
+            length_squared = direction.dot(direction)
+            if length_squared == 0:
+                continue
+            t = np.clip((centroids - start).dot(direction) / length_squared, 0.0, 1.0)
+            closest = start + t[:, np.newaxis] * direction
+            np.minimum(distances, np.sum((centroids - closest) ** 2, axis=1), out=distances)
+
+        return [self._items[row] for row in np.flatnonzero(distances <= self.radii ** 2)]
@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import batch_detect
+from database import Database
+
+
+class OneBoxDetectFn:
+    ''' Finds one headstone in the middle of every crop '''
+
+    accepts_numpy = True
+
+    def __call__(self, batch):
+        count = len(batch)
+        return {'detection_boxes': np.tile([[[0.25, 0.25, 0.5, 0.5], [0.0, 0.0, 0.0, 0.0]]], (count, 1, 1)),
+                'detection_scores': np.tile([[0.9, 0.0]], (count, 1)).astype(np.float32),
+                'detection_classes': np.ones((count, 2), dtype=np.float32),
+                'num_detections': np.ones(count, dtype=np.float32)}
+
+
+class BatchDetectTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.image_path = os.path.join(self.directory.name, '2019 plot-A.tif')
+        # Textured, so no crop is skipped as empty
+        pixels = np.random.RandomState(0).randint(0, 255, (350, 400, 3)).astype(np.uint8)
+        Image.fromarray(pixels).save(self.image_path)
+        with open(os.path.join(self.directory.name, '2019 plot-A.tfw'), 'w') as tfw_file:
+            tfw_file.write("0.5\n0.0\n0.0\n-0.5\n1000.0\n3000.0\n")
+        open(os.path.join(self.directory.name, 'notes.txt'), 'w').close()
+
+        self.settings = batch_detect.read_config('missing.ini')
+        self.settings['detection_cache_dir'] = ''
+        batch_detect._detect_fn = OneBoxDetectFn()
+
+    def tearDown(self):
+        batch_detect._detect_fn = None
+        self.directory.cleanup()
+
+    def test_find_images(self):
+        self.assertEqual(batch_detect.find_images([self.directory.name]), [self.image_path])
+        self.assertEqual(batch_detect.find_images([os.path.join(self.directory.name, '*.txt')]), [])
+
+    def test_table_name(self):
+        self.assertEqual(batch_detect.table_name(self.image_path), 't_2019_plot_A')
+        self.assertEqual(batch_detect.table_name('/images/north.tiff'), 'north')
+
+    def test_write_results(self):
+        pixel_polygons = batch_detect.detect_image(self.image_path, self.settings)
+        # 320 pixel crops every 300 pixels make a 2 x 2 grid on a 400 x 350 image
+        self.assertEqual(pixel_polygons.shape, (4, 4, 2))
+        np.testing.assert_allclose(pixel_polygons[0], [(80, 80), (80, 160), (160, 160), (160, 80)])
+
+        database = Database(os.path.join(self.directory.name, 'results.db'))
+        batch_detect.write_results(self.image_path, pixel_polygons, self.directory.name, database)
+
+        with open(os.path.join(self.directory.name, 't_2019_plot_A.geojson')) as geojson_file:
+            geojson = json.load(geojson_file)
+        self.assertEqual(geojson['name'], 't_2019_plot_A')
+        self.assertEqual(len(geojson['features']), 4)
+        feature = geojson['features'][0]
+        self.assertEqual(feature['properties'], {'id': 0, 'row': None, 'col': None, 'centroid': [1060.0, 2940.0]})
+        self.assertEqual(feature['geometry']['coordinates'],
+                         [[[[1040.0, 2960.0], [1040.0, 2920.0], [1080.0, 2920.0], [1080.0, 2960.0],
+                            [1040.0, 2960.0]]]])
+
+        self.assertEqual(database.get_tables(), ['t_2019_plot_A'])
+        gravestones = database.fetch_gravestones('t_2019_plot_A')
+        self.assertEqual(gravestones['id'].tolist(), [0, 1, 2, 3])
+        self.assertTrue(np.isnan(gravestones['row']).all())
+        self.assertEqual((gravestones['toplx'][0], gravestones['toply'][0], gravestones['botrx'][0],
+                          gravestones['botry'][0], gravestones['centroidx'][0]), (1040.0, 2960.0, 1080.0, 2920.0,
+                                                                                1060.0))
+        database.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
 from PyQt5.QtCore import QPointF
 
 import coordmap
@@ -14,5 +17,43 @@ class CoordMapTest(unittest.TestCase):
         self.assertAlmostEqual(px.y(), 50)
 
 
+class WorldFileTransformTest(unittest.TestCase):
+    def setUp(self):
+        self.parameters = (0.25, 0.01, -0.02, -0.25, 512000.5, 4200000.5)
+        self.transform = coordmap.WorldFileTransform(*self.parameters)
+        self.points = np.random.default_rng(4).uniform(0, 20000, (100, 4, 2))
+
+    def test_matches_point_functions(self):
+        world = self.transform.to_world(self.points)
+        self.assertEqual(world.shape, self.points.shape)
+        for (x, y), (world_x, world_y) in zip(self.points.reshape(-1, 2), world.reshape(-1, 2)):
+            expected = coordmap.coordinate_map(QPointF(x, y), *self.parameters)
+            self.assertAlmostEqual(world_x, expected.x(), places=6)
+            self.assertAlmostEqual(world_y, expected.y(), places=6)
+            pixel = coordmap.pixel_map(expected, *self.parameters)
+            self.assertAlmostEqual(pixel.x(), x, places=4)
+            self.assertAlmostEqual(pixel.y(), y, places=4)
+
+    def test_round_trip(self):
+        np.testing.assert_allclose(self.transform.to_pixel(self.transform.to_world(self.points)), self.points,
+                                   atol=1e-6)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'image.tfw')
+            with open(file_name, 'w') as tfw_file:
+                tfw_file.write('\n'.join(str(parameter) for parameter in self.parameters) + '\n\n')
+            self.assertEqual(coordmap.WorldFileTransform.from_file(file_name).parameters, self.parameters)
+
+            with open(file_name, 'w') as tfw_file:
+                tfw_file.write('1.0\n0.0\n0.0\n')
+            with self.assertRaises(ValueError):
+                coordmap.WorldFileTransform.from_file(file_name)
+
+    def test_singular_transform(self):
+        with self.assertRaises(ValueError):
+            coordmap.WorldFileTransform(1.0, 2.0, 2.0, 4.0, 0.0, 0.0)
+
+
 if __name__ == '__main__':
     unittest.main()
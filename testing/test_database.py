@@ -1,6 +1,9 @@
+import threading
 import unittest
 
-from database import Database
+import numpy as np
+
+from database import Database, gravestone_rows, rows_to_array
 
 
 class TestDatabase(unittest.TestCase):
@@ -27,6 +30,112 @@ class TestDatabase(unittest.TestCase):
         self.database.delete_table("test_table")
         self.assertListEqual(self.database.get_tables(), [], "Should be empty")
 
+    def test_add_entries(self):
+        self.database.create_table("bulk_table")
+        corners = [[[x + 0.5, 1.5], [x + 2.5, 1.5], [x + 2.5, 3.5], [x + 0.5, 3.5]] for x in range(1000)]
+        centroids = [[x + 1.5, 2.5] for x in range(1000)]
+        entries = gravestone_rows(range(1000), [None] * 1000, [7] * 1000, corners, centroids)
+        # Not a valid coordinate, so skipped
+        entries.append((1000, None, None, float('nan'), 1.5, 2.5, 1.5, 2.5, 3.5, 0.5, 3.5, 1.5, 2.5))
+
+        self.assertEqual(self.database.add_entries("bulk_table", entries), 1000)
+        df = self.database.get_gravestones("bulk_table")
+        self.assertEqual(len(df.index), 1000)
+        row = df[df["id"] == 10].iloc[0]
+        # Bottom left is the fourth corner, bottom right the third
+        self.assertEqual((row["col"], row["toplx"], row["botlx"], row["botrx"], row["botry"], row["centroidx"]),
+                         (7, 10.5, 10.5, 12.5, 3.5, 11.5))
+        self.database.delete_table("bulk_table")
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(self.database._connection()))
+        thread.start()
+        thread.join()
+        self.assertIs(self.database._connection(), self.database._connection())
+        self.assertIsNot(connections[0], self.database._connection())
+        self.database.close()
+        self.assertEqual(self.database.get_tables(), [])
+
+    def test_query_bbox(self):
+        self.database.create_table("bbox_table")
+        self.assertListEqual(self.database.get_tables(), ["bbox_table"], "Spatial index tables should be hidden")
+        corners = [[[x, 10.5], [x + 2, 10.5], [x + 2, 12.5], [x, 12.5]] for x in range(0, 100, 5)]
+        centroids = [[x + 1, 11.5] for x in range(0, 100, 5)]
+        self.database.add_entries("bbox_table", gravestone_rows(range(20), [None] * 20, [None] * 20,
+                                                                corners, centroids))
+
+        df = self.database.query_bbox("bbox_table", 11.5, 0.0, 21.0, 11.0)
+        self.assertListEqual(sorted(df["id"].tolist()), [2, 3, 4])
+        # Touching the corner of a box counts
+        self.assertListEqual(self.database.query_bbox("bbox_table", 2.0, 12.5, 2.0, 20.0)["id"].tolist(), [0])
+        self.assertEqual(len(self.database.query_bbox("bbox_table", 0.0, 20.0, 100.0, 30.0)), 0)
+
+        # Replacing and deleting rows keeps the index in sync
+        self.database.add_entry("bbox_table", 3, None, None, 500.5, 10.5, 502.5, 10.5, 500.5, 12.5, 502.5, 12.5,
+                                501.5, 11.5)
+        self.assertListEqual(sorted(self.database.query_bbox("bbox_table", 11.5, 0.0, 21.0, 11.0)["id"].tolist()),
+                             [2, 4])
+        self.assertListEqual(self.database.query_bbox("bbox_table", 499.0, 0.0, 510.0, 20.0)["id"].tolist(), [3])
+        self.database._connection().execute("DELETE FROM bbox_table WHERE id = 4;")
+        self.assertListEqual(self.database.query_bbox("bbox_table", 11.5, 0.0, 21.0, 11.0)["id"].tolist(), [2])
+        rtree_count = self.database._connection().execute("SELECT count(*) FROM bbox_table_rtree;").fetchone()[0]
+        self.assertEqual(rtree_count, 19)
+
+        self.database.delete_table("bbox_table")
+        self.assertListEqual(self.database.get_tables(), [])
+
+    def test_query_bbox_indexes_existing_tables(self):
+        # A table from before spatial indexes, as created by older versions
+        conn = self.database._connection()
+        with conn:
+            conn.execute("CREATE TABLE old_table (id INTEGER UNIQUE, row INTEGER, col INTEGER, toplx FLOAT, "
+                         "toply FLOAT, toprx FLOAT, topry FLOAT, botlx FLOAT, botly FLOAT, botrx FLOAT, botry FLOAT, "
+                         "centroidx FLOAT, centroidy FLOAT);")
+            conn.execute("INSERT INTO old_table VALUES (1, 2, 3, 4.0, 5.0, 6.0, 5.0, 4.0, 7.0, 6.0, 7.0, 5.0, 6.0);")
+        self.assertListEqual(self.database.query_bbox("old_table", 0.0, 0.0, 4.5, 5.5)["id"].tolist(), [1])
+
+        # Without the R*Tree module, the table is scanned instead
+        self.database.rtree_available = False
+        self.assertListEqual(self.database.query_bbox("old_table", 5.5, 6.5, 10.0, 10.0)["id"].tolist(), [1])
+        self.database.delete_table("old_table")
+
+    def test_fetch_gravestones(self):
+        self.database.create_table("fetch_table")
+        self.database.add_entry("fetch_table", 1, 2, None, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0)
+        self.database.add_entry("fetch_table", 2, 3, 4, 14.0, 15.0, 16.0, 17.0, 18.0, 19.0, 20.0, 21.0, 22.0, 23.0)
+
+        gravestones = self.database.fetch_gravestones("fetch_table")
+        self.assertEqual(len(gravestones), 2)
+        self.assertListEqual(gravestones["id"].tolist(), [1, 2])
+        self.assertTrue(np.isnan(gravestones["col"][0]))
+        self.assertListEqual(gravestones["botrx"].tolist(), [10.0, 20.0])
+
+        # The same GeoJSON from the array as from a DataFrame
+        properties = ['id', 'row', 'col', 'centroid']
+        geojson = self.database.df_to_geojson(gravestones, properties)
+        self.assertEqual(geojson, self.database.df_to_geojson(self.database.get_gravestones("fetch_table"),
+                                                              properties))
+        self.assertEqual(geojson['features'][0]['properties'], {'id': 1, 'row': 2, 'col': None,
+                                                                'centroid': [12.0, 13.0]})
+        self.database.delete_table("fetch_table")
+        self.assertEqual(len(rows_to_array([])), 0)
+
+    def test_fetch_gravestones_text_cell(self):
+        self.database.create_table("text_table")
+        self.database.add_entry("text_table", 1, 2, 3, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0, 13.0)
+        self.database.add_entry("text_table", 2, 3, 4, 14.0, 15.0, 16.0, 17.0, 18.0, 19.0, 20.0, 21.0, 22.0, 23.0)
+        # Edited by hand in another tool
+        with self.database._connection() as conn:
+            conn.execute("UPDATE text_table SET toplx = 'n/a', col = '5' WHERE id = 2;")
+
+        gravestones = self.database.fetch_gravestones("text_table")
+        self.assertListEqual(gravestones["id"].tolist(), [1, 2])
+        self.assertTrue(np.isnan(gravestones["toplx"][1]))
+        self.assertEqual(gravestones["col"].tolist(), [3, 5])
+        self.assertEqual(gravestones["toply"].tolist(), [5.0, 15.0])
+        self.database.delete_table("text_table")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import database_validation
+
+
+def valid_columns(count):
+    columns = {'id': np.arange(count), 'row': [None] * count, 'col': np.ones(count, dtype=np.int64)}
+    for feature in database_validation.COORD_FEATURES:
+        columns[feature] = np.linspace(-100.0, 4200000.5, count)
+    return columns
+
+
+class CoordTest(unittest.TestCase):
+    def test_accepts_floats(self):
+        for coord in [0.0, 0, -0.0, 1.5e-7, 4.2e6, np.float32(3.25), '0.0', '-.5', '12', '1e5', '+3.5E-2']:
+            self.assertTrue(database_validation.isValidCoord(coord), coord)
+
+    def test_rejects_non_numbers(self):
+        for coord in [None, float('nan'), float('inf'), 'abc', '1.2.3', '', True]:
+            self.assertFalse(database_validation.isValidCoord(coord), coord)
+
+
+class InvalidRowsTest(unittest.TestCase):
+    def test_valid_columns(self):
+        self.assertEqual(database_validation.invalid_rows(valid_columns(1000)).tolist(), [])
+
+    def test_reports_bad_rows(self):
+        columns = valid_columns(10)
+        columns['id'] = columns['id'].astype(np.float64)
+        columns['id'][1] = 1.5
+        columns['row'] = [None, None, 2.5, None, None, None, None, None, None, 4]
+        columns['toprx'] = columns['toprx'].copy()
+        columns['toprx'][4] = np.nan
+        columns['botly'] = list(columns['botly'])
+        columns['botly'][6] = 'abc'
+        columns['centroidx'] = columns['centroidx'].copy()
+        columns['centroidx'][8] = 1e12
+        self.assertEqual(database_validation.invalid_rows(columns).tolist(), [1, 2, 4, 6, 8])
+
+    def test_dataframe(self):
+        dataframe = pd.DataFrame(valid_columns(5))
+        dataframe.loc[3, 'toplx'] = np.inf
+        self.assertEqual(database_validation.invalid_rows(dataframe).tolist(), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
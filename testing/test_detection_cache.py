@@ -0,0 +1,103 @@
+import os
+import shutil
+import time
+import unittest
+
+import numpy as np
+
+from ml import image_cut
+from ml.detection_cache import DetectionCache, iter_cached_detections
+
+
+def detections(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'detection_boxes': rng.random((count, 4)),
+        'detection_scores': rng.random(count).astype(np.float32),
+        'detection_classes': np.ones(count, dtype=np.int64),
+        'detection_indices': rng.integers(0, 5, (count, 2))
+    }
+
+
+class DetectionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = 'detection_cache_test'
+        self.image = np.random.default_rng(1).integers(0, 256, (40, 60, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        cache = DetectionCache(self.directory, 1 << 20)
+        key = cache.key(self.image, 'missing_model', (32, 32), 30)
+        self.assertIsNone(cache.load(key))
+        cache.save(key, detections(10))
+        loaded = cache.load(key)
+        for name, value in detections(10).items():
+            np.testing.assert_array_equal(loaded[name], value)
+            self.assertEqual(loaded[name].dtype, value.dtype)
+
+    def test_key_depends_on_image_model_and_tiling(self):
+        cache = DetectionCache(self.directory, 1 << 20)
+        key = cache.key(self.image, 'model_a', (32, 32), 30)
+        self.assertEqual(key, cache.key(self.image.copy(), 'model_a', (32, 32), 30))
+        changed_image = self.image.copy()
+        changed_image[0, 0, 0] ^= 1
+        self.assertNotEqual(key, cache.key(changed_image, 'model_a', (32, 32), 30))
+        self.assertNotEqual(key, cache.key(self.image, 'model_b', (32, 32), 30))
+        self.assertNotEqual(key, cache.key(self.image, 'model_a', (32, 32), 28))
+        self.assertNotEqual(key, cache.key(self.image, 'model_a', (32, 32), 30, image_cut.EmptyCropFilter(2.0)))
+
+    def test_evicts_least_recently_used(self):
+        cache = DetectionCache(self.directory, 1 << 20)
+        cache.save('first', detections(1000))
+        entry_size = os.path.getsize(os.path.join(self.directory, 'first.npz'))
+        cache.max_bytes = 2 * entry_size + entry_size // 2
+
+        cache.save('second', detections(1000, 1))
+        # Make the modification times distinct, then use the first entry again
+        past = time.time() - 10
+        os.utime(os.path.join(self.directory, 'second.npz'), (past, past))
+        os.utime(os.path.join(self.directory, 'first.npz'), (past - 10, past - 10))
+        self.assertIsNotNone(cache.load('first'))
+
+        cache.save('third', detections(1000, 2))
+        self.assertEqual(sorted(os.listdir(self.directory)), ['first.npz', 'third.npz'])
+
+    def test_low_thresholds_bypass_cache(self):
+        cache = DetectionCache(self.directory, 1 << 20, min_score=0.05)
+        self.assertTrue(cache.covers(0.45))
+        self.assertFalse(cache.covers(0.01))
+
+    def test_lookup_and_iter_cached_detections(self):
+        cache = DetectionCache(self.directory, 1 << 20, min_score=0.05)
+        crops = [(0, col, self.image[:, col * 20:col * 20 + 20]) for col in range(3)]
+        key, cached = cache.lookup(self.image, 'missing_model', (20, 40), 20, None, 0.5)
+        self.assertIsNone(cached)
+
+        def detect_fn(batch):
+            # One box per crop scoring 0.3, below the confidence threshold, and one scoring 0.9
+            count = len(batch)
+            return {'detection_boxes': np.tile([[0.1, 0.1, 0.4, 0.4], [0.5, 0.5, 0.9, 0.9]], (count, 1, 1)),
+                    'detection_scores': np.tile([0.3, 0.9], (count, 1)).astype(np.float32),
+                    'detection_classes': np.ones((count, 2)), 'num_detections': np.full(count, 2)}
+        detect_fn.accepts_numpy = True
+
+        # Cancelled runs aren't cached
+        batches = iter_cached_detections(cache, key, detect_fn, iter(crops), (60, 40), 20, 0.5)
+        next(batches)
+        batches.close()
+        self.assertIsNone(cache.load(key))
+
+        batches = list(iter_cached_detections(cache, key, detect_fn, iter(crops), (60, 40), 20, 0.5))
+        self.assertEqual([len(detections['detection_scores']) for _, detections, _ in batches], [1, 1, 1])
+        self.assertEqual(len(cache.load(key)['detection_scores']), 6)
+
+        _, cached = cache.lookup(self.image, 'missing_model', (20, 40), 20, None, 0.5)
+        self.assertEqual(cached['detection_scores'].tolist(), [np.float32(0.9)] * 3)
+        # Too low a threshold for the cache to answer
+        self.assertEqual(cache.lookup(self.image, 'missing_model', (20, 40), 20, None, 0.01), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
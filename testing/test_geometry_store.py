@@ -0,0 +1,65 @@
+import math
+import unittest
+
+import numpy as np
+
+from geometry_store import GeometryStore, NO_VALUE, optional_value
+
+SQUARE = [(0, 0), (10, 0), (10, 10), (0, 10)]
+
+
+class GeometryStoreTest(unittest.TestCase):
+    def test_allocate_grows_and_reuses_slots(self):
+        store = GeometryStore(capacity=2)
+        slots = [store.allocate(SQUARE, id=i) for i in range(5)]
+        self.assertEqual(slots, [0, 1, 2, 3, 4])
+        self.assertEqual(store.records['id'][slots].tolist(), [0, 1, 2, 3, 4])
+
+        store.release(1)
+        store.release(1)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.used_slots().tolist(), [0, 2, 3, 4])
+        self.assertEqual(store.allocate(SQUARE, id=9), 1)
+        self.assertEqual(store.records['id'][1], 9)
+
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.allocate(SQUARE), 0)
+
+    def test_missing_row_and_col(self):
+        store = GeometryStore()
+        slot = store.allocate(SQUARE, id=3, row=None, col=7)
+        self.assertEqual(store.records['row'][slot], NO_VALUE)
+        self.assertIsNone(optional_value(store.records['row'][slot]))
+        self.assertEqual(optional_value(store.records['col'][slot]), 7)
+
+    def test_scene_corners_centroids_and_radii(self):
+        store = GeometryStore()
+        first = store.allocate(SQUARE)
+        second = store.allocate([(0, 0), (4, 0), (4, 2), (0, 2)])
+        store.records['offset'][second] = (100, 50)
+
+        corners = store.scene_corners([first, second])
+        np.testing.assert_array_equal(corners[1], [(100, 50), (104, 50), (104, 52), (100, 52)])
+        np.testing.assert_array_equal(store.centroids([first, second]), [(5, 5), (2, 1)])
+        np.testing.assert_allclose(store.radii([first, second]), [math.sqrt(50), math.sqrt(5)])
+
+    def test_rotate_matches_point_by_point_rotation(self):
+        rng = np.random.default_rng(2)
+        store = GeometryStore()
+        polygons = rng.uniform(0, 500, (50, 4, 2))
+        slots = [store.allocate(polygon) for polygon in polygons]
+        store.rotate(slots[::2], 30)
+
+        radians = math.radians(30)
+        for index, polygon in enumerate(polygons):
+            expected = polygon
+            if index % 2 == 0:
+                ox, oy = polygon.mean(axis=0)
+                expected = [(ox + math.cos(radians) * (x - ox) - math.sin(radians) * (y - oy),
+                             oy + math.sin(radians) * (x - ox) + math.cos(radians) * (y - oy)) for x, y in polygon]
+            np.testing.assert_allclose(store.records['corners'][slots[index]], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
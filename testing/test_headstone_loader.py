@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PyQt5.QtCore import QPointF, QRectF
+from PyQt5.QtWidgets import QApplication
+
+import coordmap
+from database import Database, gravestone_rows
+from headstone_loader import HeadstoneLoader
+from photoviewer import PhotoViewer
+from selection_polygon import SelectionPolygon
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class HeadstoneLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = Database(os.path.join(self.directory.name, 'loader.db'))
+        self.database.create_table('stones')
+        self.transform = coordmap.WorldFileTransform(0.5, 0.0, 0.0, -0.5, 1000.0, 3000.0)
+
+        # A 50 x 50 grid of headstones, 40 pixels apart
+        xs, ys = np.meshgrid(np.arange(50) * 40 + 5.0, np.arange(50) * 40 + 5.0)
+        pixel = np.stack([np.stack(corner, axis=-1) for corner in
+                          [(xs, ys), (xs + 20, ys), (xs + 20, ys + 30), (xs, ys + 30)]], axis=2).reshape(-1, 4, 2)
+        world = self.transform.to_world(pixel)
+        count = len(world)
+        self.database.add_entries('stones', gravestone_rows(range(count), [None] * count, list(range(count)),
+                                                            world.tolist(), world.mean(axis=1).tolist()))
+
+        self.viewer = PhotoViewer(None)
+        self.viewer.set_photo(np.zeros((2000, 2000, 3), dtype=np.uint8))
+        self.loader = HeadstoneLoader(self.viewer, self.database, 'stones', self.transform, margin=0)
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def test_loads_only_around_view(self):
+        self.loader.update(QRectF(0, 0, 200, 200))
+        self.assertEqual(self.loader.loaded_count(), 25)
+        polygon = min(self.viewer.selection_polygons, key=lambda polygon: polygon.id)
+        self.assertEqual((polygon.id, polygon.row, polygon.col), (0, None, 0))
+        np.testing.assert_allclose(self.viewer.geometry.scene_corners([polygon.slot])[0],
+                                   [(5, 5), (25, 5), (25, 35), (5, 35)])
+
+        # Panning away removes the headstones left behind
+        self.loader.update(QRectF(1000, 1000, 200, 200))
+        self.assertEqual(self.loader.loaded_count(), 25)
+        self.assertEqual(len(self.viewer.selection_polygons), 25)
+
+    def test_keeps_edits_and_deletions(self):
+        self.loader.update(QRectF(0, 0, 200, 200))
+        polygons = sorted(self.viewer.selection_polygons, key=lambda polygon: polygon.id)
+        edited, deleted, selected = polygons[:3]
+        edited.row = 7
+        selected.select()
+        deleted_id = deleted.id
+        self.viewer.remove_selection_polygons([deleted])
+
+        self.loader.update(QRectF(1000, 1000, 200, 200))
+        self.assertIn(edited, self.viewer.selection_polygons)
+        self.assertIn(selected, self.viewer.selection_polygons)
+        self.assertEqual(len(self.viewer.selection_polygons), 27)
+
+        self.loader.update(QRectF(0, 0, 200, 200))
+        ids = [polygon.id for polygon in self.viewer.selection_polygons]
+        self.assertNotIn(deleted_id, ids)
+        self.assertEqual(ids.count(edited.id), 1)
+
+        self.loader.load_all()
+        self.assertEqual(len(self.viewer.selection_polygons), 2499)
+
+    def test_new_polygons_skip_unloaded_ids(self):
+        self.loader.update(QRectF(0, 0, 200, 200))
+        drawn = SelectionPolygon([QPointF(1, 1), QPointF(1, 3), QPointF(3, 3), QPointF(3, 1)], self.viewer)
+        self.viewer.add_selection_polygon(drawn)
+        self.assertEqual(drawn.id, 2500)
+
+        self.loader.load_all()
+        ids = [polygon.id for polygon in self.viewer.selection_polygons]
+        self.assertEqual(len(ids), 2501)
+        self.assertEqual(len(set(ids)), len(ids))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import threading
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from ml import image_cut
+
+
+class ImageCutTest(unittest.TestCase):
+    def setUp(self):
+        pixels = np.arange(70 * 50 * 3, dtype=np.uint32).reshape((50, 70, 3)) % 251
+        self.image = Image.fromarray(pixels.astype(np.uint8), 'RGB')
+
+    def test_grid_shape(self):
+        self.assertEqual(image_cut.crop_grid_shape((32, 32), 30, self.image.size), (2, 3))
+
+    def test_lazy_crops_match_list(self):
+        crop_list = image_cut.crop_image_with_padding((32, 32), 30, self.image)
+        lazy_crops = list(image_cut.iter_crops_with_padding((32, 32), 30, self.image, prefetch=2))
+        self.assertEqual([(row, col) for row, col, _ in lazy_crops],
+                         [(row, col) for row in range(2) for col in range(3)])
+        for row, col, crop in lazy_crops:
+            self.assertEqual(crop.size, (32, 32))
+            np.testing.assert_array_equal(np.array(crop), np.array(crop_list[row][col]))
+
+    def test_edge_crops_are_padded(self):
+        crops = image_cut.crop_image_with_padding((32, 32), 30, self.image)
+        edge = np.array(crops[1][2])
+        np.testing.assert_array_equal(edge[:20, :10], np.array(self.image)[30:50, 60:70])
+        self.assertFalse(edge[20:, :].any())
+        self.assertFalse(edge[:, 10:].any())
+
+    def test_numpy_backend_matches_pil(self):
+        pil_crops = list(image_cut.iter_crops_with_padding((32, 32), 30, self.image))
+        array_crops = list(image_cut.iter_crops_with_padding((32, 32), 30, self.image, backend='numpy'))
+        self.assertEqual(len(array_crops), len(pil_crops))
+        for (row, col, pil_crop), (array_row, array_col, array_crop) in zip(pil_crops, array_crops):
+            self.assertEqual((row, col), (array_row, array_col))
+            np.testing.assert_array_equal(np.array(pil_crop), array_crop)
+
+    def test_load_image_array_decodes_in_strips(self):
+        palette_image = self.image.convert('P')
+        palette_image.save('image_cut_test.png')
+        try:
+            array = image_cut.load_image_array('image_cut_test.png')
+        finally:
+            os.remove('image_cut_test.png')
+        np.testing.assert_array_equal(array, np.array(palette_image.convert('RGB')))
+        np.testing.assert_array_equal(image_cut.image_to_array(palette_image, strip_height=7), array)
+
+    def test_inner_crops_are_views(self):
+        array = np.array(self.image)
+        tiler = image_cut.ArrayTiler(array, (32, 32), 30)
+        self.assertTrue(np.shares_memory(tiler.crop(0, 0), array))
+        self.assertFalse(np.shares_memory(tiler.crop(1, 2), array))
+
+    def test_empty_crop_filter(self):
+        array = np.zeros((64, 64, 3), dtype=np.uint8)
+        array[:32, :32] = 128
+        array[2:30:4, 2:30:4] = 255
+        array[32:, 32:] = 200
+        crop_filter = image_cut.EmptyCropFilter(min_std=2.0, max_padding=0.9, sample_step=1)
+        kept = list(crop_filter.filter(image_cut.iter_crops_with_padding((32, 32), 32, array)))
+        # Only the textured crop is kept, the uniform and all-black crops are skipped
+        self.assertEqual([(row, col) for row, col, _ in kept], [(0, 0)])
+        self.assertEqual((crop_filter.seen, crop_filter.skipped), (4, 3))
+
+    def test_empty_crop_filter_padding(self):
+        # A black image with a headstone in its bottom right corner
+        array = np.zeros((62, 62, 3), dtype=np.uint8)
+        array[56:, 56:] = 255
+        crop_filter = image_cut.EmptyCropFilter(max_padding=0.9, sample_step=1)
+        kept = list(crop_filter.filter(image_cut.iter_crops_with_padding((32, 32), 30, array), 30, (62, 62)))
+        # The last row and column are mostly padding and their pixels are in the crops before them, black crops
+        # inside the image are kept
+        self.assertEqual([(row, col) for row, col, _ in kept], [(0, 0), (0, 1), (1, 0), (1, 1)])
+        self.assertTrue((kept[3][2][26:, 26:] == 255).all())
+
+        # Here the last column has pixels no other crop has, so it is kept however much padding it has
+        array = np.zeros((64, 64, 3), dtype=np.uint8)
+        array[62:, 62:] = 255
+        crop_filter = image_cut.EmptyCropFilter(max_padding=0.5, sample_step=1)
+        kept = list(crop_filter.filter(image_cut.iter_crops_with_padding((32, 32), 30, array), 30, (64, 64)))
+        self.assertEqual(len(kept), 9)
+        self.assertTrue((kept[8][2][:4, :4] == array[60:, 60:]).all())
+
+    def test_abandoned_generator_stops(self):
+        threads = set(threading.enumerate())
+        crops = image_cut.iter_crops_with_padding((32, 32), 30, self.image, prefetch=1)
+        next(crops)
+        producers = set(threading.enumerate()) - threads
+        self.assertEqual(len(producers), 1)
+        crops.close()
+        producer = producers.pop()
+        producer.join(timeout=5)
+        self.assertFalse(producer.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
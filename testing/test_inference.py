@@ -0,0 +1,164 @@
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ml import inference
+
+
+class FakeDetectFn:
+    ''' Stands in for a model that takes NumPy batches, like the detection service. Each crop gets
+        (crop mean % 4) boxes, padded to max_detections rows as the real model's outputs are '''
+
+    accepts_numpy = True
+
+    def __init__(self, max_detections=5, fixed_batch_size=None):
+        self.max_detections = max_detections
+        self.fixed_batch_size = fixed_batch_size
+        self.batch_shapes = []
+
+    def __call__(self, batch):
+        if self.fixed_batch_size is not None and batch.shape[0] != self.fixed_batch_size:
+            raise ValueError(f'expected a batch of {self.fixed_batch_size}, got {batch.shape[0]}')
+        self.batch_shapes.append(batch.shape)
+        count = len(batch)
+        boxes = np.zeros((count, self.max_detections, 4), dtype=np.float32)
+        scores = np.zeros((count, self.max_detections), dtype=np.float32)
+        num_detections = np.zeros(count, dtype=np.float32)
+        for index, crop in enumerate(batch):
+            level = int(crop.mean())
+            num_detections[index] = level % 4
+            for box in range(level % 4):
+                boxes[index, box] = [0.1 * box, 0.2, 0.1 * box + 0.3, 0.6]
+                scores[index, box] = (level % 10) / 10 + 0.05 * box
+        return {'detection_boxes': boxes, 'detection_scores': scores,
+                'detection_classes': np.ones((count, self.max_detections), dtype=np.float32),
+                'num_detections': num_detections}
+
+
+def numbered_crops(count, size=(8, 6)):
+    ''' (row, col, crop) tuples of uniform crops, each filled with a different value '''
+    return [(index // 3, index % 3, np.full((size[1], size[0], 3), index * 7 + 1, dtype=np.uint8))
+            for index in range(count)]
+
+
+class RegionInferenceTest(unittest.TestCase):
+    def test_region_boxes_to_image(self):
+        # Box covering the right half of a (100, 50, 200, 100) region of a 400 x 200 image
+        boxes = np.array([[0.0, 0.5, 1.0, 1.0]])
+        image_boxes = inference.region_boxes_to_image(boxes, (100, 50, 200, 100), (400, 200))
+        np.testing.assert_allclose(image_boxes, [[50 / 200, 200 / 400, 150 / 200, 300 / 400]])
+
+    def test_suppress_overlapping(self):
+        detections = {
+            'detection_boxes': np.array([[0.1, 0.1, 0.2, 0.2], [0.5, 0.5, 0.6, 0.6], [0.8, 0.8, 0.9, 0.9]]),
+            'detection_scores': np.array([0.9, 0.8, 0.7], dtype=np.float32)
+        }
+        existing = np.array([[0.1, 0.11, 0.2, 0.21], [0.8, 0.85, 0.9, 0.95]])
+        kept = inference.suppress_overlapping(detections, np.array([2, 0, 1]), existing, 0.15)
+        np.testing.assert_array_equal(kept, [1])
+        np.testing.assert_array_equal(
+            inference.suppress_overlapping(detections, np.array([0, 1]), np.zeros((0, 4)), 0.15), [0, 1])
+
+
+class BatchDetectionTest(unittest.TestCase):
+    def detect(self, detect_fn, batch_size, count=7):
+        accumulator = inference.DetectionAccumulator()
+        for _, detections, flag in inference.iter_batch_detections(detect_fn, numbered_crops(count), (100, 100),
+                                                                   4, 0.0, batch_size=batch_size):
+            if flag:
+                accumulator.append(detections)
+        return accumulator.finalize()
+
+    def assert_same_detections(self, detections, expected):
+        self.assertEqual(detections.keys(), expected.keys())
+        for key in expected:
+            np.testing.assert_array_equal(detections[key], expected[key], key)
+
+    def test_batches_match_single_crops(self):
+        single = FakeDetectFn()
+        expected = self.detect(single, 1)
+        self.assertEqual([shape[0] for shape in single.batch_shapes], [1] * 7)
+        self.assertGreater(len(expected['detection_scores']), 0)
+
+        batched = FakeDetectFn()
+        # 7 crops in batches of 3 leave a short final batch
+        self.assert_same_detections(self.detect(batched, 3), expected)
+        self.assertEqual(batched.batch_shapes, [(3, 6, 8, 3), (3, 6, 8, 3), (1, 6, 8, 3)])
+
+    def test_fixed_batch_size_fallback(self):
+        expected = self.detect(FakeDetectFn(), 1)
+        # A model exported for batches of 1 rejects the batch, which is then run a crop at a time
+        fixed = FakeDetectFn(fixed_batch_size=1)
+        self.assert_same_detections(self.detect(fixed, 3), expected)
+        self.assertEqual([shape[0] for shape in fixed.batch_shapes], [1] * 7)
+
+
+class ScaleBoxesTest(unittest.TestCase):
+    def test_matches_scale_box_dims(self):
+        # A 1000 x 700 image in 320 pixel crops every 300, the last row and column run past its edges
+        full_size, crop_size, stride = (1000, 700), (320, 320), 300
+        rng = np.random.RandomState(0)
+        indices = np.array([(0, 0), (0, 3), (2, 0), (2, 3), (1, 2)])
+        boxes = rng.uniform(0, 1, (len(indices), 4))
+        # Reaching into the padding of the bottom right crop
+        boxes[3] = [0.5, 0.5, 1.0, 1.0]
+        scaled = inference.scale_boxes(boxes, indices, full_size, stride, crop_size)
+        for box, index, result in zip(boxes, indices, scaled):
+            np.testing.assert_allclose(result, inference.scale_box_dims(box, full_size, stride, crop_size,
+                                                                        tuple(index)))
+        # Past the image edge boxes scale beyond 1, as they always have
+        self.assertGreater(scaled[3, 3], 1.0)
+
+    def test_batch_masks_padding(self):
+        batch = FakeDetectFn(max_detections=4)(np.stack([crop for _, _, crop in numbered_crops(4)]))
+        # Rows past num_detections hold padding, which would otherwise pass a score threshold of 0
+        batch['detection_scores'][:, -1] = 0.99
+        detections = inference.scale_batch_detections(batch, [(0, 0), (0, 1), (0, 2), (1, 0)], (100, 100), 4,
+                                                      (8, 6))
+        num_detections = batch['num_detections'].astype(int)
+        self.assertEqual(len(detections['detection_scores']), num_detections.sum())
+        self.assertNotIn(np.float32(0.99), detections['detection_scores'])
+        np.testing.assert_array_equal(detections['detection_indices'],
+                                      np.repeat([(0, 0), (0, 1), (0, 2), (1, 0)], num_detections, axis=0))
+        self.assertEqual(detections['detection_classes'].dtype, np.int64)
+
+
+class DetectionAccumulatorTest(unittest.TestCase):
+    def test_empty(self):
+        detections = inference.DetectionAccumulator().finalize()
+        self.assertEqual(detections['detection_boxes'].shape, (0, 4))
+        self.assertEqual(detections['detection_scores'].dtype, np.float32)
+        self.assertEqual(detections['detection_classes'].dtype, np.int64)
+        self.assertEqual(detections['detection_indices'].shape, (0, 2))
+        for mode in ('grid', 'global'):
+            self.assertEqual(inference.non_maximum_supression_indices(detections, 0.5, mode).tolist(), [])
+        self.assertEqual(len(inference.non_maximum_supression(detections, 0.5, 'grid')['detection_boxes']), 0)
+
+    def test_concatenates_in_order(self):
+        accumulator = inference.DetectionAccumulator()
+        for first in (0, 2):
+            accumulator.append({'detection_boxes': np.full((2, 4), first / 10.0),
+                                'detection_scores': np.array([first, first + 1], dtype=np.float32),
+                                'detection_classes': np.ones(2, dtype=np.int64),
+                                'detection_indices': np.full((2, 2), first)})
+        detections = accumulator.finalize()
+        self.assertEqual(accumulator.num_detections, 4)
+        self.assertEqual(detections['detection_scores'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(detections['detection_indices'][:, 0].tolist(), [0, 0, 2, 2])
+
+
+class RemoteDetectionTest(unittest.TestCase):
+    def test_numpy_detect_fn_skips_tensorflow(self):
+        tensorflow_loaded = 'tensorflow' in sys.modules
+        with mock.patch.object(inference, 'load_tensorflow', side_effect=AssertionError('TensorFlow loaded')):
+            batches = list(inference.iter_batch_detections(FakeDetectFn(), numbered_crops(5), (100, 100), 4,
+                                                           0.0, batch_size=2))
+        self.assertEqual([done for done, _, _ in batches], [2, 4, 5])
+        if not tensorflow_loaded:
+            self.assertNotIn('tensorflow', sys.modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
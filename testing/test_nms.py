@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+
+from ml import nms
+
+
+class GridNmsTest(unittest.TestCase):
+    def test_matches_global_greedy(self):
+        rng = np.random.default_rng(7)
+        centres = rng.random((400, 2))
+        sizes = rng.uniform(0.005, 0.04, (400, 2))
+        boxes = np.concatenate((centres - sizes / 2, centres + sizes / 2), axis=1)
+        scores = rng.random(400).astype(np.float32)
+
+        kept = nms.grid_non_maximum_supression_indices(boxes, scores, 0.15)
+        np.testing.assert_array_equal(kept, nms.greedy_non_maximum_supression_indices(boxes, scores, 0.15))
+
+    def test_duplicates_across_crop_overlap(self):
+        boxes = np.array([[0.10, 0.10, 0.20, 0.20],
+                          [0.11, 0.11, 0.21, 0.21],
+                          [0.50, 0.50, 0.60, 0.60]])
+        scores = np.array([0.6, 0.9, 0.7])
+        kept = nms.grid_non_maximum_supression_indices(boxes, scores, 0.15)
+        np.testing.assert_array_equal(kept, [1, 2])
+
+    def test_empty_and_single(self):
+        self.assertEqual(len(nms.grid_non_maximum_supression_indices(np.zeros((0, 4)), np.zeros(0), 0.5)), 0)
+        np.testing.assert_array_equal(
+            nms.grid_non_maximum_supression_indices(np.array([[0, 0, 1, 1]]), np.array([0.5]), 0.5), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
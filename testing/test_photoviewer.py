@@ -0,0 +1,41 @@
+import sys
+import unittest
+
+import numpy as np
+from PyQt5.QtCore import QPointF
+from PyQt5.QtWidgets import QApplication
+
+from photoviewer import PhotoViewer
+from selection_polygon import SelectionPolygon
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class PhotoViewerTest(unittest.TestCase):
+    def setUp(self):
+        self.viewer = PhotoViewer(None)
+        self.viewer.set_photo(np.zeros((200, 200, 3), dtype=np.uint8))
+
+    def add_square(self, x, y):
+        polygon = SelectionPolygon([QPointF(x, y), QPointF(x + 10, y), QPointF(x + 10, y + 10), QPointF(x, y + 10)],
+                                   self.viewer)
+        self.viewer.add_selection_polygon(polygon)
+        return polygon
+
+    def test_removing_deleted_polygon_again(self):
+        first = self.add_square(0, 0)
+        self.viewer.remove_selection_polygons([first])
+        # Takes the slot the first polygon had
+        second = self.add_square(20, 20)
+        self.assertEqual(second.slot, first.slot)
+
+        self.viewer.remove_selection_polygons([first])
+        third = self.add_square(50, 50)
+        self.assertNotEqual(third.slot, second.slot)
+        self.assertEqual(self.viewer.selection_polygons, [second, third])
+        np.testing.assert_array_equal(self.viewer.geometry.scene_corners([second.slot])[0],
+                                      [(20, 20), (30, 20), (30, 30), (20, 30)])
+
+
+if __name__ == '__main__':
+    unittest.main()
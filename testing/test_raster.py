@@ -0,0 +1,117 @@
+import math
+import os
+import struct
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from ml import image_cut, raster
+
+
+def write_tiled_tiff(file_name, array, tile_size):
+    """ Writes an uncompressed, tiled RGB TIFF, which PIL can read but not write """
+    height, width = array.shape[:2]
+    tiles = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            tile = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+            part = array[top:top + tile_size, left:left + tile_size]
+            tile[:part.shape[0], :part.shape[1]] = part
+            tiles.append(tile.tobytes())
+
+    offsets = [8 + sum(len(tile) for tile in tiles[:i]) for i in range(len(tiles))]
+    extra_offset = 8 + sum(len(tile) for tile in tiles)
+    bits_offset = extra_offset
+    offsets_offset = bits_offset + 6
+    counts_offset = offsets_offset + 4 * len(tiles)
+    ifd_offset = counts_offset + 4 * len(tiles)
+    entries = [(256, 4, 1, width), (257, 4, 1, height), (258, 3, 3, bits_offset), (259, 3, 1, 1),
+               (262, 3, 1, 2), (277, 3, 1, 3), (284, 3, 1, 1), (322, 4, 1, tile_size), (323, 4, 1, tile_size),
+               (324, 4, len(tiles), offsets_offset), (325, 4, len(tiles), counts_offset)]
+
+    with open(file_name, 'wb') as tiff_file:
+        tiff_file.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        tiff_file.write(b''.join(tiles))
+        tiff_file.write(struct.pack('<3H', 8, 8, 8))
+        tiff_file.write(struct.pack(f'<{len(tiles)}I', *offsets))
+        tiff_file.write(struct.pack(f'<{len(tiles)}I', *[len(tile) for tile in tiles]))
+        tiff_file.write(struct.pack('<H', len(entries)))
+        for tag, tag_type, count, value in entries:
+            if tag_type == 3 and count == 1:
+                tiff_file.write(struct.pack('<HHIHH', tag, tag_type, count, value, 0))
+            else:
+                tiff_file.write(struct.pack('<HHII', tag, tag_type, count, value))
+        tiff_file.write(struct.pack('<I', 0))
+
+
+class RasterTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.array = rng.integers(1, 256, (70, 90, 3), dtype=np.uint8)
+        self.file_names = []
+
+    def tearDown(self):
+        for file_name in self.file_names:
+            os.remove(file_name)
+
+    def temp_name(self, file_name):
+        self.file_names.append(file_name)
+        return file_name
+
+    def assert_windows_match(self, image):
+        self.assertEqual(image.size, (90, 70))
+        padded = np.zeros((100, 120, 3), dtype=np.uint8)
+        padded[10:80, 10:100] = self.array
+        for left, top, width, height in ((0, 0, 90, 70), (17, 5, 40, 33), (60, 50, 50, 40), (-10, -10, 20, 20)):
+            np.testing.assert_array_equal(image.read_window(left, top, width, height),
+                                          padded[top + 10:top + 10 + height, left + 10:left + 10 + width])
+
+    def test_striped_tiff_is_memory_mapped(self):
+        file_name = self.temp_name('raster_test_striped.tif')
+        Image.fromarray(self.array).save(file_name)
+        image = raster.open_raster(file_name)
+        self.assertIsInstance(image, raster.TiffRaster)
+        self.assert_windows_match(image)
+        np.testing.assert_array_equal(image.as_array(), self.array)
+
+    def test_tiled_tiff(self):
+        file_name = self.temp_name('raster_test_tiled.tif')
+        write_tiled_tiff(file_name, self.array, 32)
+        image = raster.open_raster(file_name)
+        self.assertIsInstance(image, raster.TiffRaster)
+        self.assertIsNone(image.as_array())
+        self.assert_windows_match(image)
+
+    def test_compressed_image_is_decoded(self):
+        file_name = self.temp_name('raster_test.png')
+        Image.fromarray(self.array).save(file_name)
+        image = raster.open_raster(file_name)
+        self.assertIsInstance(image, raster.ArrayRaster)
+        self.assert_windows_match(image)
+
+    def test_window_raster(self):
+        file_name = self.temp_name('raster_test_window.tif')
+        write_tiled_tiff(file_name, self.array, 32)
+        for source in (raster.open_raster(file_name), raster.ArrayRaster(self.array)):
+            window = raster.WindowRaster(source, 20, 10, 50, 40)
+            self.assertEqual(window.size, (50, 40))
+            np.testing.assert_array_equal(window.read_window(0, 0, 50, 40), self.array[10:50, 20:70])
+            # Padding comes from outside the window, not the rest of the image
+            self.assertFalse(window.read_window(40, 30, 20, 20)[10:].any())
+        self.assertTrue(np.shares_memory(window.as_array(), self.array))
+
+    def test_tiled_tiff_crops_match_array_crops(self):
+        file_name = self.temp_name('raster_test_crops.tif')
+        write_tiled_tiff(file_name, self.array, 16)
+        raster_crops = list(image_cut.iter_crops_with_padding((32, 32), 30, raster.open_raster(file_name),
+                                                              prefetch=2))
+        array_crops = list(image_cut.iter_crops_with_padding((32, 32), 30, self.array))
+        self.assertEqual(len(raster_crops), math.ceil(70 / 30) * math.ceil(90 / 30))
+        for (row, col, crop), (array_row, array_col, array_crop) in zip(raster_crops, array_crops):
+            self.assertEqual((row, col), (array_row, array_col))
+            np.testing.assert_array_equal(crop, array_crop)
+
+
+if __name__ == '__main__':
+    unittest.main()
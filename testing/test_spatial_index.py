@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+
+from spatial_index import CentroidArray, SpatialIndex
+
+
+def segment_distance(x, y, start, end):
+    (sx, sy), (ex, ey) = start, end
+    dx, dy = ex - sx, ey - sy
+    length_squared = dx * dx + dy * dy
+    t = 0.0 if length_squared == 0 else max(0.0, min(1.0, ((x - sx) * dx + (y - sy) * dy) / length_squared))
+    return np.hypot(x - (sx + t * dx), y - (sy + t * dy))
+
+
+def random_bounds(rng, count):
+    corners = rng.uniform(-500, 3000, (count, 2))
+    sizes = rng.uniform(5, 150, (count, 2))
+    return [tuple(bounds) for bounds in np.concatenate((corners, corners + sizes), axis=1).tolist()]
+
+
+class SpatialIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.bounds = random_bounds(rng, 500)
+        self.index = SpatialIndex(cell_size=64.0)
+        for item, bounds in enumerate(self.bounds):
+            self.index.insert(item, bounds)
+
+    def test_query_rect_matches_brute_force(self):
+        for query in [(0, 0, 200, 200), (-1000, -1000, 5000, 5000), (1000, 400, 1001, 401), (4000, 4000, 4100, 4100)]:
+            expected = {item for item, (x0, y0, x1, y1) in enumerate(self.bounds)
+                        if x0 <= query[2] and x1 >= query[0] and y0 <= query[3] and y1 >= query[1]}
+            self.assertEqual(self.index.query_rect(query), expected)
+
+    def test_move_and_remove(self):
+        self.index.insert(0, (10000, 10000, 10010, 10010))
+        self.assertEqual(self.index.query_rect((9990, 9990, 10020, 10020)), {0})
+        self.assertNotIn(0, self.index.query_rect(self.bounds[0]))
+
+        self.index.remove(0)
+        self.assertNotIn(0, self.index)
+        self.assertEqual(self.index.query_rect((9990, 9990, 10020, 10020)), set())
+        self.assertEqual(len(self.index), len(self.bounds) - 1)
+        # Removing an item that isn't indexed does nothing
+        self.index.remove(0)
+
+    def test_clear(self):
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(self.index.query_rect((-1e6, -1e6, 1e6, 1e6)), set())
+
+
+class CentroidArrayTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.centroids = rng.uniform(0, 2000, (3000, 2))
+        self.radii = rng.uniform(5, 40, 3000)
+        # Starts small so inserting grows the arrays
+        self.array = CentroidArray(capacity=16)
+        for item, (centroid, radius) in enumerate(zip(self.centroids, self.radii)):
+            self.array.insert(item, centroid, radius)
+
+    def brute_force(self, points, items):
+        found = set()
+        for item in items:
+            x, y = self.centroids[item]
+            if any(segment_distance(x, y, start, end) <= self.radii[item] for start, end in zip(points, points[1:])):
+                found.add(item)
+        return found
+
+    def test_line_matches_brute_force(self):
+        line = [(100, 1900), (1800, 150)]
+        found = set(self.array.near_polyline(line))
+        self.assertEqual(found, self.brute_force(line, range(3000)))
+        self.assertTrue(found)
+
+    def test_polyline_matches_brute_force(self):
+        polyline = [(0, 0), (1000, 300), (1000, 1500), (200, 1900)]
+        self.assertEqual(set(self.array.near_polyline(polyline)), self.brute_force(polyline, range(3000)))
+
+    def test_line_ends_at_its_end_points(self):
+        array = CentroidArray()
+        array.insert('inside', (50, 0), 5)
+        array.insert('past end', (120, 0), 5)
+        self.assertEqual(array.near_polyline([(0, 0), (100, 0)]), ['inside'])
+
+    def test_update_and_remove(self):
+        for item in range(0, 3000, 2):
+            self.array.remove(item)
+        self.array.insert(1, (5000, 5000), 10)
+        self.assertEqual(len(self.array), 1500)
+        self.assertEqual(self.array.near_polyline([(4990, 4990), (5010, 5010)]), [1])
+
+        line = [(100, 1900), (1800, 150)]
+        remaining = set(range(3, 3000, 2))
+        self.assertEqual(set(self.array.near_polyline(line)) - {1}, self.brute_force(line, remaining))
+
+    def test_clear(self):
+        self.array.clear()
+        self.assertEqual(self.array.near_polyline([(0, 0), (2000, 2000)]), [])
+        self.array.insert('new', (10, 10), 1)
+        self.assertEqual(self.array.near_polyline([(0, 0), (20, 20)]), ['new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
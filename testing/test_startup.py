@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+# Modules only needed to run detection, or to read tables into DataFrames, which the editor should not import at
+# startup
+DETECTION_MODULES = ('tensorflow', 'matplotlib', 'object_detection', 'pandas')
+
+
+class StartupTest(unittest.TestCase):
+    def test_editor_import_skips_detection_stack(self):
+        # Import in a fresh interpreter, so modules loaded by other tests don't count
+        script = ("import sys, main; "
+                  f"print('loaded:' + ','.join(name for name in {DETECTION_MODULES!r} if name in sys.modules))")
+        env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', script], cwd='..', env=env,
+                                capture_output=True, text=True, check=True)
+        print(f"Editor imports in {time.perf_counter() - start:.2f}s")
+        self.assertEqual(result.stdout.strip().splitlines()[-1], 'loaded:')
+
+    def test_batch_detect_import_skips_qt(self):
+        # The batch detector runs on machines without a display, so it must not need PyQt
+        script = "import sys, batch_detect; print('PyQt5' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', script], cwd='..', capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import sys
+import unittest
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+
+from tiled_image_item import TiledImageItem, build_pyramid, downsample
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+
+class TiledImageTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.array = rng.integers(0, 256, (301, 250, 3), dtype=np.uint8)
+
+    def test_downsample_averages_blocks(self):
+        half = downsample(self.array, strip_height=16)
+        self.assertEqual(half.shape, (151, 125, 3))
+        expected = (self.array[:300].reshape(150, 2, 125, 2, 3).astype(np.float64).mean(axis=(1, 3)))
+        np.testing.assert_allclose(half[:150], expected, atol=0.5)
+        # The odd last row is averaged with itself
+        np.testing.assert_allclose(half[150], self.array[300].reshape(125, 2, 3).mean(axis=1), atol=0.5)
+
+    def test_pyramid_levels(self):
+        levels = build_pyramid(self.array, tile_size=64)
+        self.assertIs(levels[0].as_array(), self.array)
+        self.assertEqual([level.shape[:2] for level in levels[1:]], [(151, 125), (76, 63), (38, 32)])
+        np.testing.assert_array_equal(levels[2], downsample(downsample(self.array)))
+
+    def test_tile_cache_evicts_least_recently_used(self):
+        item = TiledImageItem(tile_size=64, cache_size=3)
+        item.set_image(self.array)
+        self.assertEqual(item.width_and_height(), (250, 301))
+        item.tile(0, 0, 0)
+        item.tile(0, 0, 1)
+        item.tile(0, 0, 0)
+        item.tile(0, 4, 3)
+        edge = item.tile(1, 2, 1)
+        self.assertEqual(item.cached_tile_count(), 3)
+        self.assertNotIn((0, 0, 1), item._tiles)
+        self.assertIn((0, 0, 0), item._tiles)
+        # Edge tiles are cut to the level's size
+        self.assertEqual((edge.width(), edge.height()), (125 - 64, 151 - 128))
+
+    def test_level_for_scale(self):
+        item = TiledImageItem(tile_size=64)
+        item.set_image(self.array)
+        self.assertEqual(item.level_for_scale(2.0), 0)
+        self.assertEqual(item.level_for_scale(0.6), 0)
+        self.assertEqual(item.level_for_scale(0.3), 1)
+        self.assertEqual(item.level_for_scale(0.001), item.level_count() - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
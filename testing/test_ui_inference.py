@@ -22,6 +22,10 @@ class InferenceUiTest(unittest.TestCase):
         window.image = Image.open("../test_data/graves_small.png")
         window.detect_fn = tf.saved_model.load("../ml/run9/saved_model")
         window.detect_gravestones()
+
+        # Detection runs on a worker thread, wait for it and deliver its signals
+        window.detection_worker.wait()
+        app.processEvents()
         literal_pts = [(51.26742750406265, 142.48606532812119),
                        (51.26742750406265, 167.80804574489594),
                        (66.45438686013222, 167.80804574489594),
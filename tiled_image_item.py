@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import math
+import tempfile
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import QRectF
+
+from ml import raster
+
+# Pyramid levels with more pixels than this are kept in a temporary file instead of memory
+MAX_LEVEL_PIXELS_IN_MEMORY = 64 * 1024 * 1024
+
+
+def array_to_qimage(array):
+    """ Wraps an RGB uint8 array in a QImage without copying it, the array must outlive the QImage """
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    image = QtGui.QImage(array.data, width, height, array.strides[0], QtGui.QImage.Format_RGB888)
+    # Keep the buffer alive for as long as the QImage is
+    image.ndarray = array
+    return image
+
+
+def downsample(array, strip_height=512):
+    """ Halves an RGB uint8 array in both dimensions by averaging 2x2 blocks, a strip at a time so the
+        temporary arrays stay small. Odd edges are averaged with a copy of the last row or column """
+    height, width = array.shape[:2]
+    result = np.empty(((height + 1) // 2, (width + 1) // 2, array.shape[2]), dtype=np.uint8)
+    for top in range(0, height, 2 * strip_height):
+        block = array[top:top + 2 * strip_height].astype(np.uint16)
+        if block.shape[0] % 2:
+            block = np.concatenate((block, block[-1:]), axis=0)
+        if block.shape[1] % 2:
+            block = np.concatenate((block, block[:, -1:]), axis=1)
+        total = block[0::2, 0::2] + block[1::2, 0::2] + block[0::2, 1::2] + block[1::2, 1::2]
+        result[top // 2:top // 2 + total.shape[0]] = (total + 2) >> 2
+    return result
+
+
+def _empty_level(height, width):
+    """ Array for a pyramid level, memory-mapped to a temporary file if it's too large to hold in memory """
+    if height * width <= MAX_LEVEL_PIXELS_IN_MEMORY:
+        return np.empty((height, width, 3), dtype=np.uint8)
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(height, width, 3))
+
+
+def build_pyramid(source, tile_size=512, strip_height=512):
+    """ Returns the image raster followed by successively halved arrays, down to the first that fits in one tile.
+        The image is read once, a strip at a time, and the halved levels add a third of its size """
+    if isinstance(source, np.ndarray):
+        source = raster.ArrayRaster(source)
+    levels = [source]
+    width, height = source.size
+    previous = None
+    while max(width, height) > tile_size:
+        level = _empty_level((height + 1) // 2, (width + 1) // 2)
+        for top in range(0, height, 2 * strip_height):
+            if previous is None:
+                strip = source.read_window(0, top, width, min(2 * strip_height, height - top))
+            else:
+                strip = previous[top:top + 2 * strip_height]
+            level[top // 2:top // 2 + strip_height] = downsample(strip, strip_height)
+        levels.append(level)
+        previous = level
+        height, width = level.shape[:2]
+    return levels
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """ Draws a large image as tiles from a pyramid of downsampled levels, only creating pixmaps for the tiles
+        in view at the level matching the zoom. Recently drawn tiles are kept in a least recently used cache """
+
+    def __init__(self, tile_size=512, cache_size=256, parent=None):
+        super(TiledImageItem, self).__init__(parent)
+
+        self.tile_size = tile_size
+        self.cache_size = cache_size
+
+        self._levels = []
+        self._width = 0
+        self._height = 0
+        # (level, row, col) -> QPixmap, least recently drawn first
+        self._tiles = OrderedDict()
+
+        # Needed for the exposed rect in paint()
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def set_image(self, image=None):
+        """ Show a raster or RGB uint8 array, which is read as needed rather than copied. None clears the item """
+        self.prepareGeometryChange()
+        self._tiles.clear()
+        if image is None:
+            self._levels = []
+            self._width = self._height = 0
+        else:
+            self._levels = build_pyramid(image, self.tile_size)
+            self._width, self._height = self._levels[0].size
+        self.update()
+
+    def is_empty(self):
+        return not self._levels
+
+    def width_and_height(self):
+        return self._width, self._height
+
+    def level_count(self):
+        return len(self._levels)
+
+    def cached_tile_count(self):
+        return len(self._tiles)
+
+    def level_size(self, level):
+        """ (width, height) of a pyramid level """
+        if level == 0:
+            return self._width, self._height
+        return self._levels[level].shape[1], self._levels[level].shape[0]
+
+    def boundingRect(self):
+        return QRectF(0, 0, self._width, self._height)
+
+    def level_for_scale(self, scale):
+        """ Coarsest level with at least one image pixel per screen pixel at this scale """
+        if scale >= 1 or scale <= 0:
+            return 0
+        return min(int(math.floor(math.log2(1 / scale))), len(self._levels) - 1)
+
+    def tile(self, level, row, col):
+        """ Returns the pixmap of a tile, creating it and evicting the least recently used tiles if needed """
+        key = (level, row, col)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+
+        top = row * self.tile_size
+        left = col * self.tile_size
+        if level == 0:
+            # Only the tiles in view are read from the full resolution image
+            width = min(self.tile_size, self._width - left)
+            height = min(self.tile_size, self._height - top)
+            tile_array = self._levels[0].read_window(left, top, width, height)
+        else:
+            tile_array = self._levels[level][top:top + self.tile_size, left:left + self.tile_size]
+        pixmap = QtGui.QPixmap.fromImage(array_to_qimage(tile_array))
+
+        self._tiles[key] = pixmap
+        while len(self._tiles) > self.cache_size:
+            self._tiles.popitem(last=False)
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        if not self._levels:
+            return
+
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.level_for_scale(scale)
+        factor = 2 ** level
+        level_width, level_height = self.level_size(level)
+
+        # Tiles of this level that intersect the exposed part of the item
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        scene_tile_size = self.tile_size * factor
+        first_col = max(0, int(exposed.left() // scene_tile_size))
+        first_row = max(0, int(exposed.top() // scene_tile_size))
+        last_col = min(int(math.ceil(exposed.right() / scene_tile_size)), math.ceil(level_width / self.tile_size))
+        last_row = min(int(math.ceil(exposed.bottom() / scene_tile_size)), math.ceil(level_height / self.tile_size))
+
+        # Halved odd edges make the coarser levels slightly larger than the image, clip that off
+        painter.save()
+        painter.setClipRect(self.boundingRect(), QtCore.Qt.IntersectClip)
+        if scale < 1:
+            painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        for row in range(first_row, last_row):
+            for col in range(first_col, last_col):
+                pixmap = self.tile(level, row, col)
+                target = QRectF(col * scene_tile_size, row * scene_tile_size,
+                                pixmap.width() * factor, pixmap.height() * factor)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+        painter.restore()